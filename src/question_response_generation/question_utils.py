@@ -1,11 +1,18 @@
+import os
 import random
 
+import numpy
 import spacy
 import torch
 # from datasets import load_dataset
 from spacy.lang.en.stop_words import STOP_WORDS
 from torch.utils.data import DataLoader
 
+from src.re_qa_model import mask_pad_labels
+from src.zero_extraction_utils import (ColumnarDataset, ShardedDataset,
+                                       TokenizerEncoder, create_sharded_loader,
+                                       write_shards)
+
 
 def white_space_fix(text):
     return " ".join(text.split())
@@ -228,6 +235,24 @@ def create_data_for_question_pretrain():
     return contexts, questions
 
 
+def tokenize_question_pretrain_shard(
+    question_tokenizer, contexts, questions, source_max_length, decoder_max_length
+):
+    """Tokenize the contexts and questions of one shard, unpadded."""
+    encoder = TokenizerEncoder(question_tokenizer)
+    input_ids = [ids[:source_max_length] for ids in encoder(contexts)]
+    labels = [ids[:decoder_max_length] for ids in encoder(questions)]
+    return ColumnarDataset(
+        {
+            "input_ids": input_ids,
+            "attention_mask": [[1] * len(ids) for ids in input_ids],
+            "labels": labels,
+            "target_attention_mask": [[1] * len(ids) for ids in labels],
+        },
+        pad_token_id=question_tokenizer.pad_token_id,
+    )
+
+
 def create_question_pretrain_dataset(
     question_tokenizer,
     batch_size,
@@ -235,8 +260,36 @@ def create_question_pretrain_dataset(
     decoder_max_length,
     distributed=True,
     num_workers=1,
+    shard_dir=None,
+    shard_size=100000,
 ):
-    """Function to create the question input-outputs to do the pretraining of the question generator."""
+    """Function to create the question input-outputs to do the pretraining of the question generator.
+
+    With a shard_dir, the examples are tokenized into shards of shard_size
+    examples, reused if shard_dir exists, and streamed by a ShardedDataset.
+    """
+
+    if shard_dir is not None:
+        if not os.path.exists(shard_dir):
+            contexts, questions = create_data_for_question_pretrain()
+            write_shards(
+                shard_dir,
+                (
+                    tokenize_question_pretrain_shard(
+                        question_tokenizer,
+                        contexts[start : start + shard_size],
+                        questions[start : start + shard_size],
+                        source_max_length,
+                        decoder_max_length,
+                    )
+                    for start in range(0, len(contexts), shard_size)
+                ),
+            )
+        train_dataset = ShardedDataset(
+            shard_dir, batch_size, shuffle=True, num_workers=num_workers
+        )
+        train_loader = create_sharded_loader(train_dataset)
+        return train_loader, train_dataset, None
 
     contexts, questions = create_data_for_question_pretrain()
     train_encodings = question_tokenizer(
@@ -255,19 +308,9 @@ def create_question_pretrain_dataset(
     )
     train_encodings["target_attention_mask"] = train_answer_encodings.attention_mask
 
-    train_encodings["labels"] = train_answer_encodings.input_ids
-
-    # because HuggingFace automatically shifts the labels, the labels correspond exactly to `target_ids`.
-    # We have to make sure that the PAD token is ignored
-
-    train_labels = [
-        [
-            -100 if token == question_tokenizer.pad_token_id else token
-            for token in labels
-        ]
-        for labels in train_encodings["labels"]
-    ]
-    train_encodings["labels"] = train_labels
+    train_encodings["labels"] = mask_pad_labels(
+        numpy.asarray(train_answer_encodings.input_ids), question_tokenizer.pad_token_id
+    )
 
     class HelperDataset(torch.utils.data.Dataset):
         def __init__(self, encodings):
@@ -1,9 +1,12 @@
 import random
 
+import numpy
 import torch
 # from datasets import load_dataset
 from torch.utils.data import DataLoader
 
+from src.re_qa_model import mask_pad_labels
+
 
 def white_space_fix(text):
     return " ".join(text.split())
@@ -211,15 +214,9 @@ def create_response_dataset(
             batch["input_ids"] = inputs.input_ids
             batch["attention_mask"] = inputs.attention_mask
             batch["target_attention_mask"] = outputs.attention_mask
-            batch["labels"] = outputs.input_ids
-
-            # We have to make sure that the PAD token is ignored, -100 is being ignored in the loss function.
-
-            labels = [
-                [-100 if token == tokenizer.pad_token_id else token for token in labels]
-                for labels in batch["labels"]
-            ]
-            batch["labels"] = labels
+            batch["labels"] = mask_pad_labels(
+                numpy.asarray(outputs.input_ids), tokenizer.pad_token_id
+            )
 
             return batch
 
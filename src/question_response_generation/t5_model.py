@@ -11,12 +11,13 @@ import torch
 from transformers import Adafactor, T5ForConditionalGeneration, T5Tokenizer
 
 from src.re_qa_model import (HyperParameters, clear_cache, load_module,
-                             set_random_seed)
+                             sequence_log_p, set_random_seed, torch_save)
 
 
-def save(model: torch.nn.Module, path: str) -> None:
-    """Save the model to task at the specified path."""
-    torch.save(model.state_dict(), path)
+def save(model: torch.nn.Module, path: str, writer=None) -> None:
+    """Save the model to task at the specified path, in the background with
+    a CheckpointWriter."""
+    torch_save(model, path, writer=writer)
 
 
 # MODEL_NAME = "t5-base"
@@ -69,25 +70,22 @@ class T5QA(object):
             model.to(self.device)
 
             self.model_path = os.path.join(cfg.model_path, "model")
-            load_module(model, self.model_path, cfg.checkpoint)
+            if cfg.checkpoint is not None:
+                load_module(model, self.model_path, cfg.checkpoint)
 
         self.model = model
         self.tokenizer = tokenizer
 
-    def save(self, checkpoint_name: str):
+    def save(self, checkpoint_name: str, writer=None):
         """Save the encoder model to the specified path name."""
         path = self.model_path + "_" + checkpoint_name
-        save(self.model, path + "_model")
+        save(self.model, path + "_model", writer=writer)
 
     def relation_extraction_predict(self, batch):
         clear_cache()
         # disable dropout
         self.model.eval()
 
-        loss_fct = torch.nn.CrossEntropyLoss(ignore_index=-100, reduction="none")
-        if self.config.gpu:
-            loss_fct = loss_fct.to(self.device)
-
         input_ids = batch["input_ids"]
         input_mask = batch["attention_mask"]
         target_mask = batch["target_attention_mask"]
@@ -98,26 +96,16 @@ class T5QA(object):
             target_mask = target_mask.to(self.device)
             labels = labels.to(self.device)
 
-        output = self.model(
-            input_ids=input_ids,
-            attention_mask=input_mask,
-            decoder_attention_mask=target_mask,
-            decoder_input_ids=self.model._shift_right(labels),
-            labels=None,
-        )
-
-        log_p = -loss_fct(
-            output.logits.view(-1, output.logits.size(-1)),
-            labels.view(-1),
-        )
+        # the dataparallel wrapper of the train mode hides the t5 submodules.
+        model = getattr(self.model, "module", self.model)
+        with torch.no_grad():
+            answer_log_p = sequence_log_p(
+                model, labels, target_mask, input_mask, input_ids=input_ids
+            )
 
         # b: batch size * num_unseen_relations
-        # sz: sequence size
-        # v: vocab size
-        b, sz, v = output.logits.size()
-        log_p = log_p.view(b, sz)
-        good_log_p = log_p.masked_fill_(labels == -100, 0.0)
-        answer_log_p = torch.sum(good_log_p, dim=1).squeeze().cpu().detach().numpy()
+        b = answer_log_p.size(0)
+        answer_log_p = answer_log_p.cpu().numpy()
 
         for index in range(b):
             relation_log_p = answer_log_p[index]
@@ -126,6 +114,66 @@ class T5QA(object):
             }
             yield output_batch
 
+    def checkpoint_parameters(self, state_dict):
+        """Move the parameters of the checkpoint state_dict to the device, in
+        the dtype of the model for the half precision checkpoints.
+
+        The tied parameters are one parameter of the model, so they get
+        one tensor under its first name.
+        """
+        model = getattr(self.model, "module", self.model)
+        return {
+            name: state_dict[name].to(self.device, dtype=param.dtype)
+            for name, param in model.named_parameters()
+        }
+
+    def multi_relation_extraction_predict(self, batch, checkpoints):
+        """relation_extraction_predict for the parameters of every checkpoint
+        in one pass over the batch.
+
+        The checkpoint parameters are swapped into the model in turn, and
+        the parameters of the model are restored after the batch. Every
+        example gives the list of its output rows for the checkpoints.
+        """
+        clear_cache()
+        # disable dropout
+        self.model.eval()
+
+        input_ids = batch["input_ids"]
+        input_mask = batch["attention_mask"]
+        target_mask = batch["target_attention_mask"]
+        labels = batch["labels"]
+        if self.config.gpu:
+            input_ids = input_ids.to(self.device)
+            input_mask = input_mask.to(self.device)
+            target_mask = target_mask.to(self.device)
+            labels = labels.to(self.device)
+
+        model = getattr(self.model, "module", self.model)
+        model_parameters = dict(model.named_parameters())
+        model_data = {name: param.data for name, param in model_parameters.items()}
+        answer_log_ps = []
+        try:
+            with torch.no_grad():
+                for parameters in checkpoints:
+                    for name, param in model_parameters.items():
+                        param.data = parameters[name]
+                    answer_log_p = sequence_log_p(
+                        model, labels, target_mask, input_mask, input_ids=input_ids
+                    )
+                    answer_log_ps.append(answer_log_p.cpu().numpy())
+        finally:
+            for name, param in model_parameters.items():
+                param.data = model_data[name]
+
+        # b: batch size * num_unseen_relations
+        b = input_ids.size(0)
+        for index in range(b):
+            yield [
+                {"relation_log_p": answer_log_p[index]}
+                for answer_log_p in answer_log_ps
+            ]
+
     def predict(self, batch):
         clear_cache()
         # disable dropout
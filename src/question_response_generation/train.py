@@ -14,8 +14,10 @@ from src.question_response_generation.question_utils import \
 from src.question_response_generation.response_utils import \
     create_response_dataset
 from src.question_response_generation.t5_model import T5QA, HyperParameters
-from src.re_qa_model import set_random_seed
-from src.zero_extraction_utils import create_prompt_zero_re_qa_dataset
+from src.re_qa_model import CheckpointWriter, TopCheckpoints, set_random_seed
+from src.zero_extraction_utils import (create_prompt_zero_re_qa_dataset,
+                                       evaluate_relation_f1,
+                                       predictions_in_dataset_order)
 
 def run_train_epoch(
     model,
@@ -40,22 +42,49 @@ def run_predict(
     with io.open(prediction_file, mode="w", encoding="utf-8") as out_fp:
         writer = csv.writer(out_fp, **writerparams)
         header_written = False
-        for batch in dev_dataloader:
-            if prediction_type in ["entity", "prompt"]:
-                for ret_row in model.predict(batch):
-                    if not header_written:
-                        headers = ret_row.keys()
-                        writer.writerow(headers)
-                        header_written = True
-                    writer.writerow(list(ret_row.values()))
-
-            elif prediction_type == "relation":
-                for ret_row in model.relation_extraction_predict(batch):
-                    if not header_written:
-                        headers = ret_row.keys()
-                        writer.writerow(headers)
-                        header_written = True
-                    writer.writerow(list(ret_row.values()))
+        if prediction_type in ["entity", "prompt"]:
+            predict_function = model.predict
+
+        elif prediction_type == "relation":
+            predict_function = model.relation_extraction_predict
+
+        # rows are written in the order of the dataset to line up with the gold files.
+        for ret_row in predictions_in_dataset_order(dev_dataloader, predict_function):
+            if not header_written:
+                headers = ret_row.keys()
+                writer.writerow(headers)
+                header_written = True
+            writer.writerow(list(ret_row.values()))
+
+
+def run_multi_relation_predict(
+    model, dev_dataloader, checkpoints, prediction_files
+) -> None:
+    """Score the relations of the 'dev_dataset' with the parameters of every
+    checkpoint in one pass over the data, and save the results of every
+    checkpoint in its prediction file."""
+    writerparams = {"quotechar": '"', "quoting": csv.QUOTE_ALL}
+    out_fps = [
+        io.open(prediction_file, mode="w", encoding="utf-8")
+        for prediction_file in prediction_files
+    ]
+    try:
+        writers = [csv.writer(out_fp, **writerparams) for out_fp in out_fps]
+        header_written = False
+
+        def predict_function(batch):
+            return model.multi_relation_extraction_predict(batch, checkpoints)
+
+        # rows are written in the order of the dataset to line up with the gold files.
+        for ret_rows in predictions_in_dataset_order(dev_dataloader, predict_function):
+            for writer, ret_row in zip(writers, ret_rows):
+                if not header_written:
+                    writer.writerow(ret_row.keys())
+                writer.writerow(list(ret_row.values()))
+            header_written = True
+    finally:
+        for out_fp in out_fps:
+            out_fp.close()
 
 
 def save_config(config: HyperParameters, path: str) -> None:
@@ -79,8 +108,15 @@ def run_model(
     train_dataloader=None,
     test_dataloader=None,
     save_always: Optional[bool] = False,
+    dev_dataloader=None,
+    dev_gold_ids=None,
 ) -> None:
-    """Run the model on input data (for training or testing)"""
+    """Run the model on input data (for training or testing)
+
+    With config.eval_steps, the relations of the dev_dataloader are scored
+    during training, and with config.keep_top_k only the checkpoints with
+    the best dev f1 are saved.
+    """
 
     model_path = config.model_path
     max_epochs = config.max_epochs
@@ -88,6 +124,18 @@ def run_model(
     if mode == "train":
         print("\nINFO: ML training\n")
         first_start = time.time()
+        # the checkpoints are written in the background.
+        writer = CheckpointWriter(
+            flat=config.flat_checkpoints,
+            dtype=config.checkpoint_dtype,
+            base=config.model_name if config.delta_checkpoints else None,
+        )
+        evaluate_dev = config.eval_steps is not None and dev_dataloader is not None
+        top_checkpoints = None
+        if evaluate_dev and config.keep_top_k is not None:
+            top_checkpoints = TopCheckpoints(
+                model.model_path, config.keep_top_k, writer=writer
+            )
         epoch = 0
         while epoch < max_epochs:
             print("\nEpoch:{0}\n".format(epoch))
@@ -111,16 +159,41 @@ def run_model(
                         step, loss, mean_loss
                     )
                 )
-                if step > 0 and save_always and (step % 100 == 0):
-                    model.save(str(epoch) + "_step_" + str(step))
+                if evaluate_dev and step % config.eval_steps == 0:
+                    dev_f1 = evaluate_relation_f1(
+                        dev_dataloader,
+                        model.relation_extraction_predict,
+                        dev_gold_ids,
+                    )
+                    print(
+                        "\rDev F1:{0} | Epoch:{1} | Step:{2}\n".format(
+                            dev_f1, epoch, step
+                        )
+                    )
+                    if top_checkpoints is not None:
+                        checkpoint = str(epoch) + "_step_" + str(step)
+                        top_checkpoints.add(
+                            dev_f1,
+                            ["_" + checkpoint + "_model"],
+                            lambda: model.save(checkpoint, writer=writer),
+                        )
+
+                if (
+                    step > 0
+                    and save_always
+                    and top_checkpoints is None
+                    and (step % 100 == 0)
+                ):
+                    model.save(str(epoch) + "_step_" + str(step), writer=writer)
 
             if save_always:
-                model.save(str(epoch))
+                model.save(str(epoch), writer=writer)
 
             msg = "\nEpoch training time:{} seconds\n".format(time.time() - start)
             print(msg)
             epoch += 1
 
+        writer.wait()
         save_config(config, model_path)
         msg = "\nTotal training time:{} seconds\n".format(time.time() - first_start)
         print(msg)
@@ -253,6 +326,7 @@ def run_pretrain_question_generator(args):
         decoder_max_length=config.decoder_max_length,
         distributed=False,
         num_workers=1,
+        shard_dir=args.shard_dir,
     )
     run_model(
         model,
@@ -307,7 +381,8 @@ def run_prompt_qa(args):
         source_max_length=config.source_max_length,
         decoder_max_length=config.decoder_max_length,
         file_path=file,
-        for_evaluation=for_evaluation)
+        for_evaluation=for_evaluation,
+        max_tokens=args.max_tokens)
 
     if mode == "train":
         run_model(
@@ -374,6 +449,12 @@ def argument_parser():
 
     parser.add_argument("--batch_size", type=int, default=8, help="static batch size")
 
+    parser.add_argument(
+        "--max_tokens",
+        type=int,
+        help="source token budget of the length-bucketed batches, instead of batch_size.",
+    )
+
     parser.add_argument(
         "--num_train_steps", type=int, default=50000, help="number of train steps"
     )
@@ -398,6 +479,11 @@ def argument_parser():
     parser.add_argument(
         "--checkpoint", type=str, help="checkpoint of the trained model."
     )
+    parser.add_argument(
+        "--shard_dir",
+        type=str,
+        help="directory of the tokenized shards streamed for the pretraining.",
+    )
     args, _ = parser.parse_known_args()
     return args
 
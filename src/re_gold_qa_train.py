@@ -1,12 +1,21 @@
 import argparse
+import glob
+import os
+import re
+
+from transformers import T5Tokenizer
 
 from src.question_response_generation.t5_model import T5QA
-from src.question_response_generation.train import run_model
-from src.re_qa_model import REQA, HyperParameters, load_module, set_random_seed
+from src.question_response_generation.train import (run_model,
+    run_multi_relation_predict)
+from src.re_qa_model import (MODEL_NAME, REQA, HyperParameters, load_module,
+    num_dataset_examples, prefetch_weights, set_random_seed)
 from src.re_qa_train import iterative_run_model
-from src.zero_extraction_utils import (create_fewrl_dataset,
-    create_relation_qq_dataset, create_zero_re_qa_dataset,
-    create_zero_re_qa_gold_dataset)
+from src.zero_extraction_utils import (OFFMML_COLUMNS, SEGMENT_MARKERS,
+    TokenizerEncoder, create_fewrl_dataset, create_relation_qq_dataset,
+    create_zero_re_qa_dataset, create_zero_re_qa_gold_dataset, file_digest,
+    offmml_data_path, prepare_fewrl_data, prepare_wikizsl_data,
+    read_offmml_data, read_relation_gold_ids)
 
 
 def run_relation_classification_qa(args):
@@ -41,8 +50,10 @@ def run_relation_classification_qa(args):
         batch_size=config.batch_size,
         source_max_length=config.source_max_length,
         decoder_max_length=config.decoder_max_length,
+        max_tokens=args.max_tokens,
         file=args.dev,
         concat=concat_bool,
+        write_relation_data=args.write_relation_data == "True",
     )
 
     run_model(
@@ -96,6 +107,8 @@ def run_re_gold_qa(args):
         batch_size=config.batch_size,
         source_max_length=config.source_max_length,
         decoder_max_length=config.decoder_max_length,
+        max_tokens=args.max_tokens,
+        cache_dir=args.cache_dir,
         train_file=args.train,
         dev_file=args.dev,
         ignore_unknowns=False,
@@ -153,6 +166,8 @@ def run_re_concat_qa(args):
         batch_size=config.batch_size,
         source_max_length=config.source_max_length,
         decoder_max_length=config.decoder_max_length,
+        max_tokens=args.max_tokens,
+        cache_dir=args.cache_dir,
         train_file=args.train,
         dev_file=args.dev,
         ignore_unknowns=False,
@@ -173,8 +188,10 @@ def run_re_concat_qa(args):
 def run_re_qa(args):
     """Run the relation-extraction qa models using the question generator and
     the response generator explored with some search algorithm."""
-    if args.mode == "re_qa_train":
-        mode = "train"
+    if args.mode in ["re_qa_train", "re_qa_sample_bank"]:
+        mode = "train" if args.mode == "re_qa_train" else "sample_bank"
+        if mode == "sample_bank" and args.sample_bank is None:
+            raise ValueError("re_qa_sample_bank needs the --sample_bank directory.")
         config = HyperParameters(
             model_path=args.model_path,
             batch_size=args.batch_size,
@@ -190,6 +207,8 @@ def run_re_qa(args):
             question_checkpoint=args.question_checkpoint,
             num_search_samples=int(args.num_search_samples),
             seed=args.seed,
+            sample_bank=args.sample_bank,
+            pgg_refresh_steps=args.pgg_refresh_steps,
         )
         set_random_seed(config.seed)
         model = REQA(config)
@@ -206,12 +225,25 @@ def run_re_qa(args):
             batch_size=config.batch_size,
             source_max_length=config.source_max_length,
             decoder_max_length=config.decoder_max_length,
+            max_tokens=args.max_tokens,
+            cache_dir=args.cache_dir,
             train_file=args.train,
             dev_file=args.dev,
             ignore_unknowns=False,
             concat=False,
             gold_questions=False,
         )
+        if mode == "sample_bank":
+            model.build_sample_bank(
+                train_loaders, current_device=0, source_digest=file_digest(args.train)
+            )
+            return
+
+        if model.sample_bank is not None:
+            model.sample_bank.check(
+                num_examples=num_dataset_examples(train_dataset),
+                source_digest=file_digest(args.train),
+            )
         iterative_run_model(
             model,
             config=config,
@@ -247,6 +279,8 @@ def run_re_qa(args):
             batch_size=config.batch_size,
             source_max_length=config.source_max_length,
             decoder_max_length=config.decoder_max_length,
+            max_tokens=args.max_tokens,
+            cache_dir=args.cache_dir,
             dev_file=args.dev,
             ignore_unknowns=False,
             concat=False,
@@ -280,6 +314,11 @@ def run_fewrl(args):
     elif args.mode == 'reqa_mml_eval':
         mode = "test"
         for_fewrl = False
+    elif args.mode == "fewrl_sample_bank":
+        mode = "sample_bank"
+        for_fewrl = True
+        if args.sample_bank is None:
+            raise ValueError("fewrl_sample_bank needs the --sample_bank directory.")
 
     if args.mode == "multi_fewrl_dev":
         config = HyperParameters(
@@ -309,24 +348,36 @@ def run_fewrl(args):
                 batch_size=config.batch_size,
                 source_max_length=config.source_max_length,
                 decoder_max_length=config.decoder_max_length,
+                max_tokens=args.max_tokens,
+                cache_dir=args.cache_dir,
+                write_relation_data=args.write_relation_data == "True",
                 train_fewrel_path=args.dev,
                 shuffle=False,
                 for_fewrel_dataset=for_fewrl
         )
+        prediction_files = {}
         for ep in range(args.start_epoch, args.end_epoch+1, 1):
             for step in range(args.start_step, args.end_step + args.step_up, args.step_up):
                 prediction_file = args.model_path + "relation.supp_data.offmml-pgg.run.epoch.{}.dev.predictions.step.{}.csv".format(ep, step)
                 answer_checkpoint="_{}_answer_step_{}".format(ep, step)
                 question_checkpoint="_{}_question_step_{}".format(ep, step)
-                config.prediction_file = prediction_file
-                load_module(model.answer_model, model.model_path, answer_checkpoint)
-                load_module(model.question_model, model.model_path, question_checkpoint)
-                iterative_run_model(
-                    model,
-                    config=config,
-                    test_dataloader=loader,
-                    current_device=0,
-                )
+                prediction_files[(answer_checkpoint, question_checkpoint)] = prediction_file
+
+        def evaluate(names):
+            config.prediction_file = prediction_files[names]
+            iterative_run_model(
+                model,
+                config=config,
+                test_dataloader=loader,
+                current_device=0,
+            )
+
+        sweep_checkpoints(
+            [model.answer_model, model.question_model],
+            model.model_path,
+            list(prediction_files),
+            evaluate,
+        )
     else:
         config = HyperParameters(
             model_path=args.model_path,
@@ -344,11 +395,38 @@ def run_fewrl(args):
             num_search_samples=int(args.num_search_samples),
             seed=args.seed,
             predict_type=args.predict_type,
+            sample_bank=args.sample_bank,
+            pgg_refresh_steps=args.pgg_refresh_steps,
+            eval_steps=args.eval_steps,
+            keep_top_k=args.keep_top_k,
+            flat_checkpoints=args.checkpoint_format == "flat",
+            checkpoint_dtype=args.checkpoint_dtype,
+            delta_checkpoints=args.delta_checkpoints == "True",
         )
         set_random_seed(config.seed)
         model = REQA(config)
         model = model.to("cuda:0")
 
+        if args.mode == "fewrl_sample_bank":
+            (loader, dataset) = create_relation_qq_dataset(
+                question_tokenizer=model.question_tokenizer,
+                answer_tokenizer=model.answer_tokenizer,
+                batch_size=config.batch_size,
+                source_max_length=config.source_max_length,
+                decoder_max_length=config.decoder_max_length,
+                max_tokens=args.max_tokens,
+                cache_dir=args.cache_dir,
+                write_relation_data=args.write_relation_data == "True",
+                train_fewrel_path=args.train,
+                shuffle=False,
+                for_fewrel_dataset=for_fewrl
+            )
+            model.build_sample_bank(
+                loader,
+                current_device=0,
+                source_digest=file_digest(offmml_data_path(args.train)),
+            )
+
         if args.mode == "fewrl_train":
             (loader, dataset) = create_relation_qq_dataset(
                 question_tokenizer=model.question_tokenizer,
@@ -356,10 +434,37 @@ def run_fewrl(args):
                 batch_size=config.batch_size,
                 source_max_length=config.source_max_length,
                 decoder_max_length=config.decoder_max_length,
+                max_tokens=args.max_tokens,
+                cache_dir=args.cache_dir,
+                write_relation_data=args.write_relation_data == "True",
                 train_fewrel_path=args.train,
                 shuffle=True,
-                for_fewrel_dataset=for_fewrl
+                for_fewrel_dataset=for_fewrl,
+                shard_size=args.shard_size,
+                num_workers=args.num_workers,
             )
+            if model.sample_bank is not None:
+                model.sample_bank.check(
+                    num_examples=num_dataset_examples(dataset),
+                    source_digest=file_digest(offmml_data_path(args.train)),
+                )
+
+            dev_loader = None
+            dev_gold_ids = None
+            if args.eval_steps is not None:
+                (dev_loader, dev_dataset) = create_relation_qq_dataset(
+                    question_tokenizer=model.question_tokenizer,
+                    answer_tokenizer=model.answer_tokenizer,
+                    batch_size=config.batch_size,
+                    source_max_length=config.source_max_length,
+                    decoder_max_length=config.decoder_max_length,
+                    max_tokens=args.max_tokens,
+                    cache_dir=args.cache_dir,
+                    train_fewrel_path=args.dev,
+                    shuffle=False,
+                    for_fewrel_dataset=for_fewrl,
+                )
+                dev_gold_ids = read_relation_gold_ids(args.dev)
 
             iterative_run_model(
                 model,
@@ -369,6 +474,8 @@ def run_fewrl(args):
                 save_always=True,
                 current_device=0,
                 train_method=args.train_method,
+                dev_dataloader=dev_loader,
+                dev_gold_ids=dev_gold_ids,
             )
 
         if args.mode == "fewrl_dev":
@@ -378,6 +485,9 @@ def run_fewrl(args):
                 batch_size=config.batch_size,
                 source_max_length=config.source_max_length,
                 decoder_max_length=config.decoder_max_length,
+                max_tokens=args.max_tokens,
+                cache_dir=args.cache_dir,
+                write_relation_data=args.write_relation_data == "True",
                 train_fewrel_path=args.dev,
                 shuffle=False,
                 for_fewrel_dataset=for_fewrl
@@ -396,6 +506,9 @@ def run_fewrl(args):
                 batch_size=config.batch_size,
                 source_max_length=config.source_max_length,
                 decoder_max_length=config.decoder_max_length,
+                max_tokens=args.max_tokens,
+                cache_dir=args.cache_dir,
+                write_relation_data=args.write_relation_data == "True",
                 train_fewrel_path=args.test,
                 shuffle=False,
                 for_fewrel_dataset=for_fewrl
@@ -407,6 +520,188 @@ def run_fewrl(args):
                 current_device=0,
             )
 
+def checkpoint_sort_key(name):
+    """Order the checkpoint names by their epoch and step numbers."""
+    return [int(number) for number in re.findall(r"\d+", name)]
+
+
+def sweep_checkpoints(modules, model_path, checkpoints, evaluate):
+    """Evaluate the checkpoints in one process, swapping their weights into
+    the modules which are built only once.
+
+    Every checkpoint is a tuple with one checkpoint name per module, which
+    is passed to evaluate after loading. The next checkpoint is deserialized
+    in a background thread while the current one is evaluated.
+    """
+    paths = [[model_path + name for name in names] for names in checkpoints]
+    for names, weights in zip(checkpoints, prefetch_weights(paths)):
+        print("checkpoint {0}".format(" ".join(names)))
+        for module, state_dict in zip(modules, weights):
+            module.load_state_dict(state_dict)
+        evaluate(names)
+
+
+def run_sweep(args):
+    """Evaluate every checkpoint of the model_path matching checkpoint_glob
+    the way sweep_mode evaluates one checkpoint, loading the models and the
+    data only once.
+
+    The answer checkpoints of the REQA models are paired with the question
+    checkpoints of the same epoch and step. The relation predictions of
+    the T5QA checkpoints are scored sweep_group_size checkpoints at a
+    time.
+    """
+    reqa = args.sweep_mode == "fewrl_dev"
+    config = HyperParameters(
+        model_path=args.model_path,
+        batch_size=args.batch_size,
+        source_max_length=256,
+        decoder_max_length=32,
+        gpu=args.gpu,
+        learning_rate=args.learning_rate,
+        max_epochs=args.max_epochs,
+        mode="test",
+        checkpoint=None,
+        answer_checkpoint=None,
+        question_checkpoint=None,
+        training_steps=int(args.training_steps),
+        num_search_samples=int(args.num_search_samples),
+        seed=args.seed,
+        predict_type=args.predict_type,
+        model_name=MODEL_NAME,
+    )
+    set_random_seed(config.seed)
+
+    if reqa:
+        model = REQA(config)
+        model = model.to("cuda:0")
+        modules = [model.answer_model, model.question_model]
+        tokenizer = model.answer_tokenizer
+        checkpoint_glob = args.checkpoint_glob or "_*_answer_step_*"
+    else:
+        model = T5QA(config)
+        modules = [model.model]
+        tokenizer = model.tokenizer
+        checkpoint_glob = args.checkpoint_glob or "_*_step_*_model"
+
+    model_path = os.path.join(args.model_path, "model")
+    names = [
+        path[len(model_path) :]
+        for path in glob.glob(glob.escape(model_path) + checkpoint_glob)
+        if not path.endswith(".csv")
+    ]
+    checkpoints = []
+    for name in sorted(names, key=checkpoint_sort_key):
+        if not reqa:
+            checkpoints.append((name,))
+            continue
+        question_name = name.replace("_answer_", "_question_", 1)
+        if not os.path.exists(model_path + question_name):
+            print("no question checkpoint for {0}".format(name))
+            continue
+        checkpoints.append((name, question_name))
+
+    if args.sweep_mode == "fewrl_dev":
+        (loader, dataset) = create_relation_qq_dataset(
+            question_tokenizer=model.question_tokenizer,
+            answer_tokenizer=model.answer_tokenizer,
+            batch_size=config.batch_size,
+            source_max_length=config.source_max_length,
+            decoder_max_length=config.decoder_max_length,
+            max_tokens=args.max_tokens,
+            cache_dir=args.cache_dir,
+            train_fewrel_path=args.dev,
+            shuffle=False,
+            for_fewrel_dataset=True,
+        )
+    elif args.sweep_mode == "concat_fewrl_dev":
+        loader = create_fewrl_dataset(
+            question_tokenizer=tokenizer,
+            answer_tokenizer=tokenizer,
+            batch_size=config.batch_size,
+            source_max_length=config.source_max_length,
+            decoder_max_length=config.decoder_max_length,
+            max_tokens=args.max_tokens,
+            cache_dir=args.cache_dir,
+            train_fewrel_path=args.train,
+            dev_fewrel_path=args.dev,
+            test_fewrel_path=args.test,
+            concat=True,
+        )[1]
+    elif args.sweep_mode == "re_gold_qa_test":
+        loader = create_zero_re_qa_dataset(
+            question_tokenizer=tokenizer,
+            answer_tokenizer=tokenizer,
+            batch_size=config.batch_size,
+            source_max_length=config.source_max_length,
+            decoder_max_length=config.decoder_max_length,
+            max_tokens=args.max_tokens,
+            cache_dir=args.cache_dir,
+            train_file=args.train,
+            dev_file=args.dev,
+            ignore_unknowns=False,
+            concat=False,
+            gold_questions=True,
+            for_evaluation=True,
+        )[1]
+    elif args.sweep_mode == "re_classification_qa_train":
+        loader = create_zero_re_qa_gold_dataset(
+            question_tokenizer=tokenizer,
+            answer_tokenizer=tokenizer,
+            batch_size=config.batch_size,
+            source_max_length=config.source_max_length,
+            decoder_max_length=config.decoder_max_length,
+            max_tokens=args.max_tokens,
+            file=args.dev,
+            concat=args.concat == "True",
+            write_relation_data=args.write_relation_data == "True",
+        )[0]
+    else:
+        raise ValueError("unknown sweep mode: {0}".format(args.sweep_mode))
+
+    prediction_file = args.prediction_file or os.path.join(
+        args.model_path, "sweep{checkpoint}.predictions.csv"
+    )
+
+    group_size = args.sweep_group_size
+    if not reqa and config.predict_type == "relation" and group_size > 1:
+        # score groups of the checkpoints in one pass over the data.
+        groups = [
+            checkpoints[index : index + group_size]
+            for index in range(0, len(checkpoints), group_size)
+        ]
+        paths = [[model_path + names[0] for names in group] for group in groups]
+        for group, weights in zip(groups, prefetch_weights(paths)):
+            print("checkpoints {0}".format(" ".join(names[0] for names in group)))
+            run_multi_relation_predict(
+                model,
+                loader,
+                [model.checkpoint_parameters(state_dict) for state_dict in weights],
+                [prediction_file.format(checkpoint=names[0]) for names in group],
+            )
+        return
+
+    def evaluate(names):
+        config.prediction_file = prediction_file.format(checkpoint=names[0])
+        if reqa:
+            iterative_run_model(
+                model,
+                config=config,
+                test_dataloader=loader,
+                current_device=0,
+            )
+        else:
+            config.checkpoint = names[0]
+            run_model(
+                model,
+                config=config,
+                test_dataloader=loader,
+                save_always=True,
+            )
+
+    sweep_checkpoints(modules, model_path, checkpoints, evaluate)
+
+
 def run_multi_concat_fewrl_dev(args):
     """Run concat model on the fewrl dataset for multiple checkpoints."""
     mode = "test"
@@ -423,7 +718,7 @@ def run_multi_concat_fewrl_dev(args):
         seed=args.seed,
         predict_type=args.predict_type,
         model_name="t5-small",
-        checkpoint=args.checkpoint, # to avoid error otherwise it is not being used in this multi eval.
+        checkpoint=None,
     )
     set_random_seed(config.seed)
     model = T5QA(config)
@@ -441,26 +736,33 @@ def run_multi_concat_fewrl_dev(args):
         batch_size=config.batch_size,
         source_max_length=config.source_max_length,
         decoder_max_length=config.decoder_max_length,
+        max_tokens=args.max_tokens,
+        cache_dir=args.cache_dir,
         train_fewrel_path=args.train,
         dev_fewrel_path=args.dev,
         test_fewrel_path=args.test,
         concat=True
     )
 
+    prediction_files = {}
     for ep in range(args.start_epoch, args.end_epoch+1, 1):
         for step in range(args.start_step, args.end_step + args.step_up, args.step_up):
             prediction_file = args.model_path + "relation.concat.run.epoch.{}.dev.predictions.step.{}.csv".format(ep, step)
             checkpoint="_{}_step_{}_model".format(ep, step)
-            config.checkpoint = checkpoint
-            config.prediction_file = prediction_file
-            load_module(model.model, model.model_path, config.checkpoint)
-            run_model(
-                model,
-                config=config,
-                train_dataloader=train_loader,
-                test_dataloader=val_loader,
-                save_always=True,
-            )
+            prediction_files[(checkpoint,)] = prediction_file
+
+    def evaluate(names):
+        config.checkpoint = names[0]
+        config.prediction_file = prediction_files[names]
+        run_model(
+            model,
+            config=config,
+            train_dataloader=train_loader,
+            test_dataloader=val_loader,
+            save_always=True,
+        )
+
+    sweep_checkpoints([model.model], model.model_path, list(prediction_files), evaluate)
 
 
 def run_concat_fewrl(args):
@@ -485,7 +787,12 @@ def run_concat_fewrl(args):
         checkpoint=args.checkpoint,
         seed=args.seed,
         predict_type=args.predict_type,
-        model_name="t5-small"
+        model_name="t5-small",
+        eval_steps=args.eval_steps,
+        keep_top_k=args.keep_top_k,
+        flat_checkpoints=args.checkpoint_format == "flat",
+        checkpoint_dtype=args.checkpoint_dtype,
+        delta_checkpoints=args.delta_checkpoints == "True",
     )
 
     set_random_seed(config.seed)
@@ -506,6 +813,8 @@ def run_concat_fewrl(args):
         batch_size=config.batch_size,
         source_max_length=config.source_max_length,
         decoder_max_length=config.decoder_max_length,
+        max_tokens=args.max_tokens,
+        cache_dir=args.cache_dir,
         train_fewrel_path=args.train,
         dev_fewrel_path=args.dev,
         test_fewrel_path=args.test,
@@ -513,12 +822,17 @@ def run_concat_fewrl(args):
     )
 
     if args.mode == "concat_fewrl_train":
+        dev_gold_ids = None
+        if args.eval_steps is not None:
+            dev_gold_ids = read_relation_gold_ids(args.dev)
         run_model(
             model,
             config=config,
             train_dataloader=train_loader,
             test_dataloader=test_loader,
             save_always=True,
+            dev_dataloader=val_loader,
+            dev_gold_ids=dev_gold_ids,
         )
 
     if args.mode == "concat_fewrl_dev":
@@ -540,22 +854,85 @@ def run_concat_fewrl(args):
         )
 
 
+def run_verify_tokenizer(args):
+    """Check that the fast tokenizer encodes the prompts of the train file,
+    and their segments, token for token like the T5Tokenizer."""
+    tokenizer = T5Tokenizer.from_pretrained(MODEL_NAME)
+    encoder = TokenizerEncoder(tokenizer)
+    if encoder.fast_tokenizer is None:
+        print("No fast tokenizer for {0}.".format(MODEL_NAME))
+        return
+    if not encoder.use_fast:
+        print("The fast tokenizer differs on the parity probes.")
+
+    data = read_offmml_data(args.train, OFFMML_COLUMNS)
+    texts = {}
+    for column in OFFMML_COLUMNS:
+        for text in data[column]:
+            texts[str(text)] = None
+            for segment in SEGMENT_MARKERS.split(str(text)):
+                texts[segment] = None
+    mismatches = encoder.mismatches(list(texts))
+    print("{0} of {1} texts differ.".format(len(mismatches), len(texts)))
+    for text, ids, fast_ids in mismatches[:10]:
+        print(text)
+        print(ids)
+        print(fast_ids)
+
+
+def prepare_data(args):
+    """Prepare the train, dev and test files of the seed split of the raw
+    fewrel or wikizsl file, reusing the files cached in cache_dir.
+
+    With raw_data_seeds, the splits of all those seeds are prepared
+    together, reading the raw file once.
+    """
+    seeds = None
+    if args.raw_data_seeds is not None:
+        seeds = [int(seed) for seed in args.raw_data_seeds.split(",")]
+    if args.raw_data_format == "fewrel":
+        return prepare_fewrl_data(
+            args.cache_dir,
+            args.raw_data,
+            args.seed,
+            m=args.num_unseen_relations,
+            sample_dev=args.sample_dev == "True",
+            seeds=seeds,
+        )
+    elif args.raw_data_format == "wikizsl":
+        return prepare_wikizsl_data(
+            args.cache_dir,
+            args.raw_data,
+            args.seed,
+            m=args.num_unseen_relations,
+            sample_dev=args.sample_dev == "True",
+            seeds=seeds,
+        )
+    raise ValueError("unknown raw data format: {0}".format(args.raw_data_format))
+
+
 def run_main(args):
     """Decides what to do in the code."""
+    if args.raw_data is not None:
+        args.train, args.dev, args.test = prepare_data(args)
     if args.mode in ["re_gold_qa_train", "re_gold_qa_test"]:
         run_re_gold_qa(args)
     if args.mode in ["re_classification_qa_train"]:
         run_relation_classification_qa(args)
     if args.mode in ["re_concat_qa_train", "re_concat_qa_test"]:
         run_re_concat_qa(args)
-    if args.mode in ["re_qa_train", "re_qa_test"]:
+    if args.mode in ["re_qa_train", "re_qa_test", "re_qa_sample_bank"]:
         run_re_qa(args)
-    if args.mode in ["multi_fewrl_dev", "reqa_mml_eval", "fewrl_train", "fewrl_test", "fewrl_dev"]:
+    if args.mode in ["multi_fewrl_dev", "reqa_mml_eval", "fewrl_train", "fewrl_test", "fewrl_dev", "fewrl_sample_bank"]:
         run_fewrl(args)
     if args.mode in ["concat_fewrl_train", "concat_fewrl_test", "concat_fewrl_dev"]:
         run_concat_fewrl(args)
     if args.mode in ["multi_concat_fewrl_dev"]:
         run_multi_concat_fewrl_dev(args)
+    if args.mode in ["verify_tokenizer"]:
+        run_verify_tokenizer(args)
+    if args.mode in ["sweep"]:
+        run_sweep(args)
 
 
 def argument_parser():
@@ -565,7 +942,7 @@ def argument_parser():
         "--mode",
         type=str,
         required=True,
-        help="re_gold_qa_train | re_gold_qa_test | re_concat_qa_train | re_concat_qa_test | re_qa_train | re_qa_test",
+        help="re_gold_qa_train | re_gold_qa_test | re_concat_qa_train | re_concat_qa_test | re_qa_train | re_qa_test | re_qa_sample_bank | sweep",
     )
     parser.add_argument(
         "--concat",
@@ -592,7 +969,9 @@ def argument_parser():
     parser.add_argument("--test", type=str, help="file for test data.")
 
     parser.add_argument(
-        "--prediction_file", type=str, help="file for saving predictions"
+        "--prediction_file",
+        type=str,
+        help="file for saving predictions, formatted with {checkpoint} in the sweep mode.",
     )
 
     parser.add_argument("--input_file_name", type=str, help="input file name")
@@ -664,6 +1043,110 @@ def argument_parser():
         type=str,
         help="What is the prediction type for the fewrel run.",
     )
+    parser.add_argument(
+        "--sample_bank",
+        type=str,
+        help="directory of the offline off-policy question samples.",
+    )
+    parser.add_argument(
+        "--pgg_refresh_steps",
+        type=int,
+        default=100,
+        help="regenerate the cached questions of the off-policy PGG answer updates after this many steps.",
+    )
+    parser.add_argument(
+        "--max_tokens",
+        type=int,
+        help="source token budget of the length-bucketed batches, instead of batch_size.",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        help="directory of the cached tokenized datasets.",
+    )
+    parser.add_argument(
+        "--write_relation_data",
+        type=str,
+        default="False",
+        help="write the sentence and relation pairs to the .relation_data.csv file.",
+    )
+    parser.add_argument(
+        "--shard_size",
+        type=int,
+        help="stream the fewrl train data from shards of this many examples, kept in the cache_dir.",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=0,
+        help="number of the data loader workers reading the shards.",
+    )
+    parser.add_argument(
+        "--raw_data",
+        type=str,
+        help="raw fewrel or wikizsl file to prepare the train, dev and test files from.",
+    )
+    parser.add_argument(
+        "--raw_data_seeds",
+        type=str,
+        help="comma separated seeds whose splits of the raw_data are prepared together, e.g. 12321,943,111.",
+    )
+    parser.add_argument(
+        "--raw_data_format",
+        type=str,
+        default="fewrel",
+        help="fewrel | wikizsl",
+    )
+    parser.add_argument(
+        "--sample_dev",
+        type=str,
+        default="False",
+        help="use the sampled rows of the prepared dev file.",
+    )
+    parser.add_argument(
+        "--eval_steps",
+        type=int,
+        help="score the relations of the dev data every eval_steps training steps.",
+    )
+    parser.add_argument(
+        "--keep_top_k",
+        type=int,
+        help="only keep the k checkpoints with the best dev f1 of the eval_steps scoring.",
+    )
+    parser.add_argument(
+        "--checkpoint_format",
+        type=str,
+        default="torch",
+        help="torch | flat, the flat checkpoints are memory mapped when loaded.",
+    )
+    parser.add_argument(
+        "--checkpoint_dtype",
+        type=str,
+        help="float16 | bfloat16, the dtype of the floating point weights in the flat checkpoints.",
+    )
+    parser.add_argument(
+        "--delta_checkpoints",
+        type=str,
+        default="False",
+        help="store the flat checkpoints as the difference to the pretrained model.",
+    )
+    parser.add_argument(
+        "--sweep_mode",
+        type=str,
+        default="concat_fewrl_dev",
+        help="concat_fewrl_dev | re_gold_qa_test | re_classification_qa_train | fewrl_dev",
+    )
+    parser.add_argument(
+        "--sweep_group_size",
+        type=int,
+        default=1,
+        help="number of the checkpoints scored together in one pass over the data for the relation predictions.",
+    )
+    parser.add_argument(
+        "--checkpoint_glob",
+        type=str,
+        help="glob of the checkpoint names in the model_path to sweep over.",
+    )
     args, _ = parser.parse_known_args()
     return args
 
@@ -1,16 +1,22 @@
 """Implementation of the T5 Models for Response Generation and Question
 Generation Used for relation extraction."""
 
+import functools
 import gc
+import json
 import math
 import os
 import random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from typing import Any, Optional
 
 import numpy
 import torch
-from transformers import Adafactor, T5ForConditionalGeneration, T5Tokenizer
+from transformers import (Adafactor, LogitsProcessor, LogitsProcessorList,
+                          T5ForConditionalGeneration, T5Tokenizer,
+                          TopKLogitsWarper, TopPLogitsWarper)
 
 
 def white_space_fix(text):
@@ -47,31 +53,203 @@ class HyperParameters:
     num_neg_samples: Optional[int] = 3
     model_name: str = "MODEL_NAME"
 
+    # Path to the offline samples of the init question model.
+    sample_bank: Optional[str] = None
+
+    # Regenerate the cached PGG question of an example for the off-policy
+    # answer updates once it is older than pgg_refresh_steps training steps.
+    pgg_refresh_steps: int = 100
+
+    # Score the dev data every eval_steps training steps, and only keep the
+    # keep_top_k checkpoints with the best dev f1 on disk.
+    eval_steps: Optional[int] = None
+    keep_top_k: Optional[int] = None
+
+    # Write the checkpoints in the flat memory mapped layout, optionally as
+    # checkpoint_dtype and as the delta to the pretrained model.
+    flat_checkpoints: bool = False
+    checkpoint_dtype: Optional[str] = None
+    delta_checkpoints: bool = False
+
 
 def tuple_of_tensors_to_tensor(tuple_of_tensors):
     return torch.stack(list(tuple_of_tensors), dim=0)
 
 
-def prepare_response_module_input(
-    answer_input_ids=None,
-    answer_input_mask=None,
-    labels=None,
-    target_mask=None,
-    num_samples=1,
+def expand_samples(tensor, num_samples):
+    """Repeat every row of the tensor num_samples times next to each other,
+    similar to tensor.repeat(1, num_samples).view(-1, ...)."""
+    if num_samples == 1:
+        return tensor
+    b_sz = tensor.size(0)
+    return (
+        tensor.unsqueeze(1)
+        .expand(b_sz, num_samples, *tensor.size()[1:])
+        .reshape(b_sz * num_samples, *tensor.size()[1:])
+    )
+
+
+# Number of vocabulary entries scored at once when computing the log
+# probability of the target tokens.
+VOCAB_CHUNK_SIZE = 4096
+
+
+class ChunkedTokenLogP(torch.autograd.Function):
+    """Log probability of the label tokens given the final decoder hidden
+    states and the output embedding, computed over chunks of the
+    vocabulary.
+
+    Only one b x l x chunk_size block of the logits exists at any time,
+    both in the forward and in the backward pass. Labels equal to -100
+    get a log probability of zero.
+    """
+
+    @staticmethod
+    def forward(ctx, hidden_states, weight, labels, chunk_size):
+        v = weight.size(0)
+        lse_chunks = []
+        label_logits = torch.zeros(
+            labels.size(), dtype=hidden_states.dtype, device=hidden_states.device
+        )
+        for start in range(0, v, chunk_size):
+            chunk_weight = weight[start : start + chunk_size]
+            logits = torch.matmul(hidden_states, chunk_weight.t())
+            lse_chunks.append(torch.logsumexp(logits, dim=-1))
+            in_chunk = (labels >= start) & (labels < start + chunk_weight.size(0))
+            chunk_labels = (labels - start).clamp(0, chunk_weight.size(0) - 1)
+            label_logits += (
+                logits.gather(-1, chunk_labels.unsqueeze(-1))
+                .squeeze(-1)
+                .masked_fill(~in_chunk, 0.0)
+            )
+
+        lse = torch.logsumexp(torch.stack(lse_chunks, dim=-1), dim=-1)
+        ctx.save_for_backward(hidden_states, weight, labels, lse)
+        ctx.chunk_size = chunk_size
+        return (label_logits - lse).masked_fill(labels == -100, 0.0)
+
+    @staticmethod
+    def backward(ctx, grad_log_p):
+        hidden_states, weight, labels, lse = ctx.saved_tensors
+        chunk_size = ctx.chunk_size
+        grad_log_p = grad_log_p.masked_fill(labels == -100, 0.0)
+        grad_hidden = None
+        grad_weight = None
+        if ctx.needs_input_grad[0]:
+            grad_hidden = torch.zeros_like(hidden_states)
+        if ctx.needs_input_grad[1]:
+            grad_weight = torch.zeros_like(weight)
+
+        h_dim = hidden_states.size(-1)
+        for start in range(0, weight.size(0), chunk_size):
+            chunk_weight = weight[start : start + chunk_size]
+            logits = torch.matmul(hidden_states, chunk_weight.t())
+
+            # d log_p / d logits = onehot(label) - softmax(logits)
+            grad_logits = -grad_log_p.unsqueeze(-1) * torch.exp(
+                logits - lse.unsqueeze(-1)
+            )
+            in_chunk = (labels >= start) & (labels < start + chunk_weight.size(0))
+            chunk_labels = (labels - start).clamp(0, chunk_weight.size(0) - 1)
+            grad_logits.scatter_add_(
+                -1,
+                chunk_labels.unsqueeze(-1),
+                grad_log_p.masked_fill(~in_chunk, 0.0).unsqueeze(-1),
+            )
+            if grad_hidden is not None:
+                grad_hidden += torch.matmul(grad_logits, chunk_weight)
+            if grad_weight is not None:
+                grad_weight[start : start + chunk_size] = torch.matmul(
+                    grad_logits.reshape(-1, grad_logits.size(-1)).t(),
+                    hidden_states.reshape(-1, h_dim),
+                )
+
+        return grad_hidden, grad_weight, None, None
+
+
+def sequence_log_p(
+    model,
+    labels,
+    target_mask,
+    input_mask,
+    input_ids=None,
+    encoder_hidden_states=None,
+    chunk_size=VOCAB_CHUNK_SIZE,
 ):
-    """Repeat the labels and the target_mask num_samples times in dimension
-    1."""
-    b_sz, dec_seq_len = labels.size()
-    _, src_seq_len = answer_input_ids.size()
-    labels = labels.repeat(1, num_samples).view(-1, dec_seq_len)
-    target_mask = target_mask.repeat(1, num_samples).view(-1, dec_seq_len)
+    """Compute the log probability of every label sequence (-100 is ignored)
+    under the T5 model without creating the b x l x v logits.
 
-    return (
-        answer_input_ids,
-        answer_input_mask,
-        target_mask,
+    The encoder is run on the input_ids unless its hidden states are
+    given.
+    """
+    if encoder_hidden_states is None:
+        encoder_hidden_states = model.encoder(
+            input_ids=input_ids, attention_mask=input_mask, return_dict=True
+        ).last_hidden_state
+
+    decoder_outputs = model.decoder(
+        input_ids=model._shift_right(labels),
+        attention_mask=target_mask,
+        encoder_hidden_states=encoder_hidden_states,
+        encoder_attention_mask=input_mask,
+        use_cache=False,
+        return_dict=True,
+    )
+    hidden_states = decoder_outputs.last_hidden_state
+
+    # the same rescaling done by T5ForConditionalGeneration before the lm_head.
+    if getattr(
+        model.config, "scale_decoder_outputs", model.config.tie_word_embeddings
+    ):
+        hidden_states = hidden_states * (model.model_dim**-0.5)
+
+    log_p = ChunkedTokenLogP.apply(
+        hidden_states, model.lm_head.weight, labels, chunk_size
+    )
+    return torch.sum(log_p, dim=1)
+
+
+def shared_encoder_log_p(
+    model, input_ids, input_mask, labels, target_mask, example_ids
+):
+    """Run the encoder of the T5 model once for every source and compute the
+    log probability of the target sequences, where example_ids gives the
+    source of every target sequence.
+
+    The gradients of all the decoder passes are accumulated in the
+    single encoder pass.
+    """
+    encoder_outputs = model.encoder(
+        input_ids=input_ids, attention_mask=input_mask, return_dict=True
+    )
+    return sequence_log_p(
+        model,
         labels,
+        target_mask,
+        input_mask.index_select(0, example_ids),
+        encoder_hidden_states=encoder_outputs.last_hidden_state.index_select(
+            0, example_ids
+        ),
+    )
+
+
+def unique_samples(sequences, num_samples):
+    """Find the unique sampled sequences of every example, where the
+    num_samples sequences of each example are next to each other.
+
+    Returns the unique sequences, the example index of every unique
+    sequence and the index of the unique sequence for every input
+    sequence.
+    """
+    n, _ = sequences.size()
+    example_ids = torch.arange(
+        n // num_samples, device=sequences.device
+    ).repeat_interleave(num_samples)
+    keyed_sequences = torch.cat((example_ids.unsqueeze(1), sequences), dim=1)
+    unique_keyed_sequences, inverse = torch.unique(
+        keyed_sequences, dim=0, return_inverse=True
     )
+    return unique_keyed_sequences[:, 1:], unique_keyed_sequences[:, 0], inverse
 
 
 def set_random_seed(seed: int):
@@ -96,20 +274,265 @@ def remove_prefix(text, prefix):
     return text  # or whatever
 
 
-def torch_save(model: torch.nn.Module, path: str):
-    """Save the model at the specified path."""
+# The first bytes of the flat checkpoints, the torch.save files start with "PK".
+FLAT_CHECKPOINT_MAGIC = b"FLATCKPT"
+
+# The header and the tensors of the flat checkpoints are aligned to this
+# many bytes.
+FLAT_CHECKPOINT_ALIGNMENT = 64
+
+
+def align_offset(offset):
+    """Round the offset up to the FLAT_CHECKPOINT_ALIGNMENT."""
+    return -(-offset // FLAT_CHECKPOINT_ALIGNMENT) * FLAT_CHECKPOINT_ALIGNMENT
+
+
+@functools.lru_cache(maxsize=None)
+def pretrained_weights(model_name):
+    """The state dict of the pretrained T5 model, the base of the delta
+    checkpoints."""
+    return T5ForConditionalGeneration.from_pretrained(model_name).state_dict()
+
+
+def tensor_bytes(tensor):
+    """The bytes of the tensor as a flat uint8 numpy array; numpy has no
+    bfloat16, which is viewed as int16."""
+    tensor = tensor.detach().cpu().contiguous().reshape(-1)
+    if tensor.dtype == torch.bfloat16:
+        tensor = tensor.view(torch.int16)
+    return tensor.numpy().view(numpy.uint8)
+
+
+def write_flat_checkpoint(state_dict, path, dtype=None, base=None):
+    """Write the state dict as a flat checkpoint which is memory mapped by
+    read_flat_checkpoint.
+
+    The file holds the magic bytes, the length of the json header, the
+    header and then the bytes of every tensor. The floating point tensors
+    are stored as dtype, and as their difference to the pretrained_weights
+    of the base model when it is given. The tensors shared by several keys
+    are stored once.
+    """
+    base_weights = pretrained_weights(base) if base is not None else {}
+    entries = {}
+    blobs = []
+    stored = {}
+    offset = 0
+    for key, value in state_dict.items():
+        key = remove_prefix(key, "module.")
+        tensor_key = (value.data_ptr(), value.dtype, tuple(value.shape))
+        if tensor_key in stored:
+            entries[key] = {"alias": stored[tensor_key]}
+            continue
+        stored[tensor_key] = key
+
+        delta = False
+        if value.is_floating_point():
+            base_value = base_weights.get(key)
+            if base_value is not None and base_value.shape == value.shape:
+                value = value.float() - base_value.float()
+                delta = True
+            if dtype is not None:
+                value = value.to(getattr(torch, dtype))
+        blob = tensor_bytes(value)
+        offset = align_offset(offset)
+        entries[key] = {
+            "dtype": str(value.dtype).replace("torch.", ""),
+            "shape": list(value.shape),
+            "offset": offset,
+            "delta": delta,
+        }
+        blobs.append((offset, blob))
+        offset += blob.nbytes
+
+    header = json.dumps({"base": base, "tensors": entries}).encode("utf-8")
+    header_start = len(FLAT_CHECKPOINT_MAGIC) + 8
+    data_start = align_offset(header_start + len(header))
+    with open(path, "wb") as checkpoint_file:
+        checkpoint_file.write(FLAT_CHECKPOINT_MAGIC)
+        checkpoint_file.write(len(header).to_bytes(8, "little"))
+        checkpoint_file.write(header)
+        for blob_offset, blob in blobs:
+            checkpoint_file.seek(data_start + blob_offset)
+            checkpoint_file.write(blob)
+        checkpoint_file.truncate(data_start + offset)
+
+
+def read_flat_checkpoint(path):
+    """Read the state dict of the flat checkpoint, whose tensors are views
+    of the memory mapped file.
+
+    Only the delta tensors are copied, when they are added to the
+    pretrained_weights of their base.
+    """
+    data = numpy.memmap(path, dtype=numpy.uint8, mode="c")
+    header_start = len(FLAT_CHECKPOINT_MAGIC) + 8
+    header_length = int.from_bytes(
+        bytes(data[len(FLAT_CHECKPOINT_MAGIC) : header_start]), "little"
+    )
+    header = json.loads(
+        bytes(data[header_start : header_start + header_length]).decode("utf-8")
+    )
+    data_start = align_offset(header_start + header_length)
+    base_weights = {}
+    if header["base"] is not None:
+        base_weights = pretrained_weights(header["base"])
+
+    weights = {}
+    for key, entry in header["tensors"].items():
+        if "alias" in entry:
+            weights[key] = weights[entry["alias"]]
+            continue
+        dtype = entry["dtype"]
+        array = numpy.frombuffer(
+            data,
+            dtype=numpy.int16 if dtype == "bfloat16" else numpy.dtype(dtype),
+            count=int(numpy.prod(entry["shape"])),
+            offset=data_start + entry["offset"],
+        )
+        tensor = torch.from_numpy(array.reshape(entry["shape"]))
+        if dtype == "bfloat16":
+            tensor = tensor.view(torch.bfloat16)
+        if entry["delta"]:
+            tensor = base_weights[key] + tensor
+        weights[key] = tensor
+    return weights
+
+
+class CheckpointWriter(object):
+    """Write the checkpoints on a background thread, so the training steps
+    do not wait on the disk.
+
+    The state dict is copied to the cpu before save returns, then written
+    to a temporary file which is renamed to the checkpoint path. At most
+    max_pending snapshots are held in memory, save waits for the oldest
+    one beyond that.
+
+    With flat, the checkpoints are written by write_flat_checkpoint with
+    the dtype and the base model.
+    """
+
+    def __init__(self, max_pending=2, flat=False, dtype=None, base=None):
+        self.max_pending = max_pending
+        self.flat = flat
+        self.dtype = dtype
+        self.base = base
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = deque()
+
+    def submit(self, function, *args):
+        """Run the function on the writer thread after the pending writes,
+        raising the errors of the finished ones."""
+        while self.pending and (
+            self.pending[0].done() or len(self.pending) >= self.max_pending
+        ):
+            self.pending.popleft().result()
+        self.pending.append(self.executor.submit(function, *args))
+
+    def save(self, model: torch.nn.Module, path: str):
+        """Snapshot the state dict of the model and write it to path."""
+        # the tied weights share one copy, so torch.save still writes them once.
+        copies = {}
+        state_dict = {}
+        for key, value in model.state_dict().items():
+            tensor_key = (value.data_ptr(), value.dtype, tuple(value.shape))
+            if tensor_key not in copies:
+                copies[tensor_key] = value.detach().to("cpu", copy=True)
+            state_dict[key] = copies[tensor_key]
+
+        def write():
+            if self.flat:
+                write_flat_checkpoint(
+                    state_dict, path + ".tmp", dtype=self.dtype, base=self.base
+                )
+            else:
+                torch.save(state_dict, path + ".tmp")
+            os.replace(path + ".tmp", path)
+
+        self.submit(write)
+
+    def remove(self, path: str):
+        """Remove the checkpoint file once its pending write is done."""
+        self.submit(os.remove, path)
+
+    def wait(self):
+        """Wait for all the pending writes."""
+        while self.pending:
+            self.pending.popleft().result()
+
+
+def torch_save(model: torch.nn.Module, path: str, writer=None):
+    """Save the model at the specified path, in the background with a
+    CheckpointWriter."""
+    if writer is not None:
+        writer.save(model, path)
+        return
     torch.save(model.state_dict(), path)
 
 
-def save(model, model_path: str, checkpoint_name: str):
+def save(model, model_path: str, checkpoint_name: str, writer=None):
     """Save the model to the specified path name using a checkpoint name."""
-    torch_save(model, model_path + "_" + checkpoint_name)
+    torch_save(model, model_path + "_" + checkpoint_name, writer=writer)
 
 
-def load_module(model, model_path, checkpoint_name):
-    """Load the model from the checkpoint."""
+class TopCheckpoints(object):
+    """Keep the k checkpoints with the best dev scores on disk and remove the
+    others.
+
+    The kept checkpoints and their scores are listed in
+    top_checkpoints.json next to the model files. With a CheckpointWriter,
+    the files are removed after their pending writes.
+    """
+
+    def __init__(self, model_path, k, writer=None):
+        self.model_path = model_path
+        self.k = k
+        self.writer = writer
+        self.checkpoints = []
+
+    def add(self, score, checkpoint_names, save_checkpoint):
+        """Save the checkpoint with save_checkpoint if its score is in the top
+        k, and remove the files of the checkpoint which drops out.
+
+        checkpoint_names are the names of the files written by
+        save_checkpoint, relative to the model_path.
+        """
+        if len(self.checkpoints) >= self.k and score <= self.checkpoints[-1][0]:
+            return False
+        save_checkpoint()
+        self.checkpoints.append((score, checkpoint_names))
+        self.checkpoints.sort(key=lambda checkpoint: -checkpoint[0])
+        for _, names in self.checkpoints[self.k :]:
+            for name in names:
+                if self.writer is not None:
+                    self.writer.remove(self.model_path + name)
+                else:
+                    os.remove(self.model_path + name)
+        del self.checkpoints[self.k :]
+
+        path = os.path.join(os.path.dirname(self.model_path), "top_checkpoints.json")
+        with open(path, "w") as json_file:
+            json.dump(
+                [
+                    {"score": score, "checkpoints": names}
+                    for score, names in self.checkpoints
+                ],
+                json_file,
+                indent=2,
+            )
+        return True
+
+
+def load_weights(checkpoint_path):
+    """Load the state dict of the checkpoint file on the cpu, the flat
+    checkpoints are memory mapped."""
+    with open(checkpoint_path, "rb") as checkpoint_file:
+        magic = checkpoint_file.read(len(FLAT_CHECKPOINT_MAGIC))
+    if magic == FLAT_CHECKPOINT_MAGIC:
+        return read_flat_checkpoint(checkpoint_path)
+
     loaded_weights = torch.load(
-        model_path + checkpoint_name,
+        checkpoint_path,
         map_location=lambda storage, loc: storage,
     )
 
@@ -117,7 +540,34 @@ def load_module(model, model_path, checkpoint_name):
     new_weights = {}
     for key, val in loaded_weights.items():
         new_weights[remove_prefix(key, "module.")] = val
-    model.load_state_dict(new_weights)
+    return new_weights
+
+
+def load_module(model, model_path, checkpoint_name):
+    """Load the model from the checkpoint."""
+    model.load_state_dict(load_weights(model_path + checkpoint_name))
+
+
+def prefetch_weights(checkpoint_paths):
+    """Yield the list of the state dicts of the checkpoint files for every
+    item of checkpoint_paths.
+
+    A background thread deserializes the files of the next item while
+    the caller uses the current one.
+    """
+
+    def load_all(paths):
+        return [load_weights(path) for path in paths]
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = None
+        if checkpoint_paths:
+            future = executor.submit(load_all, checkpoint_paths[0])
+        for index in range(len(checkpoint_paths)):
+            weights = future.result()
+            if index + 1 < len(checkpoint_paths):
+                future = executor.submit(load_all, checkpoint_paths[index + 1])
+            yield weights
 
 
 def clear_cache():
@@ -127,28 +577,258 @@ def clear_cache():
     gc.collect()
 
 
-def prob_of_sampled_predictions(loss_fct, sample_outputs):
-    """Helper function to compute the predictions and the probability of a
-    sampled sequence from the output of the generate function in the
-    transformers library."""
+class SampledLogProbs(LogitsProcessor):
+    """Warp the scores of the sampling steps with top-k and top-p, and sum
+    the log probabilities of the sampled tokens under the warped
+    distributions.
+
+    Only the log softmax of the previous step is kept: the token sampled
+    from it is the last token of the input_ids in the next step, and
+    finish() adds the token of the last step.
+    """
+
+    def __init__(self, top_k=None, top_p=1.0, pad_token_id=0):
+        self.warpers = LogitsProcessorList()
+        if top_k:
+            self.warpers.append(TopKLogitsWarper(top_k))
+        if top_p < 1.0:
+            self.warpers.append(TopPLogitsWarper(top_p))
+        self.pad_token_id = pad_token_id
+        self.step_log_probs = None
+        self.log_p = None
+
+    def add_tokens(self, tokens):
+        if self.step_log_probs is None:
+            return
+        token_log_p = self.step_log_probs.gather(1, tokens.unsqueeze(1)).squeeze(1)
+        token_log_p = token_log_p.masked_fill(tokens == self.pad_token_id, 0.0)
+        self.log_p = token_log_p if self.log_p is None else self.log_p + token_log_p
+
+    def __call__(self, input_ids, scores):
+        self.add_tokens(input_ids[:, -1])
+        scores = self.warpers(input_ids, scores)
+        self.step_log_probs = torch.log_softmax(scores, dim=-1)
+        return scores
+
+    def finish(self, sequences):
+        """Return the log probabilities of the generated sequences."""
+        self.add_tokens(sequences[:, -1])
+        self.step_log_probs = None
+        return self.log_p
+
+
+def splice_input_ids(segments_list, max_length, pad_token_id=0):
+    """Concatenate the token id segments of every example, then truncate
+    them to max_length and pad them to the longest row.
+
+    This gives the same ids and attention mask as calling the tokenizer
+    on the joined strings with truncation=True and padding=True.
+    """
+    rows = [
+        [token for segment in segments for token in segment][:max_length]
+        for segments in segments_list
+    ]
+    width = max([len(ids) for ids in rows], default=0)
+    input_ids = torch.full((len(rows), width), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(rows), width), dtype=torch.long)
+    for i, ids in enumerate(rows):
+        input_ids[i, : len(ids)] = torch.tensor(ids, dtype=torch.long)
+        attention_mask[i, : len(ids)] = 1
+    return input_ids, attention_mask
+
+
+def mask_pad_labels(labels, pad_token_id):
+    """Replace the pad tokens of the labels, a torch tensor or a numpy
+    array, by -100 so the loss ignores them.
+
+    HuggingFace shifts the labels to build the decoder inputs, so the
+    labels are exactly the padded target ids with the pads masked out.
+    """
+    if torch.is_tensor(labels):
+        return labels.masked_fill(labels == pad_token_id, -100)
+    return numpy.where(labels == pad_token_id, -100, labels)
+
+
+def question_labels_from_ids(question_ids, max_length, pad_token_id=0, eos_token_id=1):
+    """Build the decoder labels and the target mask from the generated token
+    ids (without the decoder start token).
+
+    An eos token is appended to the sequences which were cut by the
+    max_length of the generate function, and pad tokens become -100.
+    """
+    b_sz, seq_len = question_ids.size()
+    labels = torch.full(
+        (b_sz, max_length), pad_token_id, dtype=torch.long, device=question_ids.device
+    )
+    seq_len = min(seq_len, max_length)
+    labels[:, :seq_len] = question_ids[:, :seq_len]
+    lengths = (labels != pad_token_id).sum(dim=1).clamp(max=max_length - 1)
+    no_eos = ~(labels == eos_token_id).any(dim=1)
+    labels[no_eos, lengths[no_eos]] = eos_token_id
+    target_mask = (labels != pad_token_id).long()
+    return mask_pad_labels(labels, pad_token_id), target_mask
+
+
+class QuestionSampleBank(object):
+    """Memory-mapped questions sampled offline from the frozen init question
+    model and their log probabilities, keyed by the example index.
+
+    meta.json records how the bank was built: the number of examples,
+    the num_samples and max_length of the samples, and the digest of the
+    source data file, which check compares to the training run. It is
+    written by flush once the bank is complete.
+    """
+
+    def __init__(
+        self,
+        path,
+        mode="r",
+        num_examples=None,
+        num_samples=None,
+        max_length=None,
+        source_digest=None,
+    ):
+        self.path = path
+        questions_path = os.path.join(path, "questions.npy")
+        log_ps_path = os.path.join(path, "log_ps.npy")
+        meta_path = os.path.join(path, "meta.json")
+        if mode == "w":
+            if not os.path.exists(path):
+                os.makedirs(path)
+
+            # the t5 vocabulary fits in uint16.
+            self.questions = numpy.lib.format.open_memmap(
+                questions_path,
+                mode="w+",
+                dtype=numpy.uint16,
+                shape=(num_examples, num_samples, max_length),
+            )
+            self.log_ps = numpy.lib.format.open_memmap(
+                log_ps_path,
+                mode="w+",
+                dtype=numpy.float32,
+                shape=(num_examples, num_samples),
+            )
+            self.meta = {
+                "num_examples": num_examples,
+                "num_samples": num_samples,
+                "max_length": max_length,
+                "source_digest": source_digest,
+            }
+        else:
+            if not os.path.exists(meta_path):
+                raise ValueError(
+                    "the sample bank {0} has no meta.json, "
+                    "build it again.".format(path)
+                )
+            with open(meta_path, "r") as fd:
+                self.meta = json.load(fd)
+            self.questions = numpy.load(questions_path, mmap_mode="r")
+            self.log_ps = numpy.load(log_ps_path, mmap_mode="r")
+
+    def check(self, **expected):
+        """Raise a ValueError if the bank was built with other values of the
+        meta.json keys than the expected ones, which are skipped when
+        None."""
+        mismatches = [
+            "{0} is {1} instead of {2}".format(key, self.meta.get(key), value)
+            for key, value in expected.items()
+            if value is not None and self.meta.get(key) != value
+        ]
+        if mismatches:
+            raise ValueError(
+                "the sample bank {0} was built for other data: {1}.".format(
+                    self.path, ", ".join(mismatches)
+                )
+            )
 
-    # Skip the first pad token generated by the T5 model.
-    sampled_predictions = sample_outputs.sequences[:, 1:]
-    sampled_scores = sample_outputs.scores
-    sampled_scores = tuple_of_tensors_to_tensor(sampled_scores)
+    def write(self, example_index, sampled_questions, log_ps):
+        """Store the samples of the examples, the num_samples sampled questions
+        of every example are next to each other."""
+        example_index = example_index.cpu().numpy()
+        _, num_samples, max_length = self.questions.shape
+        sampled_questions = sampled_questions.cpu().numpy()[:, :max_length]
+        questions = numpy.zeros(
+            (len(example_index) * num_samples, max_length), dtype=numpy.uint16
+        )
+        questions[:, : sampled_questions.shape[1]] = sampled_questions
+        self.questions[example_index] = questions.reshape(-1, num_samples, max_length)
+        self.log_ps[example_index] = (
+            log_ps.cpu().numpy().reshape(-1, num_samples).astype(numpy.float32)
+        )
 
-    # v: vocab size
-    # n: batch_size * num_samples
-    # l: sequence len
-    l, n, v = sampled_scores.size()
-    log_p = -loss_fct(
-        sampled_scores.view(-1, v),
-        torch.reshape(torch.transpose(sampled_predictions, 0, 1), (l * n,)),
-    ).view(l, n)
-    pad_mask = torch.transpose(sampled_predictions, 0, 1) == 0
-    good_log_p = log_p.masked_fill_(pad_mask, 0.0)
-    log_p = torch.sum(good_log_p, dim=0).squeeze()
-    return sampled_predictions, log_p
+    def read(self, example_index):
+        """Return the sampled questions and their log probabilities for the
+        examples."""
+        example_index = example_index.cpu().numpy()
+        _, _, max_length = self.questions.shape
+        sampled_questions = torch.from_numpy(
+            self.questions[example_index].astype(numpy.int64)
+        ).view(-1, max_length)
+        log_ps = torch.from_numpy(numpy.array(self.log_ps[example_index])).view(-1)
+        return sampled_questions, log_ps
+
+    def flush(self):
+        self.questions.flush()
+        self.log_ps.flush()
+        with open(os.path.join(self.path, "meta.json"), "w") as fd:
+            json.dump(self.meta, fd)
+
+
+def num_dataset_examples(dataset):
+    """The number of examples of the dataset, also for the iterable
+    datasets whose length counts the batches."""
+    if isinstance(dataset, torch.utils.data.IterableDataset):
+        return dataset.size
+    return len(dataset)
+
+
+class PGGQuestionCache(object):
+    """Greedy questions of the question module for the PGG answer updates,
+    keyed by the example index and regenerated once they are older than
+    refresh_steps training steps."""
+
+    def __init__(self, max_length, refresh_steps):
+        self.refresh_steps = refresh_steps
+        self.step = 0
+
+        # the t5 vocabulary fits in uint16, a step of -1 marks a missing question.
+        self.questions = numpy.zeros((0, max_length), dtype=numpy.uint16)
+        self.steps = numpy.zeros((0,), dtype=numpy.int64)
+
+    def stale(self, example_index):
+        """Return the mask of the examples without a fresh question."""
+        example_index = example_index.cpu().numpy()
+        size = int(example_index.max()) + 1
+        if size > len(self.steps):
+            size = max(size, 2 * len(self.steps))
+            questions = numpy.zeros(
+                (size, self.questions.shape[1]), dtype=numpy.uint16
+            )
+            questions[: len(self.questions)] = self.questions
+            steps = numpy.full((size,), -1, dtype=numpy.int64)
+            steps[: len(self.steps)] = self.steps
+            self.questions = questions
+            self.steps = steps
+        steps = self.steps[example_index]
+        stale = (steps < 0) | (self.step - steps >= self.refresh_steps)
+        return torch.from_numpy(stale)
+
+    def write(self, example_index, questions):
+        example_index = example_index.cpu().numpy()
+        max_length = self.questions.shape[1]
+        questions = questions.cpu().numpy()[:, :max_length]
+        self.questions[example_index] = 0
+        self.questions[example_index, : questions.shape[1]] = questions
+        self.steps[example_index] = self.step
+
+    def read(self, example_index):
+        example_index = example_index.cpu().numpy()
+        return torch.from_numpy(self.questions[example_index].astype(numpy.int64))
+
+    def advance(self):
+        """Count a training step."""
+        self.step += 1
 
 
 MODEL_NAME = "t5-small"
@@ -190,10 +870,19 @@ class REQA(torch.nn.Module):
             MODEL_NAME#, local_files_only=True
         )
 
-        # Construct the pretrained question model
-        self.init_question_model = T5ForConditionalGeneration.from_pretrained(
-            MODEL_NAME#, local_files_only=True
-        )
+        # Construct the pretrained question model, which is not needed in
+        # training if the off-policy samples are read from a sample bank.
+        self.init_question_model = None
+        self.sample_bank = None
+        if cfg.mode == "train" and cfg.sample_bank is not None:
+            self.sample_bank = QuestionSampleBank(cfg.sample_bank)
+            self.sample_bank.check(
+                num_samples=cfg.num_search_samples, max_length=cfg.decoder_max_length
+            )
+        else:
+            self.init_question_model = T5ForConditionalGeneration.from_pretrained(
+                MODEL_NAME#, local_files_only=True
+            )
 
         if cfg.mode == "train":
             # Configurations suggested by the T5 paper.
@@ -229,11 +918,21 @@ class REQA(torch.nn.Module):
 
             load_module(answer_model, self.model_path, cfg.answer_checkpoint)
             load_module(question_model, self.model_path, cfg.question_checkpoint)
+            if self.init_question_model is not None:
+                load_module(
+                    self.init_question_model, self.model_path, cfg.question_checkpoint
+                )
+
+            self.pgg_question_cache = PGGQuestionCache(
+                cfg.decoder_max_length, cfg.pgg_refresh_steps
+            )
+
+        elif cfg.mode == "sample_bank":
             load_module(
                 self.init_question_model, self.model_path, cfg.question_checkpoint
             )
 
-        elif cfg.mode in ["test", "inference"]:
+        elif cfg.mode in ["test", "inference"] and cfg.answer_checkpoint is not None:
             try:
                 load_module(answer_model, self.model_path, cfg.answer_checkpoint)
                 load_module(question_model, self.model_path, cfg.question_checkpoint)
@@ -245,6 +944,99 @@ class REQA(torch.nn.Module):
         self.question_model = question_model
         self.question_tokenizer = question_tokenizer
 
+        self.init_segment_ids()
+
+        # ratio of the unique sampled questions scored in the last training step.
+        self.dedup_ratio = 1.0
+
+    def init_segment_ids(self):
+        """Tokenize the fixed segments of the answer module inputs.
+
+        Both modules share the t5 vocabulary, so the answer module inputs
+        are built by splicing token ids instead of re-tokenizing strings.
+        """
+        self.relation_prefix_ids = self.answer_tokenizer(
+            "relation:", add_special_tokens=False
+        ).input_ids
+        self.question_prefix_ids = self.answer_tokenizer(
+            "question:", add_special_tokens=False
+        ).input_ids
+        self.context_prefix_ids = self.answer_tokenizer(
+            "context:", add_special_tokens=False
+        ).input_ids
+        self.eos_ids = self.answer_tokenizer("</s>", add_special_tokens=False).input_ids
+        self.question_special_ids = set(self.question_tokenizer.all_special_ids)
+
+    def batch_segments(self, batch, key, ids_key, mask_key):
+        """The token ids of the passages or entity relations of the batch,
+        from the columns stored by add_answer_segments, or tokenized here
+        for the datasets without them."""
+        if ids_key in batch:
+            return [
+                ids[:length]
+                for ids, length in zip(
+                    batch[ids_key].tolist(), batch[mask_key].sum(dim=1).tolist()
+                )
+            ]
+        return self.answer_tokenizer(
+            list(batch[key]), add_special_tokens=False
+        ).input_ids
+
+    def question_segments(self, question_ids):
+        """Convert the generated question ids into the question segments,
+        removing the special tokens and the 'question:' prefix.
+
+        The generated ids are spliced as they are, so they match the ids
+        of tokenizing the decoded question only when the question model
+        generates the canonical tokenization of its text.
+        """
+        prefix_len = len(self.question_prefix_ids)
+        segments = []
+        for ids in question_ids.tolist():
+            ids = [token for token in ids if token not in self.question_special_ids]
+            if ids[:prefix_len] == self.question_prefix_ids:
+                ids = ids[prefix_len:]
+            segments.append(ids)
+        return segments
+
+    def answer_module_input(self, batch, question_ids, example_ids, current_device):
+        """Build the answer module input 'relation: ... question: ... context:
+        ... </s>' from the token ids of the generated questions, where
+        example_ids gives the example in the batch for every question."""
+        relation_segments = self.batch_segments(
+            batch,
+            "entity_relations",
+            "entity_relation_ids",
+            "entity_relation_attention_mask",
+        )
+        passage_segments = self.batch_segments(
+            batch, "passages", "passage_ids", "passage_attention_mask"
+        )
+        segments_list = []
+        for example_id, question_segment in zip(
+            example_ids.tolist(), self.question_segments(question_ids)
+        ):
+            segments_list.append(
+                [
+                    self.relation_prefix_ids,
+                    relation_segments[example_id],
+                    self.question_prefix_ids,
+                    question_segment,
+                    self.context_prefix_ids,
+                    passage_segments[example_id],
+                    self.eos_ids,
+                ]
+            )
+        answer_input_ids, answer_input_mask = splice_input_ids(
+            segments_list,
+            self.config.source_max_length,
+            pad_token_id=self.answer_tokenizer.pad_token_id,
+        )
+        if self.config.gpu:
+            answer_input_ids = answer_input_ids.to(current_device)
+            answer_input_mask = answer_input_mask.to(current_device)
+        return answer_input_ids, answer_input_mask
+
     def question_beam_predict(
         self, batch, current_device, with_tail_entity=False, num_ret_seqs=1
     ):
@@ -306,32 +1098,10 @@ class REQA(torch.nn.Module):
             remove_prefix(pred, "question: ") for pred in question_predictions_str
         ]
 
-        new_articles = []
-        for i in range(len(question_predictions_str)):
-            new_article = (
-                "relation: "
-                + batch["entity_relations"][i // num_ret_seqs]
-                + " question: "
-                + question_predictions_str[i]
-                + " context: "
-                + batch["passages"][i // num_ret_seqs]
-                + " </s>"
-            )
-            new_articles.append(new_article)
-
-        answer_inputs = self.answer_tokenizer(
-            new_articles,
-            truncation=True,
-            padding="max_length",
-            max_length=self.config.source_max_length,
-            add_special_tokens=False,
-            return_tensors="pt",
+        example_ids = torch.arange(question_predictions.size(0)) // num_ret_seqs
+        answer_input_ids, answer_input_mask = self.answer_module_input(
+            batch, question_predictions, example_ids, current_device
         )
-        answer_input_ids = answer_inputs.input_ids
-        answer_input_mask = answer_inputs.attention_mask
-        if self.config.gpu:
-            answer_input_ids = answer_input_ids.to(current_device)
-            answer_input_mask = answer_input_mask.to(current_device)
 
         return (
             answer_input_ids,
@@ -380,9 +1150,6 @@ class REQA(torch.nn.Module):
     def relation_classifier(self, batch, current_device):
         """Relation classifier using tail entity generation."""
         self.question_model.eval()
-        loss_fct = torch.nn.CrossEntropyLoss(ignore_index=-100, reduction="none")
-        if self.config.gpu:
-            loss_fct = loss_fct.to(current_device)
         (
             answer_input_ids,
             answer_input_mask,
@@ -402,35 +1169,23 @@ class REQA(torch.nn.Module):
             target_mask = target_mask.to(current_device)
             labels = labels.to(current_device)
 
-        b_sz, dec_seq_len = labels.size()
-        labels = labels.repeat(1, self.config.num_search_samples).view(-1, dec_seq_len)
-        target_mask = target_mask.repeat(1, self.config.num_search_samples).view(
-            -1, dec_seq_len
-        )
+        labels = expand_samples(labels, self.config.num_search_samples)
+        target_mask = expand_samples(target_mask, self.config.num_search_samples)
 
         # Answer Computation
         with torch.no_grad():
             self.answer_model.eval()
-            output = self.answer_model(
+            answer_log_p = sequence_log_p(
+                self.answer_model,
+                labels,
+                target_mask,
+                answer_input_mask,
                 input_ids=answer_input_ids,
-                attention_mask=answer_input_mask,
-                decoder_attention_mask=target_mask,
-                decoder_input_ids=self.answer_model._shift_right(labels),
-                labels=None,
-            )
-
-            log_p = -loss_fct(
-                output.logits.view(-1, output.logits.size(-1)),
-                labels.view(-1),
             )
 
             # b: batch size
-            # sz: sequence size
-            # v: vocab size
-            b, sz, v = output.logits.size()
-            log_p = log_p.view(b, sz)
-            good_log_p = log_p.masked_fill_(labels == -100, 0.0)
-            answer_log_p = torch.sum(good_log_p, dim=1).squeeze().cpu().numpy()
+            b = answer_log_p.size(0)
+            answer_log_p = answer_log_p.cpu().numpy()
             question_log_ps = question_log_ps.cpu().numpy()
             for index in range(b):
                 relation_log_p = answer_log_p[index] + question_log_ps[index]
@@ -442,257 +1197,190 @@ class REQA(torch.nn.Module):
                 }
                 yield output_batch
 
-    def pgg_answer_training(self, batch, current_device):
-        """Compute PGG loss only for the answer module."""
-        loss_fct = torch.nn.CrossEntropyLoss(ignore_index=-100, reduction="none")
-        if self.config.gpu:
-            loss_fct = loss_fct.to(current_device)
-        (
-            answer_input_ids,
-            answer_input_mask,
-            question_input_ids,
-            question_input_mask,
-            question_predictions_str,
-            question_log_ps,
-        ) = self.question_beam_predict(batch, current_device)
-        target_mask = batch["second_entity_attention_mask"]
-        labels = batch["second_entity_labels"]
-        if self.config.gpu:
-            target_mask = target_mask.to(current_device)
-            labels = labels.to(current_device)
-
-        # Answer Computation
-        self.answer_model.train()
-        output = self.answer_model(
-            input_ids=answer_input_ids,
-            attention_mask=answer_input_mask,
-            decoder_attention_mask=target_mask,
-            decoder_input_ids=self.answer_model._shift_right(labels),
-            labels=None,
-        )
-
-        log_p = -loss_fct(
-            output.logits.view(-1, output.logits.size(-1)),
-            labels.view(-1),
-        )
-
-        # b: batch size
-        # sz: sequence size
-        # v: vocab size
-        b, sz, v = output.logits.size()
-        log_p = log_p.view(b, sz)
-        good_log_p = log_p.masked_fill_(labels == -100, 0.0)
-        answer_log_p = torch.sum(good_log_p, dim=1).squeeze()
-
-        loss = -torch.mean(answer_log_p, dim=0)
-        loss_value = loss.item()
-        return loss, loss_value
-
     def response_forward(
-        self, batch, new_articles, current_device, loss_fct, answer_training=False
+        self,
+        batch,
+        answer_input_ids,
+        answer_input_mask,
+        example_ids,
+        current_device,
+        answer_training=False,
     ):
         """Prepare the input for the response module and decide whether to
-        train it for MML objectives or don't train it with PGG objective."""
-        # Get output from the response module
-        answer_inputs = self.answer_tokenizer(
-            new_articles,
-            truncation=True,
-            padding="max_length",
-            max_length=self.config.source_max_length,
-            add_special_tokens=False,
-            return_tensors="pt",
-        )
-
-        answer_input_ids = answer_inputs.input_ids
-        answer_input_mask = answer_inputs.attention_mask
-        if self.config.gpu:
-            answer_input_ids = answer_input_ids.to(current_device)
-            answer_input_mask = answer_input_mask.to(current_device)
+        train it for MML objectives or don't train it with PGG objective.
 
+        example_ids gives the example in the batch for every row of the
+        answer inputs.
+        """
         target_mask = batch["second_entity_attention_mask"]
         labels = batch["second_entity_labels"]
         if self.config.gpu:
             target_mask = target_mask.to(current_device)
             labels = labels.to(current_device)
 
-        b_sz, _ = labels.size()
-
-        (
-            answer_input_ids,
-            answer_input_mask,
-            target_mask,
-            new_labels,
-        ) = prepare_response_module_input(
-            answer_input_ids=answer_input_ids,
-            answer_input_mask=answer_input_mask,
-            labels=labels,
-            target_mask=target_mask,
-            num_samples=self.config.num_search_samples,
-        )
+        target_mask = target_mask.index_select(0, example_ids)
+        new_labels = labels.index_select(0, example_ids)
 
         if not answer_training:
             with torch.no_grad():
-                output = self.answer_model(
+                return sequence_log_p(
+                    self.answer_model,
+                    new_labels,
+                    target_mask,
+                    answer_input_mask,
                     input_ids=answer_input_ids,
-                    attention_mask=answer_input_mask,
-                    decoder_attention_mask=target_mask,
-                    decoder_input_ids=self.answer_model._shift_right(new_labels),
-                    labels=None,
                 )
 
-                log_p = -loss_fct(
-                    output.logits.view(-1, output.logits.size(-1)),
-                    new_labels.view(-1),
-                )
-
-                b, s_len, v = output.logits.size()
-                log_p = log_p.view(b, s_len)
-                good_log_p = log_p.masked_fill_(new_labels == -100, 0.0)
-                answer_log_p = torch.sum(good_log_p, dim=1).squeeze()
-                answer_log_p = answer_log_p.view(b_sz, self.config.num_search_samples)
-
-                return answer_log_p
-
-        else:
-            output = self.answer_model(
-                input_ids=answer_input_ids,
-                attention_mask=answer_input_mask,
-                decoder_attention_mask=target_mask,
-                decoder_input_ids=self.answer_model._shift_right(new_labels),
-                labels=None,
-            )
-
-            log_p = -loss_fct(
-                output.logits.view(-1, output.logits.size(-1)),
-                new_labels.view(-1),
-            )
-
-            b, s_len, v = output.logits.size()
-            log_p = log_p.view(b, s_len)
-            good_log_p = log_p.masked_fill_(new_labels == -100, 0.0)
-            answer_log_p = torch.sum(good_log_p, dim=1).squeeze()
-            answer_log_p = answer_log_p.view(b_sz, self.config.num_search_samples)
-
-            return answer_log_p
+        return sequence_log_p(
+            self.answer_model,
+            new_labels,
+            target_mask,
+            answer_input_mask,
+            input_ids=answer_input_ids,
+        )
 
     def question_forward(
         self,
         current_device,
         question_input_ids,
         question_input_mask,
-        final_sampled_question_predictions_str_reshaped,
-        loss_fct,
+        question_ids,
+        example_ids,
         question_training=True,
     ):
         """Now re-run the question generator and compute the loss for the
-        sampled predictions.
+        sampled predictions given by their generated token ids.
 
-        This will compute the gradients in the question module.
+        example_ids gives the example in the batch for every sampled
+        question. This will compute the gradients in the question
+        module.
         """
 
-        b_sz, src_seq_len = question_input_ids.size()
-        question_input_ids = question_input_ids.repeat(
-            1, self.config.num_search_samples
-        ).view(-1, src_seq_len)
-        question_input_mask = question_input_mask.repeat(
-            1, self.config.num_search_samples
-        ).view(-1, src_seq_len)
-
-        output_questions = []
-        for i in range(b_sz):
-            for j in range(self.config.num_search_samples):
-                output_question = (
-                    white_space_fix(
-                        final_sampled_question_predictions_str_reshaped[i][j]
-                    )
-                    + " </s>"
-                )
-                output_questions.append(output_question)
-
-        question_encodings = self.question_tokenizer(
-            output_questions,
-            truncation=True,
-            padding="max_length",
-            max_length=self.config.decoder_max_length,
-            add_special_tokens=False,
-            return_tensors="pt",
-        )
-        question_labels = question_encodings.pop("input_ids")
-        question_target_mask = question_encodings.pop("attention_mask")
-
         # because HuggingFace automatically shifts the labels, the labels correspond exactly to `target_ids`.
         # We have to make sure that the PAD token is ignored
-
-        question_labels = [
-            [
-                -100 if token == self.question_tokenizer.pad_token_id else token
-                for token in labels
-            ]
-            for labels in question_labels.tolist()
-        ]
-        question_labels = torch.tensor(question_labels)
+        question_labels, question_target_mask = question_labels_from_ids(
+            question_ids,
+            self.config.decoder_max_length,
+            pad_token_id=self.question_tokenizer.pad_token_id,
+            eos_token_id=self.question_tokenizer.eos_token_id,
+        )
         if self.config.gpu:
             question_target_mask = question_target_mask.to(current_device)
             question_labels = question_labels.to(current_device)
 
         if question_training:
             self.question_model.train()
-
-            _, dec_seq_len = question_labels.size()
-
-            question_output = self.question_model(
-                input_ids=question_input_ids,
-                attention_mask=question_input_mask,
-                decoder_attention_mask=question_target_mask,
-                decoder_input_ids=self.question_model._shift_right(question_labels),
-                labels=None,
+            return shared_encoder_log_p(
+                self.question_model,
+                question_input_ids,
+                question_input_mask,
+                question_labels,
+                question_target_mask,
+                example_ids,
             )
 
-            log_question_p = -loss_fct(
-                question_output.logits.view(-1, question_output.logits.size(-1)),
-                question_labels.view(-1),
+        self.question_model.eval()
+        with torch.no_grad():
+            return shared_encoder_log_p(
+                self.question_model,
+                question_input_ids,
+                question_input_mask,
+                question_labels,
+                question_target_mask,
+                example_ids,
             )
 
-            b, seq_len, v = question_output.logits.size()
-            log_question_p = log_question_p.view(b, seq_len)
-            good_log_question_p = log_question_p.masked_fill_(
-                question_labels == -100, 0.0
-            )
-            question_log_p = torch.sum(good_log_question_p, dim=1).squeeze()
-            question_log_p = question_log_p.view(b_sz, self.config.num_search_samples)
+    def sample_questions(self, model, input_ids, attention_mask, sample_p=0.95):
+        """Sample the questions from the model with top-p sampling and compute
+        their log probabilities during the generation."""
+        # keep the top-k warping that generate applies by default.
+        generation_config = getattr(model, "generation_config", None) or model.config
+        log_p_processor = SampledLogProbs(
+            top_k=getattr(generation_config, "top_k", None),
+            top_p=sample_p,
+            pad_token_id=self.question_tokenizer.pad_token_id,
+        )
+        sampled_questions = model.generate(
+            input_ids=input_ids,
+            do_sample=True,
+            no_repeat_ngram_size=self.config.no_repeat_ngram_size,
+            max_length=self.config.decoder_max_length,
+            num_return_sequences=self.config.num_search_samples,
+            top_k=0,
+            top_p=1.0,
+            logits_processor=LogitsProcessorList([log_p_processor]),
+            attention_mask=attention_mask,
+        )
+        log_ps = log_p_processor.finish(sampled_questions)
 
-            return question_log_p, output_questions
+        # Skip the first pad token generated by the T5 model.
+        return sampled_questions[:, 1:], log_ps
 
-        else:
-            self.question_model.eval()
+    def off_policy_samples(self, batch, current_device, sample_p=0.95):
+        """Sample the questions from the frozen init question model given the
+        posterior inputs and compute their log probabilities."""
+        # the posterior inputs also have the tail entity.
+        posterier_question_input_ids = batch["posterier_input_ids"]
+        posterier_question_input_mask = batch["posterier_attention_mask"]
+        if self.config.gpu:
+            posterier_question_input_ids = posterier_question_input_ids.to(
+                current_device
+            )
+            posterier_question_input_mask = posterier_question_input_mask.to(
+                current_device
+            )
 
-            _, dec_seq_len = question_labels.size()
+        with torch.no_grad():
+            self.init_question_model.eval()
+            return self.sample_questions(
+                self.init_question_model,
+                posterier_question_input_ids,
+                posterier_question_input_mask,
+                sample_p=sample_p,
+            )
 
+    def build_sample_bank(
+        self, dataloader, current_device, sample_p=0.95, source_digest=None
+    ):
+        """Sample the off-policy questions once for every example in the
+        dataloader and store them in the sample bank at config.sample_bank,
+        recording the source_digest of its data file."""
+        sample_bank = QuestionSampleBank(
+            self.config.sample_bank,
+            mode="w",
+            num_examples=num_dataset_examples(dataloader.dataset),
+            num_samples=self.config.num_search_samples,
+            max_length=self.config.decoder_max_length,
+            source_digest=source_digest,
+        )
+        for batch in dataloader:
+            sampled_questions, question_log_ps = self.off_policy_samples(
+                batch, current_device, sample_p=sample_p
+            )
+            sample_bank.write(batch["example_index"], sampled_questions, question_log_ps)
+        sample_bank.flush()
+
+    def pgg_questions(self, batch, question_input_ids, question_input_mask):
+        """Return the cached greedy questions of the examples in the batch,
+        generating the questions which are missing or stale."""
+        stale = self.pgg_question_cache.stale(batch["example_index"])
+        if stale.any():
+            stale_rows = stale.nonzero(as_tuple=True)[0]
+            device_rows = stale_rows.to(question_input_ids.device)
+            self.question_model.eval()
             with torch.no_grad():
-                question_output = self.question_model(
-                    input_ids=question_input_ids,
-                    attention_mask=question_input_mask,
-                    decoder_attention_mask=question_target_mask,
-                    decoder_input_ids=self.question_model._shift_right(question_labels),
-                    labels=None,
-                )
-
-                log_question_p = -loss_fct(
-                    question_output.logits.view(-1, question_output.logits.size(-1)),
-                    question_labels.view(-1),
-                )
-
-                b, seq_len, v = question_output.logits.size()
-                log_question_p = log_question_p.view(b, seq_len)
-                good_log_question_p = log_question_p.masked_fill_(
-                    question_labels == -100, 0.0
-                )
-                question_log_p = torch.sum(good_log_question_p, dim=1).squeeze()
-                question_log_p = question_log_p.view(
-                    b_sz, self.config.num_search_samples
+                questions = self.question_model.generate(
+                    input_ids=question_input_ids[device_rows],
+                    attention_mask=question_input_mask[device_rows],
+                    no_repeat_ngram_size=self.config.no_repeat_ngram_size,
+                    max_length=self.config.decoder_max_length,
+                    num_beams=1,
+                    do_sample=False,
                 )
-
-                return question_log_p, output_questions
+            self.pgg_question_cache.write(
+                batch["example_index"][stale_rows], questions
+            )
+        return self.pgg_question_cache.read(batch["example_index"])
 
     def overall_training(
         self,
@@ -707,10 +1395,6 @@ class REQA(torch.nn.Module):
         """The main training function to decide which sampling technique to use
         and also to compute the loss corresponding to different training
         objectives."""
-        loss_fct = torch.nn.CrossEntropyLoss(ignore_index=-100, reduction="none")
-        if self.config.gpu:
-            loss_fct = loss_fct.to(current_device)
-
         # Loss from the entity relation examples!
         question_input_ids = batch["entity_relation_passage_input_ids"]
         question_input_mask = batch["entity_relation_passage_attention_mask"]
@@ -718,108 +1402,64 @@ class REQA(torch.nn.Module):
             question_input_ids = question_input_ids.to(current_device)
             question_input_mask = question_input_mask.to(current_device)
 
-        if off_policy:
-            # the posterior inputs also have the tail entity.
-            posterier_question_input_ids = batch["posterier_input_ids"]
-            posterier_question_input_mask = batch["posterier_attention_mask"]
-            if self.config.gpu:
-                posterier_question_input_ids = posterier_question_input_ids.to(
-                    current_device
-                )
-                posterier_question_input_mask = posterier_question_input_mask.to(
-                    current_device
-                )
-
         b_sz, _ = question_input_ids.size()
 
         with torch.no_grad():
-            if off_policy:
-                self.init_question_model.eval()
-                sampled_question_outputs = self.init_question_model.generate(
-                    input_ids=posterier_question_input_ids,
-                    do_sample=True,
-                    no_repeat_ngram_size=self.config.no_repeat_ngram_size,
-                    max_length=self.config.decoder_max_length,
-                    num_return_sequences=self.config.num_search_samples,
-                    top_p=sample_p,
-                    output_scores=True,
-                    return_dict_in_generate=True,
-                    attention_mask=posterier_question_input_mask,
-                )
-            else:
-                self.question_model.eval()
-                sampled_question_outputs = self.question_model.generate(
-                    input_ids=question_input_ids,
-                    do_sample=True,
-                    no_repeat_ngram_size=self.config.no_repeat_ngram_size,
-                    max_length=self.config.decoder_max_length,
-                    num_return_sequences=self.config.num_search_samples,
-                    top_p=sample_p,
-                    output_scores=True,
-                    return_dict_in_generate=True,
-                    attention_mask=question_input_mask,
+            if off_policy and self.sample_bank is not None:
+                sampled_questions, question_log_ps = self.sample_bank.read(
+                    batch["example_index"]
                 )
-
-            sampled_questions, question_log_ps = prob_of_sampled_predictions(
-                loss_fct, sampled_question_outputs
-            )
-
-            if off_policy:
-                sampled_question_predictions_str = (
-                    self.init_question_tokenizer.batch_decode(
-                        sampled_questions, skip_special_tokens=True
-                    )
+                if self.config.gpu:
+                    sampled_questions = sampled_questions.to(current_device)
+                    question_log_ps = question_log_ps.to(current_device)
+            elif off_policy:
+                sampled_questions, question_log_ps = self.off_policy_samples(
+                    batch, current_device, sample_p=sample_p
                 )
             else:
-                sampled_question_predictions_str = self.question_tokenizer.batch_decode(
-                    sampled_questions, skip_special_tokens=True
+                self.question_model.eval()
+                sampled_questions, question_log_ps = self.sample_questions(
+                    self.question_model,
+                    question_input_ids,
+                    question_input_mask,
+                    sample_p=sample_p,
                 )
 
-            sampled_question_predictions_str = [
-                remove_prefix(pred, "question: ")
-                for pred in sampled_question_predictions_str
-            ]
+        sample_log_ps = question_log_ps.view(b_sz, self.config.num_search_samples)
 
-            sampled_question_predictions_str_reshaped = [
-                sampled_question_predictions_str[
-                    i
-                    * (self.config.num_search_samples) : (i + 1)
-                    * (self.config.num_search_samples)
-                ]
-                for i in range(b_sz)
-            ]
+        # Score every unique sampled question of an example only once.
+        unique_questions, example_ids, inverse = unique_samples(
+            sampled_questions, self.config.num_search_samples
+        )
+        self.dedup_ratio = unique_questions.size(0) / sampled_questions.size(0)
 
-        sample_log_ps = question_log_ps.view(b_sz, self.config.num_search_samples)
-        new_articles = []
-        for i in range(b_sz):
-            for j in range(self.config.num_search_samples):
-                new_article = (
-                    "relation: "
-                    + batch["entity_relations"][i]
-                    + " question: "
-                    + sampled_question_predictions_str_reshaped[i][j]
-                    + " context: "
-                    + batch["passages"][i]
-                    + " </s>"
-                )
-                new_articles.append(new_article)
+        answer_input_ids, answer_input_mask = self.answer_module_input(
+            batch, unique_questions, example_ids, current_device
+        )
 
         answer_log_p = self.response_forward(
             batch,
-            new_articles,
+            answer_input_ids,
+            answer_input_mask,
+            example_ids,
             current_device,
-            loss_fct,
             answer_training=answer_training,
         )
+        answer_log_p = answer_log_p[inverse].view(
+            b_sz, self.config.num_search_samples
+        )
 
-        question_log_p, output_questions = self.question_forward(
+        question_log_p = self.question_forward(
             current_device,
             question_input_ids,
             question_input_mask,
-            sampled_question_predictions_str_reshaped,
-            loss_fct,
+            unique_questions,
+            example_ids,
             question_training=question_training,
         )
+        question_log_p = question_log_p[inverse].view(
+            b_sz, self.config.num_search_samples
+        )
 
         if train_type == "MML":
             # easier stable way to use MML objective with backpropogation.
@@ -830,6 +1470,48 @@ class REQA(torch.nn.Module):
             easier_mml_loss = -torch.mean(torch.logsumexp(ratio_log, dim=1), dim=0)
             return easier_mml_loss
 
+        if train_type == "MML-PGG":
+            # MML loss for the question module as above.
+            if off_policy:
+                ratio_log = question_log_p - sample_log_ps + answer_log_p
+            else:
+                ratio_log = question_log_p + answer_log_p
+            easier_mml_loss = -torch.mean(torch.logsumexp(ratio_log, dim=1), dim=0)
+
+            # PGG loss for the answer module on one question per example.
+            if off_policy:
+                # the off-policy samples are generated given the tail entity,
+                # so the answer module is trained on a greedy question of the
+                # question module from the inputs without the tail entity.
+                pgg_questions = self.pgg_questions(
+                    batch, question_input_ids, question_input_mask
+                )
+                pgg_example_ids = torch.arange(b_sz, device=question_input_ids.device)
+                pgg_input_ids, pgg_input_mask = self.answer_module_input(
+                    batch, pgg_questions, pgg_example_ids, current_device
+                )
+            else:
+                # the on-policy samples come from the question module, so
+                # reuse the sample with its highest sampling probability.
+                best_samples = torch.argmax(sample_log_ps, dim=1)
+                best_rows = inverse.view(b_sz, self.config.num_search_samples)[
+                    torch.arange(b_sz, device=best_samples.device), best_samples
+                ]
+                pgg_input_ids = answer_input_ids[best_rows]
+                pgg_input_mask = answer_input_mask[best_rows]
+                pgg_example_ids = example_ids[best_rows]
+            self.answer_model.train()
+            pgg_answer_log_p = self.response_forward(
+                batch,
+                pgg_input_ids,
+                pgg_input_mask,
+                pgg_example_ids,
+                current_device,
+                answer_training=True,
+            )
+            pgg_loss = -torch.mean(pgg_answer_log_p, dim=0)
+            return easier_mml_loss, pgg_loss
+
     def train_objectives(
         self,
         batch,
@@ -890,23 +1572,23 @@ class REQA(torch.nn.Module):
             self.question_optimizer.zero_grad()
 
             self.answer_model.eval()
-            loss = self.overall_training(
+            loss, pgg_loss = self.overall_training(
                 batch,
                 current_device,
                 sample_p=sample_p,
                 off_policy=True,
                 answer_training=False,
                 question_training=True,
+                train_type="MML-PGG",
             )
             loss_value = loss.item()
+            pgg_loss_value = pgg_loss.item()
 
             if not math.isnan(loss_value):
                 # BackProp
                 loss.backward()
                 # Optimize
 
-            self.question_model.eval()
-            pgg_loss, pgg_loss_value = self.pgg_answer_training(batch, current_device)
             if not math.isnan(pgg_loss_value):
                 # BackProp
                 pgg_loss.backward()
@@ -914,6 +1596,7 @@ class REQA(torch.nn.Module):
 
             self.answer_optimizer.step()
             self.question_optimizer.step()
+            self.pgg_question_cache.advance()
             return (loss_value, pgg_loss_value)
 
         if objective_type == "MML-PGG-On-Sim":
@@ -921,23 +1604,23 @@ class REQA(torch.nn.Module):
             self.question_optimizer.zero_grad()
 
             self.answer_model.eval()
-            loss = self.overall_training(
+            loss, pgg_loss = self.overall_training(
                 batch,
                 current_device,
                 sample_p=sample_p,
                 off_policy=False,
                 answer_training=False,
                 question_training=True,
+                train_type="MML-PGG",
             )
             loss_value = loss.item()
+            pgg_loss_value = pgg_loss.item()
 
             if not math.isnan(loss_value):
                 # BackProp
                 loss.backward()
                 # Optimize
 
-            self.question_model.eval()
-            pgg_loss, pgg_loss_value = self.pgg_answer_training(batch, current_device)
             if not math.isnan(pgg_loss_value):
                 # BackProp
                 pgg_loss.backward()
@@ -9,7 +9,10 @@ from typing import Optional
 import numpy as np
 import torch
 
-from src.re_qa_model import HyperParameters, save
+from src.re_qa_model import (MODEL_NAME, CheckpointWriter, HyperParameters,
+                             TopCheckpoints, save)
+from src.zero_extraction_utils import (evaluate_relation_f1,
+                                       predictions_in_dataset_order)
 
 
 def run_predict(
@@ -21,21 +24,20 @@ def run_predict(
     with io.open(prediction_file, mode="w", encoding="utf-8") as out_fp:
         writer = csv.writer(out_fp, **writerparams)
         header_written = False
-        for batch in dev_dataloader:
-            if predict_type == "entity":
-                for ret_row in model.predict_step(batch, current_device):
-                    if not header_written:
-                        headers = ret_row.keys()
-                        writer.writerow(headers)
-                        header_written = True
-                    writer.writerow(list(ret_row.values()))
-            elif predict_type == "relation":
-                for ret_row in model.relation_classifier(batch, current_device):
-                    if not header_written:
-                        headers = ret_row.keys()
-                        writer.writerow(headers)
-                        header_written = True
-                    writer.writerow(list(ret_row.values()))
+        if predict_type == "entity":
+            predict_function = model.predict_step
+        elif predict_type == "relation":
+            predict_function = model.relation_classifier
+
+        # rows are written in the order of the dataset to line up with the gold files.
+        for ret_row in predictions_in_dataset_order(
+            dev_dataloader, lambda batch: predict_function(batch, current_device)
+        ):
+            if not header_written:
+                headers = ret_row.keys()
+                writer.writerow(headers)
+                header_written = True
+            writer.writerow(list(ret_row.values()))
 
 
 def save_config(config: HyperParameters, path: str):
@@ -61,8 +63,15 @@ def iterative_run_model(
     save_always: Optional[bool] = False,
     current_device=0,
     train_method="MML-MML-On-Sim",
+    dev_dataloader=None,
+    dev_gold_ids=None,
 ) -> None:
-    """Run the model on input data (for training or testing)"""
+    """Run the model on input data (for training or testing)
+
+    With config.eval_steps, the relations of the dev_dataloader are scored
+    during training, and with config.keep_top_k only the checkpoints with
+    the best dev f1 are saved.
+    """
 
     model_path = config.model_path
     max_epochs = config.max_epochs
@@ -70,6 +79,18 @@ def iterative_run_model(
     if mode == "train":
         print("\nINFO: ML training\n")
         first_start = time.time()
+        # the checkpoints are written in the background.
+        writer = CheckpointWriter(
+            flat=config.flat_checkpoints,
+            dtype=config.checkpoint_dtype,
+            base=MODEL_NAME if config.delta_checkpoints else None,
+        )
+        evaluate_dev = config.eval_steps is not None and dev_dataloader is not None
+        top_checkpoints = None
+        if evaluate_dev and config.keep_top_k is not None:
+            top_checkpoints = TopCheckpoints(
+                model.model_path, config.keep_top_k, writer=writer
+            )
         epoch = 0
         while epoch < max_epochs:
             start = time.time()
@@ -100,25 +121,70 @@ def iterative_run_model(
                     mean_loss = np.mean(total_loss)
 
                 print(
-                    "\rBatch:{0} | Loss:{1} | Mean Loss:{2} | GPU Usage:{3}\n".format(
+                    "\rBatch:{0} | Loss:{1} | Mean Loss:{2} | GPU Usage:{3} | Dedup Ratio:{4}\n".format(
                         step + 1,
                         loss,
                         mean_loss,
                         torch.cuda.memory_allocated(device=current_device),
+                        model.dedup_ratio,
                     )
                 )
 
                 step += 1
-                if save_always and step > 0 and (step % 100 == 0):
+                if evaluate_dev and step % config.eval_steps == 0:
+                    dev_f1 = evaluate_relation_f1(
+                        dev_dataloader,
+                        lambda batch: model.relation_classifier(batch, current_device),
+                        dev_gold_ids,
+                        log_p_key="answer_log_p",
+                        num_samples=config.num_search_samples,
+                    )
+                    print(
+                        "\rDev F1:{0} | Epoch:{1} | Step:{2}\n".format(
+                            dev_f1, epoch, step
+                        )
+                    )
+                    if top_checkpoints is not None:
+                        question_checkpoint = str(epoch) + "_question_step_" + str(step)
+                        answer_checkpoint = str(epoch) + "_answer_step_" + str(step)
+
+                        def save_checkpoint():
+                            save(
+                                model.question_model,
+                                model.model_path,
+                                question_checkpoint,
+                                writer=writer,
+                            )
+                            save(
+                                model.answer_model,
+                                model.model_path,
+                                answer_checkpoint,
+                                writer=writer,
+                            )
+
+                        top_checkpoints.add(
+                            dev_f1,
+                            ["_" + question_checkpoint, "_" + answer_checkpoint],
+                            save_checkpoint,
+                        )
+
+                if (
+                    save_always
+                    and top_checkpoints is None
+                    and step > 0
+                    and (step % 100 == 0)
+                ):
                     save(
                         model.question_model,
                         model.model_path,
                         str(epoch) + "_question_step_" + str(step),
+                        writer=writer,
                     )
                     save(
                         model.answer_model,
                         model.model_path,
                         str(epoch) + "_answer_step_" + str(step),
+                        writer=writer,
                     )
 
             if save_always:
@@ -126,17 +192,20 @@ def iterative_run_model(
                     model.question_model,
                     model.model_path,
                     str(epoch) + "_question_full",
+                    writer=writer,
                 )
                 save(
                     model.answer_model,
                     model.model_path,
                     str(epoch) + "_answer_full",
+                    writer=writer,
                 )
 
             msg = "\nEpoch training time: {0} seconds\n".format(time.time() - start)
             print(msg)
             epoch += 1
 
+        writer.wait()
         save_config(config, model_path)
 
         msg = "\nTotal training time: {0} seconds\n".format(time.time() - first_start)
@@ -1,18 +1,31 @@
+import csv
+import functools
+import hashlib
+import itertools
 import json
+import math
+import multiprocessing
+import os
+import pickle
 import random
+import re
+import shutil
+from array import array
 from pathlib import Path
 from re import I
 
+import numpy
 import pandas as pd
 import torch
 # from datasets import load_dataset
 from torch.utils.data import DataLoader
+from transformers import AutoTokenizer, BatchEncoding
 
 from random import sample
-from src.re_qa_model import set_random_seed
+from src.re_qa_model import mask_pad_labels, set_random_seed
 
 
-def sample_dev_rows(file_path, seed=12321):
+def sample_dev_rows(file_path, seed=12321, output_path=None):
     set_random_seed(seed)
     data_df = pd.read_csv(file_path, sep=",")
     rel_id_data = {}
@@ -41,13 +54,148 @@ def sample_dev_rows(file_path, seed=12321):
                 sampled_rows.append(ret)
 
     output_df = pd.DataFrame(sampled_rows)
-    output_df.to_csv(file_path+".sampled.csv", sep=",", header=True, index=False)
+    if output_path is None:
+        output_path = file_path + ".sampled.csv"
+    output_df.to_csv(output_path, sep=",", header=True, index=False)
     return
 
 
 def white_space_fix(text):
     return " ".join(text.split())
 
+
+# relation_descriptions.json and props.json are in the repository root.
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+SENTENCE_DELIMITERS = [". ", ".\n", "? ", "?\n", "! ", "!\n"]
+
+
+def first_sentence(desc):
+    """Cut a props.json description at its first sentence."""
+    desc = desc.strip(".") + ". "
+    pos = [desc.find(delimiter) for delimiter in SENTENCE_DELIMITERS]
+    pos = min([p for p in pos if p >= 0])
+    return white_space_fix(desc[:pos])
+
+
+def index_relation_descriptions(re_desc_data):
+    """Index the rows of relation_descriptions.json by relation id and label."""
+    indexes = {
+        "id_to_label": {},
+        "id_to_desc": {},
+        "label_to_id": {},
+        "label_to_desc": {},
+    }
+    for row in re_desc_data:
+        re_id = row["relation_id"]
+        re_label = row["relation_label"]
+        indexes["id_to_label"][re_id] = re_label
+        indexes["id_to_desc"][re_id] = row["relation_description"]
+        indexes["label_to_id"][re_label] = re_id
+        indexes["label_to_desc"][re_label] = row["relation_description"]
+    return indexes
+
+
+def index_props(re_desc_data):
+    """Index the first sentence of the props.json descriptions by property id
+    and by lowercased label."""
+    indexes = {"id_to_desc": {}, "label_to_desc": {}}
+    for row in re_desc_data:
+        desc = row["description"]
+        if desc == {}:
+            continue
+        re_desc = first_sentence(desc)
+        indexes["id_to_desc"][row["id"]] = re_desc
+        indexes["label_to_desc"][white_space_fix(row["label"]).lower()] = re_desc
+    return indexes
+
+
+class RelationCatalog:
+    """The relation labels and descriptions of relation_descriptions.json
+    and props.json in directory.
+
+    Each file is parsed on the first use of its indexes. The indexes are
+    cached in a .catalog.pkl file next to the json, which is rebuilt when
+    the json changes.
+    """
+
+    def __init__(self, directory=REPO_DIR):
+        self.directory = Path(directory)
+        self.relation_indexes = None
+        self.prop_indexes = None
+
+    def load_indexes(self, name, index):
+        json_path = self.directory / name
+        cache_path = self.directory / (name + ".catalog.pkl")
+        stat = json_path.stat()
+        key = (stat.st_size, stat.st_mtime_ns)
+        try:
+            with open(cache_path, "rb") as fd:
+                cached_key, indexes = pickle.load(fd)
+            if cached_key == key:
+                return indexes
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            pass
+
+        with open(json_path, "r") as fd:
+            indexes = index(json.load(fd))
+        tmp_path = "{0}.tmp-{1}".format(cache_path, os.getpid())
+        try:
+            with open(tmp_path, "wb") as fd:
+                pickle.dump((key, indexes), fd, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            # the catalog still works without the cache, e.g. read-only.
+            pass
+        return indexes
+
+    @property
+    def relations(self):
+        if self.relation_indexes is None:
+            self.relation_indexes = self.load_indexes(
+                "relation_descriptions.json", index_relation_descriptions
+            )
+        return self.relation_indexes
+
+    @property
+    def props(self):
+        if self.prop_indexes is None:
+            self.prop_indexes = self.load_indexes("props.json", index_props)
+        return self.prop_indexes
+
+    @property
+    def id_to_label(self):
+        return self.relations["id_to_label"]
+
+    @property
+    def id_to_desc(self):
+        return self.relations["id_to_desc"]
+
+    @property
+    def label_to_id(self):
+        return self.relations["label_to_id"]
+
+    @property
+    def label_to_desc(self):
+        return self.relations["label_to_desc"]
+
+    @property
+    def prop_id_to_desc(self):
+        """First sentence descriptions of props.json by property id."""
+        return self.props["id_to_desc"]
+
+    @property
+    def prop_label_to_desc(self):
+        """First sentence descriptions of props.json by lowercased label."""
+        return self.props["label_to_desc"]
+
+
+@functools.lru_cache(maxsize=None)
+def relation_catalog(directory=REPO_DIR):
+    """The process-wide RelationCatalog of the directory."""
+    return RelationCatalog(directory)
+
+
 def find_sub_list(sl, l):
     i = 0
     while i <= len(l) - len(sl):
@@ -66,12 +214,7 @@ def find_fewrel_ids(path):
         data = json.load(json_file)
         r_ids = set(list(data.keys()))
 
-    id_to_desc = {}
-    with open("./relation_descriptions.json", "r") as fd:
-        re_desc_data = json.load(fd)
-        for row in re_desc_data:
-            re_id = row["relation_id"]
-            id_to_desc[re_id] = row["relation_description"]
+    id_to_desc = relation_catalog().id_to_desc
 
     ids_not_found = []
     for id in r_ids:
@@ -90,12 +233,7 @@ def find_wikizsl_ids(path):
         if label not in all_keys:
             all_keys.add(label)
 
-    id_to_desc = {}
-    with open("./relation_descriptions.json", "r") as fd:
-        re_desc_data = json.load(fd)
-        for row in re_desc_data:
-            re_id = row["relation_id"]
-            id_to_desc[re_id] = row["relation_description"]
+    id_to_desc = relation_catalog().id_to_desc
 
     ids_not_found = []
     for id in all_keys:
@@ -107,19 +245,7 @@ def find_wikizsl_ids(path):
 def find_all_relation_ids_in_reqa(path):
     label_to_id = {}
 
-    rel_desc_dict = {}
-    with open("./props.json", "r") as fd:
-        re_desc_data = json.load(fd)
-        sentence_delimiters = [". ", ".\n", "? ", "?\n", "! ", "!\n"]
-        for row in re_desc_data:
-            desc = row["description"]
-            if desc == {}:
-                continue
-            desc = desc.strip(".") + ". "
-            pos = [desc.find(delimiter) for delimiter in sentence_delimiters]
-            pos = min([p for p in pos if p >= 0])
-            re_desc = desc[:pos]
-            rel_desc_dict[row["id"]] = white_space_fix(re_desc)
+    rel_desc_dict = dict(relation_catalog().prop_id_to_desc)
 
     rel_dict = {}
     with open(path, "r") as fd:
@@ -157,172 +283,604 @@ def write_jsonl(file_path, lines):
     data = [ujson.dumps(line, escape_forward_slashes=False) for line in lines]
     Path(file_path).open('w', encoding='utf-8').write('\n'.join(data))
 
-def convert_promptZRE_to_offmml_format(promptzsl_path, output_path):
-    path = Path("./relation_descriptions.json")
 
-    label_to_desc = {}
-    with open(path, "r") as fd:
-        re_desc_data = json.load(fd)
-        for row in re_desc_data:
-            label_to_desc[row["relation_label"]] = row["relation_description"]
-
-    train_contexts = []
-    train_posterier_contexts = []
-    train_answers = []
-    train_passages = []
-    train_entities = []
-    train_entity_relations = []
-    all_relation_labels = set()
-    for row in read_jsonl(promptzsl_path):
-        for triple_row in row["triplets"]:
-            tokens = triple_row["tokens"]
-            head_indices = triple_row["head"]
-            tail_indices = triple_row["tail"]
-            re_label = triple_row["label"]
-            all_relation_labels.add(re_label)
-            sentence = " ".join(tokens)
-            head_entity = " ".join([tokens[i] for i in head_indices])
-            tail_entity = " ".join([tokens[i] for i in tail_indices])
+def write_jsonl_line(fd, line):
+    """Append one line to the .jsonl file open in fd, in the format of
+    write_jsonl."""
+    if fd.tell() > 0:
+        fd.write("\n")
+    fd.write(ujson.dumps(line, escape_forward_slashes=False))
+
+
+def iter_json_items(file_path, chunk_size=1 << 20):
+    """Stream the items of the top level array or object of a .json file,
+    decoding one item at a time.
+
+    YIELDS: (key, value, start, end) where key is None for an array and
+    start, end are the byte offsets of the value, see read_json_value.
+    """
+    decoder = json.JSONDecoder()
+    with open(file_path, "r", encoding="utf-8") as fd:
+        buffer = fd.read(chunk_size)
+        pos = 0
+        # byte offset of buffer[pos] in the file.
+        offset = 0
+
+        def advance(end):
+            nonlocal pos, offset
+            offset += len(buffer[pos:end].encode("utf-8"))
+            pos = end
+
+        def read_more():
+            nonlocal buffer, pos
+            more = fd.read(chunk_size)
+            if not more:
+                return False
+            buffer = buffer[pos:] + more
+            pos = 0
+            return True
+
+        def skip(chars):
+            while True:
+                end = pos
+                while end < len(buffer) and (
+                    buffer[end].isspace() or buffer[end] in chars
+                ):
+                    end += 1
+                advance(end)
+                if pos < len(buffer) or not read_more():
+                    return
+
+        def decode():
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buffer, pos)
+                    # the value may continue in the next chunk, a number
+                    # only ends at a delimiter.
+                    is_number = isinstance(value, (int, float)) and not isinstance(
+                        value, bool
+                    )
+                    complete = end < len(buffer) and (
+                        not is_number
+                        or buffer[end].isspace()
+                        or buffer[end] in ",]}"
+                    )
+                    if complete or not read_more():
+                        break
+                except json.JSONDecodeError:
+                    if not read_more():
+                        raise
+            start = offset
+            advance(end)
+            return value, start, offset
+
+        skip("")
+        is_object = buffer[pos] == "{"
+        closing = "}" if is_object else "]"
+        advance(pos + 1)
+        while True:
+            skip(",")
+            if buffer[pos] == closing:
+                return
+            key = None
+            if is_object:
+                key, _, _ = decode()
+                skip(":")
+            value, start, end = decode()
+            yield key, value, start, end
+
+
+def read_json_value(file_path, start, end):
+    """Decode the json value at the byte offsets given by iter_json_items."""
+    with open(file_path, "rb") as fd:
+        fd.seek(start)
+        return json.loads(fd.read(end - start).decode("utf-8"))
+
+
+# The columns of the csv files read for the off-policy mml training.
+OFFMML_COLUMNS = [
+    "passages",
+    "contexts",
+    "answers",
+    "entity_relations",
+    "entities",
+    "posterier_contexts",
+]
+
+# The fields stored in the columnar tables, the columns are built from them.
+OFFMML_FIELDS = ["passages", "entities", "relations", "descriptions", "answers"]
+
+OFFMML_COLUMN_FIELDS = {
+    "passages": ["passages"],
+    "contexts": ["passages", "entities", "relations", "descriptions"],
+    "concat_contexts": ["passages", "entities", "relations"],
+    "answers": ["answers"],
+    "entity_relations": ["entities", "relations"],
+    "entities": ["entities"],
+    "posterier_contexts": [
+        "passages",
+        "entities",
+        "relations",
+        "descriptions",
+        "answers",
+    ],
+    "actual_ids": ["actual_ids"],
+}
+
+
+def offmml_row(
+    sentence, head_entity, r_name, r_desc, gold_answers, columns=OFFMML_COLUMNS
+):
+    """Create the csv row which asks about the head entity and the relation
+    in the sentence, with the given columns.
+
+    concat_contexts is the question of the concat models, the
+    "question: head <SEP> relation" of entity_relations.
+    """
+    row = {}
+    if "passages" in columns:
+        row["passages"] = sentence
+    if "contexts" in columns:
+        row["contexts"] = (
+            "answer: "
+            + white_space_fix(head_entity)
+            + " <SEP> "
+            + white_space_fix(r_name)
+            + " ; "
+            + white_space_fix(r_desc)
+            + " context: "
+            + white_space_fix(sentence)
+            + " </s>"
+        )
+    if "concat_contexts" in columns:
+        row["concat_contexts"] = white_space_fix(
+            "question: "
+            + white_space_fix(head_entity + " <SEP> " + r_name)
+            + " context: "
+            + white_space_fix(sentence)
+            + " </s>"
+        )
+    if "answers" in columns:
+        row["answers"] = white_space_fix(gold_answers) + " </s>"
+    if "entity_relations" in columns:
+        row["entity_relations"] = white_space_fix(head_entity + " <SEP> " + r_name)
+    if "entities" in columns:
+        row["entities"] = white_space_fix(head_entity)
+    if "posterier_contexts" in columns:
+        row["posterier_contexts"] = (
+            "answer: "
+            + white_space_fix(head_entity)
+            + " <SEP> "
+            + white_space_fix(r_name)
+            + " ; "
+            + white_space_fix(r_desc)
+            + " "
+            + white_space_fix(gold_answers)
+            + " context: "
+            + white_space_fix(sentence)
+            + " </s>"
+        )
+    return row
+
+
+def offmml_sentence_pieces(sentence, head_entity):
+    """The parts of the OFFMML_COLUMNS prompts which only depend on the
+    sentence and its head entity, see offmml_pieces_row."""
+    head = white_space_fix(head_entity)
+    return {
+        "sentence": sentence,
+        "head_entity": head_entity,
+        "entity": head,
+        "head": "answer: " + head,
+        "head_words": head.split(),
+        "context": " context: " + white_space_fix(sentence) + " </s>",
+    }
+
+
+def offmml_answer_pieces(gold_answers):
+    """The parts of the OFFMML_COLUMNS prompts which only depend on the gold
+    answers."""
+    answers = white_space_fix(gold_answers)
+    return {"gold_answers": gold_answers, "answers": answers}
+
+
+def offmml_relation_pieces(r_name, r_desc):
+    """The parts of the OFFMML_COLUMNS prompts which only depend on the
+    relation."""
+    return {
+        "r_name": r_name,
+        "r_desc": r_desc,
+        "relation": " <SEP> "
+        + white_space_fix(r_name)
+        + " ; "
+        + white_space_fix(r_desc),
+        "relation_words": r_name.split(),
+    }
+
+
+def offmml_pieces_row(sentence_pieces, relation_pieces, answer_pieces):
+    """Join the prompt pieces into the OFFMML_COLUMNS row of offmml_row.
+
+    The pieces of a sentence or a relation are built once, and only
+    joined for every row asking about them.
+    """
+    head = sentence_pieces["head"] + relation_pieces["relation"]
+    return {
+        "passages": sentence_pieces["sentence"],
+        "contexts": head + sentence_pieces["context"],
+        "answers": answer_pieces["answers"] + " </s>",
+        "entity_relations": " ".join(
+            sentence_pieces["head_words"]
+            + ["<SEP>"]
+            + relation_pieces["relation_words"]
+        ),
+        "entities": sentence_pieces["entity"],
+        "posterier_contexts": head
+        + " "
+        + answer_pieces["answers"]
+        + sentence_pieces["context"],
+    }
+
+
+def offmml_table_path(csv_path):
+    """The columnar table written next to the csv file of a data split."""
+    return str(Path(csv_path).with_suffix(".npz"))
+
+
+def offmml_data_path(csv_path):
+    """The file read for the data split: its table, or the csv file."""
+    if csv_path is None:
+        return None
+    table_path = offmml_table_path(csv_path)
+    return table_path if os.path.exists(table_path) else csv_path
+
+
+# Rows of codes and offsets kept in memory before they are appended to the
+# part files of the columnar table.
+OFFMML_FLUSH_ROWS = 65536
 
-            gold_answers = tail_entity
-            train_passages.append(sentence)
-            train_entity_relations.append(
-                white_space_fix(head_entity + " <SEP> " + re_label)
+
+def read_offmml_part(path, dtype):
+    """Memory map a part file of the columnar table, which may be empty."""
+    if os.path.getsize(path) == 0:
+        return numpy.zeros((0,), dtype=dtype)
+    return numpy.memmap(path, dtype=dtype, mode="r")
+
+
+class OffmmlWriter:
+    """Write the rows of a data split to its columnar table and, for the
+    notebooks, to the csv file.
+
+    The table keeps every field as the unique strings, utf-8 encoded into
+    one byte array with their offsets, and the int32 codes of the rows.
+    So a passage is stored once for all the candidate relations asking
+    about it.
+
+    The strings, offsets and codes are appended to part files next to the
+    table while the rows are written, only the sha1 digests of the unique
+    strings are kept in memory. close() packs the part files into the
+    table.
+    """
+
+    def __init__(self, csv_path, actual_ids=False, write_csv=True):
+        self.csv_path = csv_path
+        self.table_path = offmml_table_path(csv_path)
+        self.fields = OFFMML_FIELDS + (["actual_ids"] if actual_ids else [])
+        self.index = {field: {} for field in self.fields}
+        self.blob_sizes = {field: 0 for field in self.fields}
+        self.offsets = {field: array("q", [0]) for field in self.fields}
+        self.codes = {field: array("i") for field in self.fields}
+        self.part_fds = {
+            (field, part): open(self.part_path(field, part), "wb")
+            for field in self.fields
+            for part in ["blob", "offsets", "codes"]
+        }
+        self.num_rows = 0
+        self.csv_fd = None
+        self.csv_writer = None
+        if write_csv:
+            self.csv_fd = open(csv_path, "w", newline="")
+            self.csv_writer = csv.DictWriter(
+                self.csv_fd,
+                fieldnames=OFFMML_COLUMNS + (["actual_ids"] if actual_ids else []),
+                lineterminator="\n",
             )
-            train_entities.append(white_space_fix(head_entity))
-            train_contexts.append(
-                    "answer: "
-                    + white_space_fix(head_entity)
-                    + " <SEP> "
-                    + white_space_fix(re_label)
-                    + " ; "
-                    + white_space_fix(label_to_desc[re_label])
-                    + " context: "
-                    + white_space_fix(sentence)
-                    + " </s>"
+            self.csv_writer.writeheader()
+
+    def part_path(self, field, part):
+        return "{0}.{1}.{2}.part".format(self.table_path, field, part)
+
+    def code(self, field, value):
+        """The code of the value, appending the value to the blob of the
+        field if it is new."""
+        encoded = value.encode("utf-8")
+        key = hashlib.sha1(encoded).digest()
+        index = self.index[field]
+        code = index.get(key)
+        if code is None:
+            code = len(index)
+            index[key] = code
+            self.part_fds[(field, "blob")].write(encoded)
+            self.blob_sizes[field] += len(encoded)
+            self.offsets[field].append(self.blob_sizes[field])
+        return code
+
+    def writerow(
+        self, sentence, head_entity, r_name, r_desc, gold_answers, actual_id=None
+    ):
+        self.write_pieces(
+            offmml_sentence_pieces(sentence, head_entity),
+            offmml_relation_pieces(r_name, r_desc),
+            offmml_answer_pieces(gold_answers),
+            actual_id=actual_id,
+        )
+
+    def write_pieces(
+        self, sentence_pieces, relation_pieces, answer_pieces, actual_id=None
+    ):
+        """Write the row of the prompt pieces built by offmml_sentence_pieces,
+        offmml_relation_pieces and offmml_answer_pieces."""
+        fields = {
+            "passages": sentence_pieces["sentence"],
+            "entities": sentence_pieces["head_entity"],
+            "relations": relation_pieces["r_name"],
+            "descriptions": relation_pieces["r_desc"],
+            "answers": answer_pieces["gold_answers"],
+            "actual_ids": actual_id,
+        }
+        for field in self.fields:
+            self.codes[field].append(self.code(field, fields[field]))
+        self.num_rows += 1
+        if self.num_rows % OFFMML_FLUSH_ROWS == 0:
+            self.flush()
+
+        if self.csv_writer is not None:
+            row = offmml_pieces_row(sentence_pieces, relation_pieces, answer_pieces)
+            if "actual_ids" in self.fields:
+                row["actual_ids"] = actual_id
+            self.csv_writer.writerow(row)
+
+    def flush(self):
+        """Append the offsets and codes kept in memory to the part files."""
+        for field in self.fields:
+            self.offsets[field].tofile(self.part_fds[(field, "offsets")])
+            self.codes[field].tofile(self.part_fds[(field, "codes")])
+            del self.offsets[field][:]
+            del self.codes[field][:]
+
+    def close(self):
+        self.flush()
+        for fd in self.part_fds.values():
+            fd.close()
+        arrays = {}
+        for field in self.fields:
+            arrays[field + ".blob"] = read_offmml_part(
+                self.part_path(field, "blob"), numpy.uint8
             )
-            train_posterier_contexts.append(
-                    "answer: "
-                    + white_space_fix(head_entity)
-                    + " <SEP> "
-                    + white_space_fix(re_label)
-                    + " ; "
-                    + white_space_fix(label_to_desc[re_label])
-                    + " "
-                    + white_space_fix(gold_answers)
-                    + " context: "
-                    + white_space_fix(sentence)
-                    + " </s>"
+            arrays[field + ".offsets"] = read_offmml_part(
+                self.part_path(field, "offsets"), numpy.int64
             )
-            train_answers.append(
-                    white_space_fix(gold_answers) + " </s>"
+            arrays[field + ".codes"] = read_offmml_part(
+                self.part_path(field, "codes"), numpy.int32
             )
-    
-    # This time generate the negative data per example.
-    for row in read_jsonl(promptzsl_path):
-        for triple_row in row["triplets"]:
-            tokens = triple_row["tokens"]
-            head_indices = triple_row["head"]
-            tail_indices = triple_row["tail"]
-            re_label = triple_row["label"]
+        with open(self.table_path, "wb") as fd:
+            numpy.savez(fd, **arrays)
+        del arrays
+        for field, part in self.part_fds.keys():
+            os.remove(self.part_path(field, part))
+        if self.csv_fd is not None:
+            self.csv_fd.close()
 
-            all_labels = list(all_relation_labels)
-            all_labels.remove(re_label)
-            neg_label = random.sample(all_labels, 1)[0]
+    def __enter__(self):
+        return self
 
-            sentence = " ".join(tokens)
-            head_entity = " ".join([tokens[i] for i in head_indices])
-            tail_entity = " ".join([tokens[i] for i in tail_indices])
+    def __exit__(self, *exc_info):
+        self.close()
 
-            gold_answers = "no_answer"
-            train_passages.append(sentence)
-            train_entity_relations.append(
-                white_space_fix(head_entity + " <SEP> " + neg_label)
-            )
-            train_entities.append(white_space_fix(head_entity))
-            train_contexts.append(
-                    "answer: "
-                    + white_space_fix(head_entity)
-                    + " <SEP> "
-                    + white_space_fix(neg_label)
-                    + " ; "
-                    + white_space_fix(label_to_desc[neg_label])
-                    + " context: "
-                    + white_space_fix(sentence)
-                    + " </s>"
-            )
-            train_posterier_contexts.append(
-                    "answer: "
-                    + white_space_fix(head_entity)
-                    + " <SEP> "
-                    + white_space_fix(neg_label)
-                    + " ; "
-                    + white_space_fix(label_to_desc[neg_label])
-                    + " "
-                    + white_space_fix(gold_answers)
-                    + " context: "
-                    + white_space_fix(sentence)
-                    + " </s>"
+
+def decode_offmml_strings(blob, offsets, codes):
+    """Decode the strings of the codes from the utf-8 blob of a columnar
+    table field, every unique code once."""
+    strings = {}
+    for code in codes:
+        if code not in strings:
+            encoded = blob[offsets[code] : offsets[code + 1]].tobytes()
+            strings[code] = encoded.decode("utf-8")
+    return [strings[code] for code in codes]
+
+
+def read_offmml_data(csv_path, columns):
+    """Read the columns of a data split as lists, from its columnar table if
+    it exists, otherwise from the csv file.
+
+    Only the fields of the requested columns are decoded.
+    """
+    return next(iter_offmml_data(csv_path, columns))
+
+
+def iter_offmml_data(csv_path, columns, chunk_size=None):
+    """Yield the columns of the data split like read_offmml_data, for
+    chunk_size rows at a time.
+
+    Without a chunk_size, all the rows are yielded as one chunk.
+    """
+    table_path = offmml_table_path(csv_path)
+    if not os.path.exists(table_path):
+        csv_columns = [column for column in columns if column != "concat_contexts"]
+        if "concat_contexts" in columns:
+            csv_columns = list(
+                dict.fromkeys(csv_columns + ["contexts", "entity_relations"])
             )
-            train_answers.append(
-                    white_space_fix(gold_answers) + " </s>"
+        data_dfs = pd.read_csv(
+            csv_path, sep=",", usecols=csv_columns, chunksize=chunk_size
+        )
+        if chunk_size is None:
+            data_dfs = [data_dfs]
+        for data_df in data_dfs:
+            data = {column: data_df[column].tolist() for column in csv_columns}
+            if "concat_contexts" in columns:
+                data["concat_contexts"] = [
+                    white_space_fix(
+                        "question: "
+                        + entity_relation
+                        + " context: "
+                        + context.split("context: ")[1]
+                    )
+                    for context, entity_relation in zip(
+                        data["contexts"], data["entity_relations"]
+                    )
+                ]
+            yield {column: data[column] for column in columns}
+        return
+
+    blobs = {}
+    offsets = {}
+    codes = {}
+    with numpy.load(table_path) as table:
+        for column in columns:
+            for field in OFFMML_COLUMN_FIELDS[column]:
+                if field in codes:
+                    continue
+                blobs[field] = table[field + ".blob"]
+                offsets[field] = table[field + ".offsets"]
+                codes[field] = table[field + ".codes"]
+
+    size = len(next(iter(codes.values())))
+    row_columns = [column for column in columns if column != "actual_ids"]
+    for start in range(0, size, chunk_size) if chunk_size else [0]:
+        end = size if chunk_size is None else start + chunk_size
+        fields = {
+            field: decode_offmml_strings(
+                blobs[field], offsets[field], codes[field][start:end].tolist()
             )
+            for field in codes.keys()
+        }
+        data = {}
+        if "actual_ids" in columns:
+            data["actual_ids"] = fields.pop("actual_ids")
+        if row_columns:
+            rows = [
+                offmml_row(*row_fields, columns=row_columns)
+                for row_fields in zip(
+                    *[
+                        fields.get(field, itertools.repeat(None))
+                        for field in OFFMML_FIELDS
+                    ]
+                )
+            ]
+            for column in row_columns:
+                data[column] = [row[column] for row in rows]
+        yield {column: data[column] for column in columns}
 
-    shuffled_indices = list(range(len(train_passages)))
-    random.shuffle(shuffled_indices)
 
-    train_df = pd.DataFrame(
-        {
-            "passages": [train_passages[i] for i in shuffled_indices],
-            "contexts": [train_contexts[i] for i in shuffled_indices],
-            "answers": [train_answers[i] for i in shuffled_indices],
-            "entity_relations": [train_entity_relations[i] for i in shuffled_indices],
-            "entities": [train_entities[i] for i in shuffled_indices],
-            "posterier_contexts": [train_posterier_contexts[i] for i in shuffled_indices],
-        }
-    )
+def sample_other(ids, index):
+    """Sample an element of ids other than ids[index].
 
-    train_df.to_csv(
-       output_path, sep=",", header=True, index=False
-    )
+    Draws like random.sample(ids without ids[index], 1)[0].
+    """
+    other = random.randrange(len(ids) - 1)
+    if other >= index:
+        other += 1
+    return ids[other]
+
+
+def convert_promptZRE_to_offmml_format(promptzsl_path, output_path):
+    label_to_desc = relation_catalog().label_to_desc
+
+    # only the position of every triplet is kept, the rows are read back
+    # from the file in the shuffled order.
+    all_relation_labels = []
+    label_to_index = {}
+    line_offsets = []
+    triple_indices = []
+    label_indices = []
+    with open(promptzsl_path, "rb") as fd:
+        offset = 0
+        for line in fd:
+            try:  # hack to handle broken jsonl
+                row = ujson.loads(line.strip())
+            except ValueError:
+                offset += len(line)
+                continue
+            for triple_index, triple_row in enumerate(row["triplets"]):
+                re_label = triple_row["label"]
+                if re_label not in label_to_index:
+                    label_to_index[re_label] = len(all_relation_labels)
+                    all_relation_labels.append(re_label)
+                line_offsets.append(offset)
+                triple_indices.append(triple_index)
+                label_indices.append(label_to_index[re_label])
+            offset += len(line)
+
+    # This time generate the negative data per example.
+    neg_labels = [
+        sample_other(all_relation_labels, label_index)
+        for label_index in label_indices
+    ]
+
+    num_triplets = len(line_offsets)
+    shuffled_indices = list(range(2 * num_triplets))
+    random.shuffle(shuffled_indices)
+
+    with open(promptzsl_path, "rb") as fd, OffmmlWriter(output_path) as writer:
+        for index in shuffled_indices:
+            triple_index = index % num_triplets
+            fd.seek(line_offsets[triple_index])
+            row = ujson.loads(fd.readline().strip())
+            triple_row = row["triplets"][triple_indices[triple_index]]
+            tokens = triple_row["tokens"]
+            sentence = " ".join(tokens)
+            head_entity = " ".join([tokens[i] for i in triple_row["head"]])
+            tail_entity = " ".join([tokens[i] for i in triple_row["tail"]])
+            if index < num_triplets:
+                re_label = triple_row["label"]
+                gold_answers = tail_entity
+            else:
+                re_label = neg_labels[triple_index]
+                gold_answers = "no_answer"
+            writer.writerow(
+                sentence,
+                head_entity,
+                re_label,
+                label_to_desc[re_label],
+                gold_answers,
+            )
     return
 
+
+def read_wikizsl_relation_ids(zsl_path):
+    """Read the relation ids of the wikizsl file in the order they first
+    appear."""
+    relation_ids = []
+    relation_set = set()
+    for _, row, _, _ in iter_json_items(zsl_path):
+        relation_id = row["edgeSet"][0]["kbID"]
+        if relation_id not in relation_set:
+            relation_ids.append(relation_id)
+            relation_set.add(relation_id)
+    return relation_ids
+
+
 def convert_wikizsl_to_promptZRE_format(zsl_path, output_path, seed=12321, m=5):
     set_random_seed(seed)
 
-    id_to_label = {}
-    with open("./relation_descriptions.json", "r") as fd:
-        re_desc_data = json.load(fd)
-        for row in re_desc_data:
-            re_label = row["relation_label"]
-            re_id = row["relation_id"]
-            id_to_label[re_id] = re_label
+    id_to_label = relation_catalog().id_to_label
 
-    with open(zsl_path, "r") as json_file:
-        data = json.load(json_file)
-        # preserve order after shuffle.
-        relation_ids = []
-        relation_set = set()
-        for row in data:
-            relation_id = row["edgeSet"][0]["kbID"]
-            if relation_id not in relation_set:
-                relation_ids.append(relation_id)
-                relation_set.add(relation_id)
-
-        r_ids = relation_ids
-        random.shuffle(r_ids)
-        val_r_ids = r_ids[: m]
-        test_r_ids = r_ids[m : 4 * m]
-        train_r_ids = r_ids[4 * m :]
-
-        set_val_r_ids = set(val_r_ids)
-        set_test_r_ids = set(test_r_ids)
-        set_train_r_ids = set(train_r_ids)
-
-        val_data = []
-        train_data = []
-        test_data = []
-        for row in data:
+    # preserve order after shuffle.
+    r_ids = read_wikizsl_relation_ids(zsl_path)
+    random.shuffle(r_ids)
+    val_r_ids = r_ids[: m]
+    test_r_ids = r_ids[m : 4 * m]
+    train_r_ids = r_ids[4 * m :]
+
+    set_val_r_ids = set(val_r_ids)
+    set_test_r_ids = set(test_r_ids)
+    set_train_r_ids = set(train_r_ids)
+
+    with open(output_path + ".train.jsonl", "w", encoding="utf-8") as train_fd, open(
+        output_path + ".dev.jsonl", "w", encoding="utf-8"
+    ) as val_fd, open(output_path + ".test.jsonl", "w", encoding="utf-8") as test_fd:
+        for _, row, _, _ in iter_json_items(zsl_path):
             relation_id = row["edgeSet"][0]["kbID"]
             data_row = {
                 "triplets" : [{
@@ -334,32 +892,43 @@ def convert_wikizsl_to_promptZRE_format(zsl_path, output_path, seed=12321, m=5):
                 }]
             }
             if relation_id in set_val_r_ids:
-                val_data.append(data_row)
+                write_jsonl_line(val_fd, data_row)
             elif relation_id in set_test_r_ids:
-                test_data.append(data_row)
+                write_jsonl_line(test_fd, data_row)
             elif relation_id in set_train_r_ids:
-                train_data.append(data_row)
-
-        write_jsonl(output_path+'.train.jsonl', train_data)
-        write_jsonl(output_path+'.dev.jsonl', val_data)
-        write_jsonl(output_path+'.test.jsonl', test_data)
+                write_jsonl_line(train_fd, data_row)
 
 def hash_tokens(tokens):
     return "".join("".join(tokens).split()).replace('"', '').replace("'", "").strip().lower()
 
 def convert_fewrel_to_promptZRE_format(output_path, seed=12321, m=5):
-    set_random_seed(seed)
+    with open("./fewrel_all.json") as f:
+        raw_train = json.load(f)
+    write_fewrel_promptZRE_split(raw_train, output_path, seed, m=m)
 
-    id_to_label = {}
-    with open("./relation_descriptions.json", "r") as fd:
-        re_desc_data = json.load(fd)
-        for row in re_desc_data:
-            re_label = row["relation_label"]
-            re_id = row["relation_id"]
-            id_to_label[re_id] = re_label
 
+def convert_fewrel_to_promptZRE_format_seeds(output_path, seeds, m=5, num_workers=None):
+    """Write the splits of convert_fewrel_to_promptZRE_format for every seed
+    to output_path.<seed>, reading fewrel_all.json once."""
     with open("./fewrel_all.json") as f:
         raw_train = json.load(f)
+    map_seeds(
+        functools.partial(write_fewrel_promptZRE_split, m=m, add_seed_to_path=True),
+        seeds,
+        shared_args=(raw_train, output_path),
+        num_workers=num_workers,
+    )
+
+
+def write_fewrel_promptZRE_split(
+    raw_train, output_path, seed, m=5, add_seed_to_path=False
+):
+    """Write the jsonl files of the seed split of the fewrel relations."""
+    set_random_seed(seed)
+    if add_seed_to_path:
+        output_path = output_path + "." + str(seed)
+
+    id_to_label = relation_catalog().id_to_label
 
     for k, v in raw_train.items():
         print(k, len(v))
@@ -464,13 +1033,7 @@ def convert_fewrel_to_promptZRE_format(output_path, seed=12321, m=5):
 def convert_fewrel_to_RCL_format(output_path, seed=12321, m=5):
     set_random_seed(seed)
 
-    id_to_label = {}
-    with open("./relation_descriptions.json", "r") as fd:
-        re_desc_data = json.load(fd)
-        for row in re_desc_data:
-            re_label = row["relation_label"]
-            re_id = row["relation_id"]
-            id_to_label[re_id] = re_label
+    id_to_label = relation_catalog().id_to_label
 
     with open("./fewrel_all.json") as f:
         raw_train = json.load(f)
@@ -545,13 +1108,7 @@ def convert_fewrel_to_RCL_format(output_path, seed=12321, m=5):
 def convert_reqa_to_fewrel_format(path, output_path):
     path = Path(path)
 
-    label_to_id = {}
-    with open("./relation_descriptions.json", "r") as fd:
-        re_desc_data = json.load(fd)
-        for row in re_desc_data:
-            re_label = row["relation_label"]
-            re_id = row["relation_id"]
-            label_to_id[re_label] = re_id
+    label_to_id = relation_catalog().label_to_id
 
     output_json = {}
     with open(output_path, "w") as out_fd:
@@ -592,21 +1149,6 @@ def read_re_qa_relation_data_prompt_format(path, train=False):
     """Create data for the UnifiedQA model with a prompt format."""
     path = Path(path)
 
-    rel_dict = {}
-    with open("./props.json", "r") as fd:
-        re_desc_data = json.load(fd)
-        sentence_delimiters = [". ", ".\n", "? ", "?\n", "! ", "!\n"]
-        for row in re_desc_data:
-            desc = row["description"]
-            if desc == {}:
-                continue
-            desc = desc.strip(".") + ". "
-            pos = [desc.find(delimiter) for delimiter in sentence_delimiters]
-            pos = min([p for p in pos if p >= 0])
-            re_desc = desc[:pos]
-            re_id = row["label"]
-            rel_dict[white_space_fix(re_id).lower()] = white_space_fix(re_desc)
-
     all_relations = {}
     with open(path, "r") as fd:
         for line in fd:
@@ -665,19 +1207,15 @@ def read_re_qa_relation_data_prompt_format(path, train=False):
     return contexts, answers
 
 
-def read_gold_re_qa_relation_data(path, concat=False, for_question_generation=False):
-    """Create val data for relation classification considering all the data and
-    gold_templates."""
-    path = Path(path)
-
-    label_to_desc = {}
-    with open("./relation_descriptions.json", "r") as fd:
-        re_desc_data = json.load(fd)
-        for row in re_desc_data:
-            re_label = row["relation_label"]
-            label_to_desc[re_label] = row["relation_description"]
+def read_gold_re_qa_relation_data(path):
+    """Read the split for relation classification considering all the data
+    and gold_templates.
 
+    Returns the rows which have answers and the gold templates of every
+    relation in the split.
+    """
     all_relations = {}
+    rows = []
     with open(path, "r") as fd:
         for line in fd:
             line = line.strip()
@@ -686,216 +1224,1416 @@ def read_gold_re_qa_relation_data(path, concat=False, for_question_generation=Fa
                 all_relations[line_arr[0]] = {line_arr[1]}
             else:
                 all_relations[line_arr[0]].add(line_arr[1])
+            if len(line_arr) > 4:
+                rows.append(line_arr)
+    return rows, all_relations
+
+
+# Token rows padded with -100 rather than the pad token, so the loss ignores them.
+LABEL_KEYS = ["labels", "second_entity_labels"]
+
+# Per-example strings which are kept as lists in the batch.
+STRING_KEYS = ["passages", "entity_relations"]
+
+
+# The attention masks are derived from the lengths of these token rows.
+MASK_KEYS = {
+    "attention_mask": "input_ids",
+    "target_attention_mask": "labels",
+    "entity_relation_passage_attention_mask": "entity_relation_passage_input_ids",
+    "posterier_attention_mask": "posterier_input_ids",
+    "entity_attention_mask": "entity_input_ids",
+    "second_entity_attention_mask": "second_entity_labels",
+    "passage_attention_mask": "passage_ids",
+    "entity_relation_attention_mask": "entity_relation_ids",
+}
+
+
+def encode_without_special_tokens(tokenizer, texts):
+    """The token ids of the texts, without the special tokens."""
+    return tokenizer(texts, add_special_tokens=False)["input_ids"]
+
+
+@functools.lru_cache(maxsize=None)
+def load_fast_tokenizer(name_or_path, vocab_size):
+    """Load the fast tokenizer of name_or_path, or None if it has none with
+    the same vocab_size."""
+    try:
+        tokenizer = AutoTokenizer.from_pretrained(name_or_path, use_fast=True)
+    except Exception:
+        # e.g. the conversion of the sentencepiece model is not supported.
+        return None
+    if not tokenizer.is_fast or len(tokenizer) != vocab_size:
+        return None
+    return tokenizer
+
+
+# Prompts in the formats of the datasets, which the fast tokenizer must
+# encode like the tokenizer to be used in its place.
+PARITY_PROBES = [
+    "answer: head <SEP> relation ; description. context: the passage, 1 2. </s>",
+    "answer: head <SEP> relation ; description answer context: passage </s>",
+    "question: head <SEP> relation context: the passage </s>",
+    "head <SEP> relation",
+    "tail entity </s>",
+    "no_answer </s>",
+    "</s>",
+    " spaces  at the ends ",
+]
+
+
+class TokenizerEncoder:
+    """Encode the texts like tokenizer(texts, add_special_tokens=False).
+
+    The texts are encoded in batches of batch_size by the fast tokenizer
+    of the same vocabulary, which encodes every batch on several threads.
+    The slow T5Tokenizer strips the spaces around the special tokens, as
+    in " </s>", and at the ends of the text, so they are also stripped
+    for the fast tokenizer. It is
+    only used if it encodes the PARITY_PROBES like the tokenizer,
+    otherwise the batches are split over num_workers processes of the
+    tokenizer. With verify, the tokenizer itself also encodes the texts,
+    and a ValueError is raised if the fast tokenizer gives other ids for
+    any of them.
+    """
 
-    with open(path, "r") as fd:
-        contexts = []
-        posterier_contexts = []
-        answers = []
-        passages = []
-        entities = []
-        entity_relations = []
-        correct_indices = []
-        rel_types = []
-        for line in fd:
-            line = line.strip()
-            line_arr = line.split("\t")
-            passage = line_arr[3]
-            for rel_type in all_relations.keys():
-                if concat:
-                    gold_question = line_arr[2] + " <SEP> " + rel_type
-                else:
-                    gold_template = next(iter(all_relations[rel_type]))
-                    gold_question = gold_template.replace(
-                        "XXX", " " + line_arr[2] + " "
-                    )
-                if len(line_arr) > 4:
-                    gold_answers = line_arr[4:]
-                    if rel_type == line_arr[0]:
-                        correct_indices.append(True)
-                    else:
-                        correct_indices.append(False)
-                else:
-                    continue
-                rel_types.append(rel_type)
-                passages.append(passage)
-                entity_relations.append(white_space_fix(line_arr[2] + " " + rel_type))
-                entities.append(white_space_fix(line_arr[2]))
-                if for_question_generation:
-                    if rel_type in label_to_desc:
-                        contexts.append(
-                            "answer: "
-                            + white_space_fix(line_arr[2])
-                            + " <SEP> "
-                            + white_space_fix(rel_type)
-                            + " ; "
-                            + label_to_desc[rel_type]
-                            + " context: "
-                            + white_space_fix(passage)
-                            + " </s>"
-                        )
-                        posterier_contexts.append(
-                            "answer: "
-                            + white_space_fix(line_arr[2])
-                            + " <SEP> "
-                            + white_space_fix(rel_type)
-                            + " ; "
-                            + label_to_desc[rel_type]
-                            + " "
-                            + white_space_fix(" and ".join(gold_answers))
-                            + " context: "
-                            + white_space_fix(passage)
-                            + " </s>"
+    def __init__(self, tokenizer, num_workers=None, batch_size=10000, verify=False):
+        self.tokenizer = tokenizer
+        self.fast_tokenizer = (
+            tokenizer
+            if tokenizer.is_fast
+            else load_fast_tokenizer(tokenizer.name_or_path, len(tokenizer))
+        )
+        self.special_token_spaces = re.compile(
+            r"\s*({0})\s*".format(
+                "|".join(re.escape(token) for token in tokenizer.all_special_tokens)
+            )
+        )
+        self.num_workers = os.cpu_count() if num_workers is None else num_workers
+        self.batch_size = batch_size
+        self.verify = verify
+        self.use_fast = self.fast_tokenizer is not None and (
+            self.fast_tokenizer is tokenizer or not self.mismatches(PARITY_PROBES)
+        )
+
+    def fast_encode(self, texts):
+        if self.fast_tokenizer is self.tokenizer:
+            return encode_without_special_tokens(self.tokenizer, texts)
+        return encode_without_special_tokens(
+            self.fast_tokenizer,
+            [self.special_token_spaces.sub(r"\1", text).strip() for text in texts],
+        )
+
+    def mismatches(self, texts):
+        """Find the texts which the fast tokenizer encodes to other ids than
+        the tokenizer, as the (text, ids, fast ids) triples."""
+        return [
+            (text, ids, fast_ids)
+            for text, ids, fast_ids in zip(
+                texts,
+                encode_without_special_tokens(self.tokenizer, texts),
+                self.fast_encode(texts),
+            )
+            if ids != fast_ids
+        ]
+
+    def __call__(self, texts):
+        texts = list(texts)
+        batches = [
+            texts[start : start + self.batch_size]
+            for start in range(0, len(texts), self.batch_size)
+        ]
+        if self.use_fast:
+            batch_ids = [self.fast_encode(batch) for batch in batches]
+            if self.verify and self.fast_tokenizer is not self.tokenizer:
+                for batch in batches:
+                    mismatches = self.mismatches(batch)
+                    if mismatches:
+                        raise ValueError(
+                            "the fast tokenizer encodes {0!r} to {2} instead of "
+                            "{1}".format(*mismatches[0])
                         )
-                else:
-                    contexts.append(
-                        "question: "
-                        + white_space_fix(gold_question)
-                        + " context: "
-                        + white_space_fix(passage)
-                        + " </s>"
-                    )
-                answers.append(white_space_fix(" and ".join(gold_answers)) + " </s>")
+        elif self.num_workers > 1 and len(batches) > 1:
+            with multiprocessing.Pool(min(self.num_workers, len(batches))) as pool:
+                batch_ids = pool.map(
+                    functools.partial(encode_without_special_tokens, self.tokenizer),
+                    batches,
+                )
+        else:
+            batch_ids = [
+                encode_without_special_tokens(self.tokenizer, batch)
+                for batch in batches
+            ]
+        return [ids for ids_of_batch in batch_ids for ids in ids_of_batch]
 
-    if for_question_generation:
-        data_df = pd.DataFrame(
+
+# The prompts are split into segments before these markers, e.g.
+# "answer: head", "<SEP> relation", "; description", "context: passage </s>".
+SEGMENT_MARKERS = re.compile(r" (?=<SEP> |; |context: )")
+
+
+class SegmentTokenizer:
+    """Tokenize the prompts as the concatenation of their segments, where
+    every unique segment is tokenized once.
+
+    The passages repeat for every candidate relation and the relation
+    descriptions for every example, so most segments are cache hits. The
+    segments are split at whitespace, which the sentencepiece tokens never
+    cross, so the ids are the ones of the whole prompt.
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.encoder = TokenizerEncoder(tokenizer)
+        self.segment_ids = {}
+
+    def __call__(self, texts, max_length=None):
+        """Return the input_ids and attention_mask of the texts, truncated
+        at the end to max_length like the tokenizer."""
+        split_texts = [SEGMENT_MARKERS.split(text) for text in texts]
+        new_segments = list(
             {
-                "passages": passages,
-                "contexts": contexts,
-                "posterier_contexts": posterier_contexts,
-                "answers": answers,
-                "entity_relations": entity_relations,
-                "entities": entities,
-                "correct_indices": correct_indices,
-                "rel_types": rel_types,
+                segment: None
+                for segments in split_texts
+                for segment in segments
+                if segment not in self.segment_ids
             }
         )
-    else:
-        data_df = pd.DataFrame(
+        if new_segments:
+            new_ids = self.encoder(new_segments)
+            self.segment_ids.update(zip(new_segments, new_ids))
+
+        input_ids = []
+        for segments in split_texts:
+            ids = [token for segment in segments for token in self.segment_ids[segment]]
+            input_ids.append(ids[:max_length])
+        return BatchEncoding(
             {
-                "passages": passages,
-                "contexts": contexts,
-                "answers": answers,
-                "entity_relations": entity_relations,
-                "entities": entities,
-                "correct_indices": correct_indices,
-                "rel_types": rel_types,
+                "input_ids": input_ids,
+                "attention_mask": [[1] * len(ids) for ids in input_ids],
             }
         )
-    if concat:
-        data_df.to_csv(
-            str(path) + ".concat.relation_data.csv", sep=",", header=True, index=False
-        )
-    elif for_question_generation:
-        data_df.to_csv(
-            str(path) + ".qq.relation_data.csv", sep=",", header=True, index=False
-        )
-    else:
-        data_df.to_csv(
-            str(path) + ".relation_data.csv", sep=",", header=True, index=False
-        )
-    return passages, contexts, posterier_contexts, answers, entity_relations, entities
 
 
-def create_zero_re_qa_gold_dataset(
-    question_tokenizer,
-    answer_tokenizer,
-    batch_size,
-    source_max_length,
-    decoder_max_length,
-    file=None,
-    concat=False,
-):
-    """Function to create the zero re qa dataset."""
-    (
-        val_passages,
-        val_contexts,
-        val_posterier_contexts,
-        val_answers,
-        val_entity_relations,
-        _,
-    ) = read_gold_re_qa_relation_data(file, concat=concat)
-
-    val_encodings = question_tokenizer(
-        val_contexts,
-        truncation=True,
-        padding="max_length",
-        max_length=source_max_length,
-        add_special_tokens=False,
-    )
-    val_answer_encodings = answer_tokenizer(
-        val_answers,
-        truncation=True,
-        padding="max_length",
-        max_length=decoder_max_length,
-        add_special_tokens=False,
-    )
+def segment_tokenizers(question_tokenizer, answer_tokenizer):
+    """Create the segment tokenizers of the question and answer modules,
+    sharing the cache if they use the same tokenizer."""
+    question_segments = SegmentTokenizer(question_tokenizer)
+    if answer_tokenizer is question_tokenizer:
+        return question_segments, question_segments
+    return question_segments, SegmentTokenizer(answer_tokenizer)
+
+
+def add_answer_segments(encodings, answer_segments, passages, entity_relations):
+    """Store the passages and entity relations of the examples, as strings
+    and as the token ids of the answer module, which
+    REQA.answer_module_input splices into the answer module inputs."""
+    passage_encodings = answer_segments(passages)
+    entity_relation_encodings = answer_segments(entity_relations)
+    encodings["passages"] = passages
+    encodings["entity_relations"] = entity_relations
+    encodings["passage_ids"] = passage_encodings["input_ids"]
+    encodings["passage_attention_mask"] = passage_encodings["attention_mask"]
+    encodings["entity_relation_ids"] = entity_relation_encodings["input_ids"]
+    encodings["entity_relation_attention_mask"] = entity_relation_encodings[
+        "attention_mask"
+    ]
 
-    val_encodings["target_attention_mask"] = val_answer_encodings.attention_mask
 
-    val_encodings["labels"] = val_answer_encodings.input_ids
+class ColumnarDataset(torch.utils.data.Dataset):
+    """Dataset of the tokenized examples where every token column is kept as
+    one flat uint16 array (the t5 vocabulary fits in uint16) with the
+    offsets and the lengths of its rows.
 
-    # because HuggingFace automatically shifts the labels, the labels correspond exactly to `target_ids`.
-    # We have to make sure that the PAD token is ignored.
+    The attention masks are not stored but derived from the lengths.
+    Indexed by a list of example indices, the dataset returns the whole
+    batch padded to its longest row, so it is used with a batch sampler
+    and batch_size=None in the DataLoader.
+    """
 
-    val_labels = [
-        [-100 if token == answer_tokenizer.pad_token_id else token for token in labels]
-        for labels in val_encodings["labels"]
-    ]
-    val_encodings["labels"] = val_labels
+    def __init__(self, encodings, pad_token_id=0):
+        self.pad_token_id = pad_token_id
+        self.strings = {}
+        self.scalars = {}
+        self.tokens = {}
+        self.lengths = {}
+        self.masks = {}
+        self.stored_keys = {}
+
+        # columns which are the same list (e.g. input_ids and
+        # entity_relation_passage_input_ids) are stored once.
+        stored_columns = {}
+        for key, values in encodings.items():
+            if key in STRING_KEYS:
+                self.strings[key] = list(values)
+            elif key in MASK_KEYS:
+                self.masks[key] = MASK_KEYS[key]
+            elif not isinstance(values[0], list):
+                self.scalars[key] = numpy.asarray(values, dtype=numpy.int32)
+            elif id(values) in stored_columns:
+                stored_key = stored_columns[id(values)]
+                self.tokens[key] = self.tokens[stored_key]
+                self.lengths[key] = self.lengths[stored_key]
+                self.stored_keys[key] = stored_key
+            else:
+                lengths = numpy.fromiter(
+                    (len(row) for row in values), dtype=numpy.int32, count=len(values)
+                )
+                offsets = numpy.zeros(len(values) + 1, dtype=numpy.int64)
+                numpy.cumsum(lengths, out=offsets[1:])
+                flat = numpy.fromiter(
+                    (token for row in values for token in row),
+                    dtype=numpy.int64,
+                    count=int(offsets[-1]),
+                )
+                if flat.size == 0 or flat.max() < 2 ** 16:
+                    flat = flat.astype(numpy.uint16)
+                else:
+                    flat = flat.astype(numpy.int32)
+                self.tokens[key] = (flat, offsets)
+                self.lengths[key] = lengths
+                self.stored_keys[key] = key
+                stored_columns[id(values)] = key
+
+        self.size = len(next(iter(encodings.values())))
+
+    def token_batch(self, key, indices):
+        """Pad the token rows of the indices for the column key."""
+        flat, offsets = self.tokens[key]
+        lengths = self.lengths[key][indices]
+        width = int(lengths.max()) if len(indices) > 0 else 0
+        positions = offsets[indices][:, None] + numpy.arange(width)[None, :]
+        valid = numpy.arange(width)[None, :] < lengths[:, None]
+        rows = numpy.where(
+            valid,
+            flat[numpy.minimum(positions, max(flat.size - 1, 0))],
+            self.pad_token_id,
+        ).astype(numpy.int64)
+        if key in LABEL_KEYS:
+            rows = mask_pad_labels(rows, self.pad_token_id)
+        return torch.from_numpy(rows), valid
+
+    def token_row(self, key, index):
+        """The tokens of the row index for the column key."""
+        flat, offsets = self.tokens[key]
+        return flat[offsets[index] : offsets[index] + self.lengths[key][index]]
+
+    def __getitem__(self, indices):
+        single = isinstance(indices, int)
+        indices = numpy.asarray([indices] if single else indices, dtype=numpy.int64)
+        batch = {}
+        token_masks = {}
+        for key in self.tokens.keys():
+            batch[key], token_masks[key] = self.token_batch(key, indices)
+        for key, token_key in self.masks.items():
+            batch[key] = torch.from_numpy(token_masks[token_key].astype(numpy.int64))
+        for key, values in self.scalars.items():
+            batch[key] = torch.from_numpy(values[indices].astype(numpy.int64))
+        for key, values in self.strings.items():
+            batch[key] = [values[index] for index in indices]
+
+        if single:
+            return {key: val[0] for key, val in batch.items()}
+        return batch
+
+    def __len__(self):
+        return self.size
+
+    def save(self, path):
+        """Write the columns as .npy files into the directory path."""
+        os.makedirs(path)
+        for key, stored_key in self.stored_keys.items():
+            if key == stored_key:
+                flat, offsets = self.tokens[key]
+                numpy.save(os.path.join(path, key + ".tokens.npy"), flat)
+                numpy.save(os.path.join(path, key + ".offsets.npy"), offsets)
+                numpy.save(os.path.join(path, key + ".lengths.npy"), self.lengths[key])
+        for key, values in self.scalars.items():
+            numpy.save(os.path.join(path, key + ".npy"), values)
+
+        columns = {
+            "size": self.size,
+            "pad_token_id": self.pad_token_id,
+            "stored_keys": self.stored_keys,
+            "masks": self.masks,
+            "scalars": list(self.scalars.keys()),
+            "strings": self.strings,
+        }
+        with open(os.path.join(path, "columns.json"), "w") as fd:
+            json.dump(columns, fd)
+
+    @classmethod
+    def load(cls, path):
+        """Open the columns written by save, memory-mapping the arrays."""
+        with open(os.path.join(path, "columns.json"), "r") as fd:
+            columns = json.load(fd)
+
+        dataset = cls.__new__(cls)
+        dataset.size = columns["size"]
+        dataset.pad_token_id = columns["pad_token_id"]
+        dataset.stored_keys = columns["stored_keys"]
+        dataset.masks = columns["masks"]
+        dataset.strings = columns["strings"]
+        dataset.scalars = {
+            key: numpy.load(os.path.join(path, key + ".npy"), mmap_mode="r")
+            for key in columns["scalars"]
+        }
+        dataset.tokens = {}
+        dataset.lengths = {}
+        for key, stored_key in dataset.stored_keys.items():
+            if stored_key not in dataset.tokens:
+                dataset.tokens[stored_key] = (
+                    numpy.load(
+                        os.path.join(path, stored_key + ".tokens.npy"), mmap_mode="r"
+                    ),
+                    numpy.load(
+                        os.path.join(path, stored_key + ".offsets.npy"), mmap_mode="r"
+                    ),
+                )
+                dataset.lengths[stored_key] = numpy.load(
+                    os.path.join(path, stored_key + ".lengths.npy"), mmap_mode="r"
+                )
+            dataset.tokens[key] = dataset.tokens[stored_key]
+            dataset.lengths[key] = dataset.lengths[stored_key]
+        return dataset
 
-    class HelperDataset(torch.utils.data.Dataset):
-        def __init__(self, encodings):
-            self.encodings = encodings
 
-        def __getitem__(self, idx):
-            row = {}
-            for key, val in self.encodings.items():
-                if key in ["passages", "entity_relations"]:
-                    row[key] = val[idx]
-                else:
-                    row[key] = torch.tensor(val[idx])
-            return row
+class CrossProductDataset(torch.utils.data.Dataset):
+    """Dataset of every (sentence, relation) pair, used to score each
+    sentence against all the candidate relations.
 
-        def __len__(self):
-            if "entity_relation_passage_input_ids" in self.encodings:
-                return len(self.encodings.entity_relation_passage_input_ids)
-            if "input_ids" in self.encodings:
-                return len(self.encodings.input_ids)
+    The token parts of the prompts are stored once per sentence and once
+    per relation, as the columns of two ColumnarDatasets. Row i pairs the
+    sentence i // R with the relation i % R, and its token columns are
+    built by concatenating the parts listed in columns, e.g.
+    {"input_ids": ([("sentence", "head"), ("relation", "relation"),
+    ("sentence", "context")], source_max_length)}.
+    """
 
-    val_dataset = HelperDataset(val_encodings)
-    val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False)
-    return val_loader, val_dataset
+    def __init__(
+        self,
+        sentences,
+        relations,
+        columns,
+        passages=None,
+        entities=None,
+        rel_types=None,
+        pad_token_id=0,
+    ):
+        self.sentences = sentences
+        self.relations = relations
+        self.columns = columns
+        self.passages = passages
+        self.entities = entities
+        self.rel_types = rel_types
+        self.pad_token_id = pad_token_id
+        self.num_relations = len(relations)
+        self.size = len(sentences) * self.num_relations
+        self.lengths = {key: self.row_lengths(key) for key in columns.keys()}
+
+    def side_indices(self, side, indices):
+        """Map the row indices to the indices of the sentences or relations."""
+        if side == "sentence":
+            return self.sentences, indices // self.num_relations
+        return self.relations, indices % self.num_relations
+
+    def row_lengths(self, key):
+        parts, max_length = self.columns[key]
+        indices = numpy.arange(self.size, dtype=numpy.int64)
+        lengths = numpy.zeros(self.size, dtype=numpy.int32)
+        for side, name in parts:
+            dataset, side_indices = self.side_indices(side, indices)
+            lengths += dataset.lengths[name][side_indices]
+        return numpy.minimum(lengths, max_length)
+
+    def token_batch(self, key, indices):
+        """Concatenate the parts of the rows and pad them for the column key."""
+        parts, max_length = self.columns[key]
+        rows = [[] for _ in indices]
+        for side, name in parts:
+            dataset, side_indices = self.side_indices(side, indices)
+            flat, offsets = dataset.tokens[name]
+            for row, index in zip(rows, side_indices):
+                row.append(flat[offsets[index] : offsets[index + 1]])
+        rows = [numpy.concatenate(row)[:max_length] for row in rows]
+
+        lengths = numpy.asarray([len(row) for row in rows], dtype=numpy.int64)
+        width = int(lengths.max()) if len(rows) > 0 else 0
+        batch = numpy.full((len(rows), width), self.pad_token_id, dtype=numpy.int64)
+        for i, row in enumerate(rows):
+            batch[i, : len(row)] = row
+        if key in LABEL_KEYS:
+            batch = mask_pad_labels(batch, self.pad_token_id)
+        valid = numpy.arange(width)[None, :] < lengths[:, None]
+        return torch.from_numpy(batch), valid
+
+    def __getitem__(self, indices):
+        single = isinstance(indices, int)
+        indices = numpy.asarray([indices] if single else indices, dtype=numpy.int64)
+        batch = {}
+        token_masks = {}
+        for key in self.columns.keys():
+            batch[key], token_masks[key] = self.token_batch(key, indices)
+        for key, token_key in MASK_KEYS.items():
+            if token_key in token_masks:
+                batch[key] = torch.from_numpy(
+                    token_masks[token_key].astype(numpy.int64)
+                )
+        if self.passages is not None:
+            sentence_indices = indices // self.num_relations
+            relation_indices = indices % self.num_relations
+            batch["passages"] = [self.passages[index] for index in sentence_indices]
+            batch["entity_relations"] = [
+                white_space_fix(self.entities[i] + " " + self.rel_types[j])
+                for i, j in zip(sentence_indices, relation_indices)
+            ]
+            # keys the offline question samples of every example.
+            batch["example_index"] = torch.from_numpy(indices)
+
+        if single:
+            return {key: val[0] for key, val in batch.items()}
+        return batch
+
+    def __len__(self):
+        return self.size
+
+    def save(self, path):
+        """Write the sentence and relation parts into the directory path."""
+        os.makedirs(path)
+        self.sentences.save(os.path.join(path, "sentences"))
+        self.relations.save(os.path.join(path, "relations"))
+        columns = {
+            "columns": self.columns,
+            "passages": self.passages,
+            "entities": self.entities,
+            "rel_types": self.rel_types,
+            "pad_token_id": self.pad_token_id,
+        }
+        with open(os.path.join(path, "cross_product.json"), "w") as fd:
+            json.dump(columns, fd)
+
+    @classmethod
+    def load(cls, path):
+        """Open the parts written by save, memory-mapping the arrays."""
+        with open(os.path.join(path, "cross_product.json"), "r") as fd:
+            columns = json.load(fd)
+        return cls(
+            ColumnarDataset.load(os.path.join(path, "sentences")),
+            ColumnarDataset.load(os.path.join(path, "relations")),
+            {
+                key: ([tuple(part) for part in parts], max_length)
+                for key, (parts, max_length) in columns["columns"].items()
+            },
+            passages=columns["passages"],
+            entities=columns["entities"],
+            rel_types=columns["rel_types"],
+            pad_token_id=columns["pad_token_id"],
+        )
 
 
-def read_zero_re_qa(path, ignore_unknowns=False, gold_question=False, concat=False, only_unknowns=False):
-    """Main function to read the zero re qa dataset."""
-    path = Path(path)
+def load_dataset(path):
+    """Open a dataset written by ColumnarDataset.save or
+    CrossProductDataset.save."""
+    if os.path.exists(os.path.join(path, "cross_product.json")):
+        return CrossProductDataset.load(path)
+    return ColumnarDataset.load(path)
 
-    label_to_desc = {}
-    with open("./relation_descriptions.json", "r") as fd:
-        re_desc_data = json.load(fd)
-        for row in re_desc_data:
-            re_label = row["relation_label"]
-            label_to_desc[re_label] = row["relation_description"]
 
-    with open(path, "r") as fd:
-        uniq_relations = set()
-        for line in fd:
-            line = line.strip()
-            line_arr = line.split("\t")
-            uniq_relations.add(white_space_fix(line_arr[0]))
+def write_shards(path, datasets):
+    """Save the ColumnarDatasets as the shards of a ShardedDataset in the
+    directory path, one after another, so only one shard is in memory.
 
-        relation_to_id = {}
-        i = 0
-        for rel in uniq_relations:
-            relation_to_id[rel] = i
-            i += 1
-        id_to_relation = {id: rel for rel, id in relation_to_id.items()}
+    The directory is renamed into place once complete.
+    """
+    tmp_path = "{0}.tmp-{1}".format(path, os.getpid())
+    os.makedirs(tmp_path)
+    shards = []
+    sizes = []
+    for dataset in datasets:
+        name = "shard-{0:05d}".format(len(shards))
+        dataset.save(os.path.join(tmp_path, name))
+        shards.append(name)
+        sizes.append(len(dataset))
+    with open(os.path.join(tmp_path, "shards.json"), "w") as fd:
+        json.dump({"shards": shards, "sizes": sizes}, fd)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # another run has written the same shards.
+        shutil.rmtree(tmp_path)
+
+
+class ShardedDataset(torch.utils.data.IterableDataset):
+    """Stream the padded batches of the shards written by write_shards, for
+    the corpora which do not fit in memory.
+
+    The shards are memory-mapped and read one after another. With
+    shuffle, the shard order changes every epoch and the examples go
+    through a shuffle buffer of buffer_size examples. Every DataLoader
+    worker of every distributed rank reads its own contiguous range of
+    the examples in the shard order. Like DistributedSampler, the ranges
+    have the same length: the last ones wrap around to the first
+    examples, so every rank yields the same number of batches. Every
+    iteration moves to the next epoch, set_epoch sets it like
+    DistributedSampler.set_epoch.
+    """
 
-    contexts = []
-    posterier_contexts = []
-    answers = []
-    passages = []
+    def __init__(
+        self,
+        path,
+        batch_size,
+        shuffle=False,
+        buffer_size=10000,
+        seed=None,
+        rank=None,
+        world_size=None,
+        num_workers=0,
+    ):
+        with open(os.path.join(path, "shards.json"), "r") as fd:
+            shards = json.load(fd)
+        self.shard_paths = [os.path.join(path, name) for name in shards["shards"]]
+        self.shard_sizes = shards["sizes"]
+        self.size = sum(self.shard_sizes)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        # follows the seed of set_random_seed.
+        self.seed = random.randrange(2 ** 31) if seed is None else seed
+        if rank is None:
+            distributed = (
+                torch.distributed.is_available() and torch.distributed.is_initialized()
+            )
+            rank = torch.distributed.get_rank() if distributed else 0
+            world_size = torch.distributed.get_world_size() if distributed else 1
+        self.rank = rank
+        self.world_size = world_size
+        self.num_workers = num_workers
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def reader_size(self):
+        """The number of examples read by every worker of every rank."""
+        num_readers = self.world_size * max(self.num_workers, 1)
+        return math.ceil(self.size / num_readers)
+
+    def reader_parts(self):
+        """Find the (shard index, first example, end example) parts of the
+        shards read by this worker, and its random generator."""
+        worker = torch.utils.data.get_worker_info()
+        num_workers = 1 if worker is None else worker.num_workers
+        worker_id = 0 if worker is None else worker.id
+        reader = self.rank * num_workers + worker_id
+        reader_size = math.ceil(self.size / (self.world_size * num_workers))
+
+        order = list(range(len(self.shard_paths)))
+        if self.shuffle:
+            random.Random("{0}-{1}".format(self.seed, self.epoch)).shuffle(order)
+        rng = random.Random("{0}-{1}-{2}".format(self.seed, self.epoch, reader))
+
+        # the first example of every shard in the shard order.
+        starts = numpy.cumsum([0] + [self.shard_sizes[shard] for shard in order])
+        parts = []
+        position = reader * reader_size
+        end = position + reader_size
+        while position < end and self.size > 0:
+            start = position % self.size
+            stop = min(self.size, start + end - position)
+            for k, shard in enumerate(order):
+                first = max(start, int(starts[k]))
+                last = min(stop, int(starts[k + 1]))
+                if first < last:
+                    parts.append(
+                        (shard, first - int(starts[k]), last - int(starts[k]))
+                    )
+            position += stop - start
+        return parts, rng
+
+    def examples(self, parts, rng):
+        """Yield the (shard, index) examples of the parts."""
+        buffer = []
+        for shard_index, first, last in parts:
+            shard = ColumnarDataset.load(self.shard_paths[shard_index])
+            for index in range(first, last):
+                if not self.shuffle:
+                    yield shard, index
+                elif len(buffer) < self.buffer_size:
+                    buffer.append((shard, index))
+                else:
+                    position = rng.randrange(len(buffer))
+                    yield buffer[position]
+                    buffer[position] = (shard, index)
+        rng.shuffle(buffer)
+        for example in buffer:
+            yield example
+
+    def make_batch(self, examples):
+        """Pad the examples, which may come from different shards, into one
+        batch like ColumnarDataset.__getitem__."""
+        shard = examples[0][0]
+        batch = {}
+        token_masks = {}
+        for key in shard.tokens.keys():
+            rows = [
+                example_shard.token_row(key, index)
+                for example_shard, index in examples
+            ]
+            lengths = numpy.asarray([len(row) for row in rows], dtype=numpy.int64)
+            width = int(lengths.max())
+            padded = numpy.full(
+                (len(rows), width), shard.pad_token_id, dtype=numpy.int64
+            )
+            for position, row in enumerate(rows):
+                padded[position, : len(row)] = row
+            if key in LABEL_KEYS:
+                padded = mask_pad_labels(padded, shard.pad_token_id)
+            batch[key] = torch.from_numpy(padded)
+            token_masks[key] = numpy.arange(width)[None, :] < lengths[:, None]
+        for key, token_key in shard.masks.items():
+            batch[key] = torch.from_numpy(token_masks[token_key].astype(numpy.int64))
+        for key in shard.scalars.keys():
+            batch[key] = torch.tensor(
+                [
+                    int(example_shard.scalars[key][index])
+                    for example_shard, index in examples
+                ],
+                dtype=torch.int64,
+            )
+        for key in shard.strings.keys():
+            batch[key] = [
+                example_shard.strings[key][index] for example_shard, index in examples
+            ]
+        return batch
+
+    def batches(self, examples):
+        batch = []
+        for example in examples:
+            batch.append(example)
+            if len(batch) == self.batch_size:
+                yield self.make_batch(batch)
+                batch = []
+        if batch:
+            yield self.make_batch(batch)
+
+    def __iter__(self):
+        parts, rng = self.reader_parts()
+        # without workers, the next epoch reads another order.
+        self.epoch += 1
+        return self.batches(self.examples(parts, rng))
+
+    def __len__(self):
+        """The number of batches of this rank, where every worker yields its
+        own last partial batch."""
+        return max(self.num_workers, 1) * math.ceil(
+            self.reader_size() / self.batch_size
+        )
+
+
+def create_sharded_loader(dataset):
+    """Create the data loader of the batches streamed by the
+    ShardedDataset, on its num_workers workers.
+
+    The workers are persistent, so their copies of the dataset move to
+    the next epoch like the dataset does without workers.
+    """
+    return DataLoader(
+        dataset,
+        batch_size=None,
+        num_workers=dataset.num_workers,
+        persistent_workers=dataset.num_workers > 0,
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def content_digest(file_path, size, mtime_ns):
+    """The sha1 of the file content, for one version of the file."""
+    digest = hashlib.sha1()
+    with open(file_path, "rb") as fd:
+        for chunk in iter(lambda: fd.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_digest(file_path):
+    """The sha1 of the file content. A file is only read again when its size
+    or modification time changed."""
+    stat = os.stat(file_path)
+    return content_digest(os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+
+
+def run_stage(cache_dir, name, run, inputs=(), params=(), outputs=()):
+    """Run a data preparation stage, or reuse its outputs.
+
+    run(output_dir) writes the output files of the stage in output_dir.
+    They are kept in cache_dir/name/<key>, where the key hashes the content
+    of the input files and the params, so a stage only runs again when one
+    of them changed. The outputs of a stage can be the inputs of the next
+    one. Without a cache_dir the stage always runs, in the current
+    directory.
+
+    Returns the paths of the outputs.
+    """
+    if cache_dir is None:
+        run(".")
+        return [os.path.join(".", output) for output in outputs]
+
+    key = hashlib.sha1(name.encode("utf-8"))
+    for file_path in inputs:
+        key.update(file_digest(file_path).encode("utf-8"))
+    key.update(repr(params).encode("utf-8"))
+    stage_path = os.path.join(cache_dir, name, key.hexdigest())
+    if not os.path.exists(stage_path):
+        tmp_path = "{0}.tmp-{1}".format(stage_path, os.getpid())
+        os.makedirs(tmp_path)
+        try:
+            run(tmp_path)
+        except BaseException:
+            shutil.rmtree(tmp_path)
+            raise
+        try:
+            os.rename(tmp_path, stage_path)
+        except OSError:
+            # another run has written the same stage.
+            shutil.rmtree(tmp_path)
+    return [os.path.join(stage_path, output) for output in outputs]
+
+
+def split_outputs(seeds):
+    """The train, val and test files written for the seeds."""
+    return [
+        split + "_data_" + str(seed) + ".csv"
+        for seed in seeds
+        for split in ["train", "val", "test"]
+    ]
+
+
+def seed_split_paths(paths, seeds, seed):
+    """The train, val and test paths of the seed in the split_outputs."""
+    index = 3 * list(seeds).index(seed)
+    return paths[index : index + 3]
+
+
+def prepare_fewrl_data(
+    cache_dir, fewrel_path, seed, m=5, sample_dev=False, seeds=None
+):
+    """Write the train, val and test files of the seed split of the fewrel
+    file with read_fewrl_dataset, through run_stage.
+
+    With seeds, the splits of all the seeds are written together by
+    read_fewrl_dataset_seeds, on a process per seed. With sample_dev, the
+    val file is replaced by its sample_dev_rows. Returns the paths of the
+    train, dev and test files of the seed.
+    """
+    if seeds is None:
+        seeds = [seed]
+        params = (seed, m)
+
+        def run(output_dir):
+            read_fewrl_dataset(fewrel_path, seed=seed, m=m, output_dir=output_dir)
+
+    else:
+        seeds = list(dict.fromkeys(list(seeds) + [seed]))
+        params = (tuple(seeds), m)
+
+        def run(output_dir):
+            read_fewrl_dataset_seeds(
+                fewrel_path,
+                seeds,
+                m=m,
+                num_workers=min(len(seeds), os.cpu_count()),
+                output_dir=output_dir,
+            )
+
+    paths = run_stage(
+        cache_dir,
+        "fewrl_split",
+        run,
+        inputs=[fewrel_path, REPO_DIR / "relation_descriptions.json"],
+        params=params,
+        outputs=split_outputs(seeds),
+    )
+    paths = seed_split_paths(paths, seeds, seed)
+    if sample_dev:
+        paths[1] = run_sampled_dev_stage(cache_dir, paths[1])
+    return paths
+
+
+def prepare_wikizsl_data(
+    cache_dir, zsl_path, seed, m=5, add_negs=False, sample_dev=False, seeds=None
+):
+    """Write the train, val and test files of the seed split of the wikizsl
+    file with read_wikizsl_dataset, through run_stage.
+
+    With seeds, the splits of all the seeds are written together by
+    read_wikizsl_dataset_seeds, on a process per seed. With sample_dev,
+    the val file is replaced by its sample_dev_rows. Returns the paths of
+    the train, dev and test files of the seed.
+    """
+    if seeds is None:
+        seeds = [seed]
+        params = (seed, m, add_negs)
+
+        def run(output_dir):
+            read_wikizsl_dataset(
+                zsl_path, seed=seed, m=m, add_negs=add_negs, output_dir=output_dir
+            )
+
+    else:
+        seeds = list(dict.fromkeys(list(seeds) + [seed]))
+        params = (tuple(seeds), m, add_negs)
+
+        def run(output_dir):
+            read_wikizsl_dataset_seeds(
+                zsl_path,
+                seeds,
+                m=m,
+                add_negs=add_negs,
+                num_workers=min(len(seeds), os.cpu_count()),
+                output_dir=output_dir,
+            )
+
+    paths = run_stage(
+        cache_dir,
+        "wikizsl_split",
+        run,
+        inputs=[zsl_path, REPO_DIR / "relation_descriptions.json"],
+        params=params,
+        outputs=split_outputs(seeds),
+    )
+    paths = seed_split_paths(paths, seeds, seed)
+    if sample_dev:
+        paths[1] = run_sampled_dev_stage(cache_dir, paths[1])
+    return paths
+
+
+def run_sampled_dev_stage(cache_dir, dev_path):
+    """Sample the rows of the dev file with sample_dev_rows, through
+    run_stage."""
+    output = os.path.basename(dev_path) + ".sampled.csv"
+    return run_stage(
+        cache_dir,
+        "sampled_dev",
+        lambda output_dir: sample_dev_rows(
+            dev_path, output_path=os.path.join(output_dir, output)
+        ),
+        inputs=[dev_path],
+        outputs=[output],
+    )[0]
+
+
+# Changes with the columns of the tokenized datasets, so the older caches
+# are not read.
+DATASET_CACHE_VERSION = 2
+
+
+def dataset_cache_path(cache_dir, file_paths, tokenizers, *params):
+    """Find the cache directory of the tokenized datasets, keyed by the
+    content of the input files, the tokenizers and the other
+    parameters of the dataset creation.
+
+    Returns None without a cache_dir.
+    """
+    if cache_dir is None:
+        return None
+
+    key = hashlib.sha1(str(DATASET_CACHE_VERSION).encode("utf-8"))
+    for file_path in file_paths:
+        if file_path is None:
+            key.update(b"<none>")
+            continue
+        key.update(file_digest(file_path).encode("utf-8"))
+    for tokenizer in tokenizers:
+        key.update(
+            "{0}|{1}|{2}".format(
+                type(tokenizer).__name__, tokenizer.name_or_path, len(tokenizer)
+            ).encode("utf-8")
+        )
+    key.update(repr(params).encode("utf-8"))
+    return os.path.join(cache_dir, key.hexdigest())
+
+
+def load_cached_datasets(cache_path, names):
+    """Open the cached datasets with the given names, or return None if they
+    are not in the cache."""
+    if cache_path is None or not os.path.exists(cache_path):
+        return None
+    return [
+        load_dataset(os.path.join(cache_path, name))
+        if os.path.exists(os.path.join(cache_path, name))
+        else None
+        for name in names
+    ]
+
+
+def save_cached_datasets(cache_path, names, datasets):
+    """Write the datasets to the cache. The directory is renamed into place
+    once complete, so concurrent runs never read a partial cache."""
+    if cache_path is None:
+        return
+    tmp_path = "{0}.tmp-{1}".format(cache_path, os.getpid())
+    os.makedirs(tmp_path)
+    for name, dataset in zip(names, datasets):
+        if dataset is not None:
+            dataset.save(os.path.join(tmp_path, name))
+    try:
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        # another run has written the same cache.
+        shutil.rmtree(tmp_path)
+
+
+class TokenBudgetBatchSampler(torch.utils.data.Sampler):
+    """Group the examples of similar length into batches, so that every batch
+    padded to its longest example has at most max_tokens tokens.
+
+    With shuffle, the examples are sorted within random buckets of
+    bucket_size examples and the batches are visited in random order.
+    The batches of the last pass are kept in self.batches.
+    """
+
+    def __init__(self, lengths, max_tokens, shuffle=False, bucket_size=1024):
+        self.lengths = lengths
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size if shuffle else len(lengths)
+        self.batches = self.make_batches()
+
+    def make_batches(self):
+        indices = list(range(len(self.lengths)))
+        if self.shuffle:
+            random.shuffle(indices)
+
+        batches = []
+        for start in range(0, len(indices), max(self.bucket_size, 1)):
+            bucket = sorted(
+                indices[start : start + self.bucket_size],
+                key=lambda index: self.lengths[index],
+            )
+            batch = []
+            batch_max_length = 0
+            for index in bucket:
+                max_length = max(batch_max_length, self.lengths[index])
+                if batch and max_length * (len(batch) + 1) > self.max_tokens:
+                    batches.append(batch)
+                    batch = []
+                    max_length = self.lengths[index]
+                batch.append(index)
+                batch_max_length = max_length
+            if batch:
+                batches.append(batch)
+
+        if self.shuffle:
+            random.shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        # not a generator, so the batches are known once the loader starts.
+        self.batches = self.make_batches()
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def create_loader(
+    dataset, batch_size, shuffle=False, max_tokens=None, length_key="input_ids"
+):
+    """Create the data loader which reads whole padded batches from the
+    ColumnarDataset.
+
+    If max_tokens is given, the examples are batched by the length of
+    their length_key tokens to fill the max_tokens budget, otherwise
+    batch_size examples are used per batch.
+    """
+    if max_tokens is None:
+        if shuffle:
+            sampler = torch.utils.data.RandomSampler(dataset)
+        else:
+            sampler = torch.utils.data.SequentialSampler(dataset)
+        batch_sampler = torch.utils.data.BatchSampler(
+            sampler, batch_size=batch_size, drop_last=False
+        )
+    else:
+        batch_sampler = TokenBudgetBatchSampler(
+            dataset.lengths[length_key], max_tokens, shuffle=shuffle
+        )
+    return DataLoader(dataset, sampler=batch_sampler, batch_size=None)
+
+
+def predictions_in_dataset_order(dataloader, predict_batch):
+    """Yield the prediction rows of predict_batch over the dataloader in the
+    order of the dataset, also when the token budget sampler has
+    reordered the examples.
+
+    Every example of a batch must give the same number of rows.
+    """
+    batches = iter(dataloader)
+    batch_sampler = dataloader.sampler
+    if not isinstance(batch_sampler, TokenBudgetBatchSampler):
+        for batch in batches:
+            for row in predict_batch(batch):
+                yield row
+        return
+
+    example_rows = {}
+    for indices, batch in zip(batch_sampler.batches, batches):
+        rows = list(predict_batch(batch))
+        rows_per_example = len(rows) // len(indices)
+        for i, index in enumerate(indices):
+            example_rows[index] = rows[
+                i * rows_per_example : (i + 1) * rows_per_example
+            ]
+
+    for index in sorted(example_rows.keys()):
+        for row in example_rows[index]:
+            yield row
+
+
+def macro_prf(predicted_ids, gold_ids):
+    """The macro precision, recall and f1 of the predicted relation indices,
+    following Sorokin and Gurevych (2017) as in relation-eval.ipynb."""
+    relation_set = set(gold_ids.tolist())
+    avg_prec = 0.0
+    avg_rec = 0.0
+    for relation in relation_set:
+        predicted = predicted_ids == relation
+        tp = int(numpy.sum(gold_ids[predicted] == relation))
+        tp_fp = int(numpy.sum(predicted))
+        tp_fn = int(numpy.sum(gold_ids == relation))
+        avg_prec += tp / tp_fp if tp_fp > 0 else 0.0
+        avg_rec += tp / tp_fn
+    avg_prec = avg_prec / len(set(predicted_ids.tolist()))
+    avg_rec = avg_rec / len(relation_set)
+    f1 = 0.0
+    if avg_prec + avg_rec > 0:
+        f1 = 2.0 * avg_prec * avg_rec / (avg_prec + avg_rec)
+    return avg_prec, avg_rec, f1
+
+
+def relation_gold_ids(actual_ids, entity_relations):
+    """The index of the actual relation of every example among its candidate
+    relations, given the actual_ids and the entity_relations of the rows of
+    the fewrl or wikizsl dev or test split.
+
+    Every example has one row per candidate relation, in the order of the
+    relations of the first example. This is the shuffled order of the split's
+    relation ids, which the wikizsl rows do not follow, as in
+    relation-eval.ipynb.
+    """
+    labels = [
+        entity_relation.rsplit("<SEP>", 1)[1].strip()
+        for entity_relation in entity_relations
+    ]
+    num_relations = len(labels)
+    if labels[0] in labels[1:]:
+        num_relations = labels.index(labels[0], 1)
+    relation_index = {label: i for i, label in enumerate(labels[:num_relations])}
+    id_to_label = relation_catalog().id_to_label
+    return numpy.asarray(
+        [
+            relation_index[white_space_fix(id_to_label[r_id])]
+            for r_id in actual_ids[::num_relations]
+        ]
+    )
+
+
+def read_relation_gold_ids(csv_path):
+    """The relation_gold_ids of the dev or test split in csv_path."""
+    data = read_offmml_data(csv_path, ["actual_ids", "entity_relations"])
+    return relation_gold_ids(data["actual_ids"], data["entity_relations"])
+
+
+def relation_f1(log_ps, gold_ids, num_samples=1):
+    """The macro f1 of the relations predicted on the fewrl or wikizsl dev or
+    test split, given the log probability of every row and the
+    relation_gold_ids of the examples.
+
+    Every example has one row per candidate relation, and the probabilities
+    of the num_samples log_ps of every row are averaged.
+    """
+    log_ps = numpy.reshape(
+        numpy.asarray(log_ps, dtype=numpy.float64), (len(gold_ids), -1, num_samples)
+    )
+    max_log_ps = numpy.max(log_ps, axis=2, keepdims=True)
+    log_ps = max_log_ps[:, :, 0] + numpy.log(
+        numpy.mean(numpy.exp(log_ps - max_log_ps), axis=2)
+    )
+    return macro_prf(numpy.argmax(log_ps, axis=1), gold_ids)[2]
+
+
+def evaluate_relation_f1(
+    dataloader, predict_batch, gold_ids, log_p_key="relation_log_p", num_samples=1
+):
+    """Predict the rows of the dataloader with predict_batch and compute the
+    relation_f1 of their log_p_key values."""
+    log_ps = [
+        row[log_p_key]
+        for row in predictions_in_dataset_order(dataloader, predict_batch)
+    ]
+    return relation_f1(log_ps, gold_ids, num_samples=num_samples)
+
+
+def create_relation_data_dataset(
+    question_tokenizer,
+    answer_tokenizer,
+    path,
+    source_max_length,
+    decoder_max_length,
+    concat=False,
+    for_question_generation=False,
+    write_relation_data=False,
+):
+    """Create the CrossProductDataset pairing every sentence of the split
+    with every relation, for relation classification considering all the
+    data and gold_templates.
+
+    With write_relation_data, the rows are also written out to the
+    .relation_data.csv side file.
+    """
+    label_to_desc = relation_catalog().label_to_desc
+
+    rows, all_relations = read_gold_re_qa_relation_data(path)
+    rel_types = list(all_relations.keys())
+    if for_question_generation:
+        # the prompts need the description of the relation.
+        rel_types = [rel_type for rel_type in rel_types if rel_type in label_to_desc]
+
+    passages = [line_arr[3] for line_arr in rows]
+    entities = [white_space_fix(line_arr[2]) for line_arr in rows]
+    answers = [white_space_fix(" and ".join(line_arr[4:])) for line_arr in rows]
+    contexts = [
+        "context: " + white_space_fix(passage) + " </s>" for passage in passages
+    ]
+
+    # parts of the prompts, tokenized by the question or the answer module.
+    sentence_texts = {
+        "context": (contexts, "question"),
+        "target": ([answer + " </s>" for answer in answers], "answer"),
+    }
+    if for_question_generation:
+        sentence_texts["head"] = (
+            ["answer: " + entity for entity in entities],
+            "question",
+        )
+        sentence_texts["answer"] = (answers, "question")
+        sentence_texts["entity"] = (entities, "question")
+        # the passages and entity relations spliced into the answer module
+        # inputs, see add_answer_segments.
+        sentence_texts["answer_passage"] = (passages, "answer")
+        sentence_texts["answer_entity"] = (entities, "answer")
+        relation_texts = {
+            "relation": (
+                [
+                    "<SEP> "
+                    + white_space_fix(rel_type)
+                    + " ; "
+                    + label_to_desc[rel_type]
+                    for rel_type in rel_types
+                ],
+                "question",
+            ),
+            "answer_relation": (
+                [white_space_fix(rel_type) for rel_type in rel_types],
+                "answer",
+            ),
+        }
+        input_parts = [
+            ("sentence", "head"),
+            ("relation", "relation"),
+            ("sentence", "context"),
+        ]
+        target_parts = ([("sentence", "target")], decoder_max_length)
+        columns = {
+            "input_ids": (input_parts, source_max_length),
+            "entity_relation_passage_input_ids": (input_parts, source_max_length),
+            "posterier_input_ids": (
+                input_parts[:2] + [("sentence", "answer")] + input_parts[2:],
+                source_max_length,
+            ),
+            "entity_input_ids": ([("sentence", "entity")], decoder_max_length),
+            "labels": target_parts,
+            "second_entity_labels": target_parts,
+            "passage_ids": ([("sentence", "answer_passage")], source_max_length),
+            "entity_relation_ids": (
+                [("sentence", "answer_entity"), ("relation", "answer_relation")],
+                source_max_length,
+            ),
+        }
+        csv_columns = {
+            "contexts": input_parts,
+            "posterier_contexts": columns["posterier_input_ids"][0],
+        }
+    elif concat:
+        sentence_texts["head"] = (
+            ["question: " + entity for entity in entities],
+            "question",
+        )
+        relation_texts = {
+            "relation": (
+                ["<SEP> " + white_space_fix(rel_type) for rel_type in rel_types],
+                "question",
+            )
+        }
+        input_parts = [
+            ("sentence", "head"),
+            ("relation", "relation"),
+            ("sentence", "context"),
+        ]
+        columns = {
+            "input_ids": (input_parts, source_max_length),
+            "labels": ([("sentence", "target")], decoder_max_length),
+        }
+        csv_columns = {"contexts": input_parts}
+    else:
+        # the gold template of the relation around the head entity, from
+        # gold_template.replace("XXX", " " + head + " ").
+        templates = [
+            next(iter(all_relations[rel_type])).split("XXX", 1) + [""]
+            for rel_type in rel_types
+        ]
+        sentence_texts["entity"] = (entities, "question")
+        relation_texts = {
+            "question_prefix": (
+                [white_space_fix("question: " + template[0]) for template in templates],
+                "question",
+            ),
+            "question_suffix": (
+                [white_space_fix(template[1]) for template in templates],
+                "question",
+            ),
+        }
+        input_parts = [
+            ("relation", "question_prefix"),
+            ("sentence", "entity"),
+            ("relation", "question_suffix"),
+            ("sentence", "context"),
+        ]
+        columns = {
+            "input_ids": (input_parts, source_max_length),
+            "labels": ([("sentence", "target")], decoder_max_length),
+        }
+        csv_columns = {"contexts": input_parts}
+
+    segments = dict(
+        zip(
+            ["question", "answer"],
+            segment_tokenizers(question_tokenizer, answer_tokenizer),
+        )
+    )
+    sentences = ColumnarDataset(
+        {
+            name: segments[module](texts)["input_ids"]
+            for name, (texts, module) in sentence_texts.items()
+        }
+    )
+    relations = ColumnarDataset(
+        {
+            name: segments[module](texts)["input_ids"]
+            for name, (texts, module) in relation_texts.items()
+        }
+    )
+    dataset = CrossProductDataset(
+        sentences,
+        relations,
+        columns,
+        passages=passages if for_question_generation else None,
+        entities=entities if for_question_generation else None,
+        rel_types=rel_types if for_question_generation else None,
+        pad_token_id=question_tokenizer.pad_token_id,
+    )
+
+    if write_relation_data:
+        texts = {"sentence": sentence_texts, "relation": relation_texts}
+
+        def prompts(parts):
+            return [
+                white_space_fix(
+                    " ".join(
+                        texts[side][name][0][i if side == "sentence" else j]
+                        for side, name in parts
+                    )
+                )
+                for i in range(len(rows))
+                for j in range(len(rel_types))
+            ]
+
+        data = {
+            "passages": [passage for passage in passages for _ in rel_types],
+        }
+        for key, parts in csv_columns.items():
+            data[key] = prompts(parts)
+        data["answers"] = [answer + " </s>" for answer in answers for _ in rel_types]
+        data["entity_relations"] = [
+            white_space_fix(entity + " " + rel_type)
+            for entity in entities
+            for rel_type in rel_types
+        ]
+        data["entities"] = [entity for entity in entities for _ in rel_types]
+        data["correct_indices"] = [
+            rel_type == line_arr[0] for line_arr in rows for rel_type in rel_types
+        ]
+        data["rel_types"] = [rel_type for _ in rows for rel_type in rel_types]
+        if concat:
+            suffix = ".concat.relation_data.csv"
+        elif for_question_generation:
+            suffix = ".qq.relation_data.csv"
+        else:
+            suffix = ".relation_data.csv"
+        pd.DataFrame(data).to_csv(str(path) + suffix, sep=",", header=True, index=False)
+
+    return dataset
+
+
+def create_zero_re_qa_gold_dataset(
+    question_tokenizer,
+    answer_tokenizer,
+    batch_size,
+    source_max_length,
+    decoder_max_length,
+    file=None,
+    concat=False,
+    max_tokens=None,
+    write_relation_data=False,
+):
+    """Function to create the zero re qa dataset."""
+    val_dataset = create_relation_data_dataset(
+        question_tokenizer,
+        answer_tokenizer,
+        file,
+        source_max_length,
+        decoder_max_length,
+        concat=concat,
+        write_relation_data=write_relation_data,
+    )
+    val_loader = create_loader(val_dataset, batch_size, max_tokens=max_tokens)
+    return val_loader, val_dataset
+
+
+def read_zero_re_qa(path, ignore_unknowns=False, gold_question=False, concat=False, only_unknowns=False):
+    """Main function to read the zero re qa dataset."""
+    path = Path(path)
+
+    label_to_desc = relation_catalog().label_to_desc
+
+    with open(path, "r") as fd:
+        uniq_relations = set()
+        for line in fd:
+            line = line.strip()
+            line_arr = line.split("\t")
+            uniq_relations.add(white_space_fix(line_arr[0]))
+
+        relation_to_id = {}
+        i = 0
+        for rel in uniq_relations:
+            relation_to_id[rel] = i
+            i += 1
+        id_to_relation = {id: rel for rel, id in relation_to_id.items()}
+
+    contexts = []
+    posterier_contexts = []
+    answers = []
+    passages = []
     entities = []
     entity_relations = []
     relations = []
@@ -987,6 +2725,7 @@ def create_prompt_zero_re_qa_dataset(
     decoder_max_length,
     file_path=None,
     for_evaluation=False,
+    max_tokens=None,
 ):
     """Function to create the prompt-based zero re qa dataset."""
 
@@ -994,61 +2733,23 @@ def create_prompt_zero_re_qa_dataset(
     data_contexts = data_df["contexts"].tolist()
     data_answers = data_df["answers"].tolist()
 
-    encodings = tokenizer(
-        data_contexts,
-        truncation=True,
-        padding="max_length",
-        max_length=source_max_length,
-        add_special_tokens=False,
-    )
-    answer_encodings = tokenizer(
-        data_answers,
-        truncation=True,
-        padding="max_length",
-        max_length=decoder_max_length,
-        add_special_tokens=False,
-    )
+    prompt_segments, _ = segment_tokenizers(tokenizer, tokenizer)
+    encodings = prompt_segments(data_contexts, max_length=source_max_length)
+    answer_encodings = prompt_segments(data_answers, max_length=decoder_max_length)
     encodings["target_attention_mask"] = answer_encodings.attention_mask
     encodings["labels"] = answer_encodings.input_ids
 
-    # because HuggingFace automatically shifts the labels, the labels correspond exactly to `target_ids`.
-    # We have to make sure that the PAD token is ignored
-    labels = [
-        [
-            -100 if token == tokenizer.pad_token_id else token
-            for token in labels
-        ]
-        for labels in encodings["labels"]
-    ]
-    encodings["labels"] = labels
-
-    class HelperDataset(torch.utils.data.Dataset):
-        def __init__(self, encodings):
-            self.encodings = encodings
-
-        def __getitem__(self, idx):
-            row = {}
-            for key, val in self.encodings.items():
-                row[key] = torch.tensor(val[idx])
-            return row
-
-        def __len__(self):
-            if "input_ids" in self.encodings:
-                return len(self.encodings.input_ids)
-
     loader = None
-    dataset = HelperDataset(encodings)
-    if not for_evaluation:
-        loader = DataLoader(dataset, batch_size=batch_size, shuffle=True)
-    else:
-        loader = DataLoader(dataset, batch_size=batch_size, shuffle=False)
+    dataset = ColumnarDataset(encodings)
+    loader = create_loader(
+        dataset, batch_size, shuffle=not for_evaluation, max_tokens=max_tokens
+    )
     return loader, dataset
 
 
-def create_zero_re_qa_dataset(
+def tokenize_zero_re_qa_dataset(
     question_tokenizer,
     answer_tokenizer,
-    batch_size,
     source_max_length,
     decoder_max_length,
     train_file=None,
@@ -1058,7 +2759,8 @@ def create_zero_re_qa_dataset(
     gold_questions=False,
     for_evaluation=False,
 ):
-    """Function to create the zero re qa dataset."""
+    """Read and tokenize the train and dev files of the zero re qa
+    dataset."""
     if not for_evaluation:
         (
             train_passages,
@@ -1089,51 +2791,26 @@ def create_zero_re_qa_dataset(
         concat=concat,
     )
 
-    val_encodings = question_tokenizer(
-        val_contexts,
-        truncation=True,
-        padding="max_length",
-        max_length=source_max_length,
-        add_special_tokens=False,
-    )
-    val_answer_encodings = answer_tokenizer(
-        val_answers,
-        truncation=True,
-        padding="max_length",
-        max_length=decoder_max_length,
-        add_special_tokens=False,
+    question_segments, answer_segments = segment_tokenizers(
+        question_tokenizer, answer_tokenizer
     )
+    val_encodings = question_segments(val_contexts, max_length=source_max_length)
+    val_answer_encodings = answer_segments(val_answers, max_length=decoder_max_length)
 
     if not for_evaluation:
-        train_encodings = question_tokenizer(
-            train_contexts,
-            truncation=True,
-            padding="max_length",
-            max_length=source_max_length,
-            add_special_tokens=False,
+        train_encodings = question_segments(
+            train_contexts, max_length=source_max_length
         )
-        train_answer_encodings = answer_tokenizer(
-            train_answers,
-            truncation=True,
-            padding="max_length",
-            max_length=decoder_max_length,
-            add_special_tokens=False,
+        train_answer_encodings = answer_segments(
+            train_answers, max_length=decoder_max_length
         )
-        train_entity_encodings = question_tokenizer(
-            train_entities,
-            truncation=True,
-            padding="max_length",
-            max_length=decoder_max_length,
-            add_special_tokens=False,
+        train_entity_encodings = question_segments(
+            train_entities, max_length=decoder_max_length
         )
 
         if not (gold_questions or concat):
-            train_posterier_encodings = question_tokenizer(
-                train_posterier_contexts,
-                truncation=True,
-                padding="max_length",
-                max_length=source_max_length,
-                add_special_tokens=False,
+            train_posterier_encodings = question_segments(
+                train_posterier_contexts, max_length=source_max_length
             )
 
     if gold_questions or concat:
@@ -1145,38 +2822,15 @@ def create_zero_re_qa_dataset(
 
             train_encodings["labels"] = train_answer_encodings.input_ids
 
-            # because HuggingFace automatically shifts the labels, the labels correspond exactly to `target_ids`.
-            # We have to make sure that the PAD token is ignored
-
-            train_labels = [
-                [
-                    -100 if token == answer_tokenizer.pad_token_id else token
-                    for token in labels
-                ]
-                for labels in train_encodings["labels"]
-            ]
-            train_encodings["labels"] = train_labels
-
         val_encodings["target_attention_mask"] = val_answer_encodings.attention_mask
 
         val_encodings["labels"] = val_answer_encodings.input_ids
 
-        # because HuggingFace automatically shifts the labels, the labels correspond exactly to `target_ids`.
-        # We have to make sure that the PAD token is ignored.
-
-        val_labels = [
-            [
-                -100 if token == answer_tokenizer.pad_token_id else token
-                for token in labels
-            ]
-            for labels in val_encodings["labels"]
-        ]
-        val_encodings["labels"] = val_labels
-
     else:
         if not for_evaluation:
-            train_encodings["passages"] = train_passages
-            train_encodings["entity_relations"] = train_entity_relations
+            add_answer_segments(
+                train_encodings, answer_segments, train_passages, train_entity_relations
+            )
             train_encodings["posterier_input_ids"] = train_posterier_encodings.pop(
                 "input_ids"
             )
@@ -1204,21 +2858,14 @@ def create_zero_re_qa_dataset(
                 "second_entity_attention_mask"
             ] = train_answer_encodings.pop("attention_mask")
 
-            # because HuggingFace automatically shifts the labels, the labels correspond exactly to `target_ids`.
-            # We have to make sure that the PAD token is ignored
-
-            train_labels = [
-                [
-                    -100 if token == answer_tokenizer.pad_token_id else token
-                    for token in labels
-                ]
-                for labels in train_encodings["second_entity_labels"]
-            ]
-            train_encodings["second_entity_labels"] = train_labels
             train_encodings["relation_labels"] = relation_info[0]
 
-        val_encodings["passages"] = val_passages
-        val_encodings["entity_relations"] = val_entity_relations
+            # keys the offline question samples of every example.
+            train_encodings["example_index"] = list(range(len(train_passages)))
+
+        add_answer_segments(
+            val_encodings, answer_segments, val_passages, val_entity_relations
+        )
         val_encodings["entity_relation_passage_input_ids"] = val_encodings.pop(
             "input_ids"
         )
@@ -1231,650 +2878,421 @@ def create_zero_re_qa_dataset(
             "attention_mask"
         )
 
-        # because Huggingface automatically shifts the labels, the labels correspond exactly to `target_ids`.
-        # We have to make sure that the PAD token is ignored.
-
-        val_labels = [
-            [
-                -100 if token == answer_tokenizer.pad_token_id else token
-                for token in labels
-            ]
-            for labels in val_encodings["second_entity_labels"]
-        ]
-        val_encodings["second_entity_labels"] = val_labels
+    train_dataset = None
+    if not for_evaluation:
+        train_dataset = ColumnarDataset(train_encodings)
+    val_dataset = ColumnarDataset(val_encodings)
+    return train_dataset, val_dataset
 
-    class HelperDataset(torch.utils.data.Dataset):
-        def __init__(self, encodings):
-            self.encodings = encodings
 
-        def __getitem__(self, idx):
-            row = {}
-            for key, val in self.encodings.items():
-                if key in ["passages", "entity_relations"]:
-                    row[key] = val[idx]
-                else:
-                    row[key] = torch.tensor(val[idx])
-            return row
+def create_zero_re_qa_dataset(
+    question_tokenizer,
+    answer_tokenizer,
+    batch_size,
+    source_max_length,
+    decoder_max_length,
+    train_file=None,
+    dev_file=None,
+    ignore_unknowns=True,
+    concat=False,
+    gold_questions=False,
+    for_evaluation=False,
+    max_tokens=None,
+    cache_dir=None,
+):
+    """Function to create the zero re qa dataset.
 
-        def __len__(self):
-            if "entity_relation_passage_input_ids" in self.encodings:
-                return len(self.encodings.entity_relation_passage_input_ids)
-            if "input_ids" in self.encodings:
-                return len(self.encodings.input_ids)
+    With a cache_dir, the tokenized datasets are reused across runs.
+    """
+    names = ["train", "val"]
+    cache_path = dataset_cache_path(
+        cache_dir,
+        [
+            None if for_evaluation else train_file,
+            dev_file,
+            # the prompts have the descriptions of relation_descriptions.json.
+            REPO_DIR / "relation_descriptions.json",
+        ],
+        [question_tokenizer, answer_tokenizer],
+        "zero_re_qa",
+        source_max_length,
+        decoder_max_length,
+        ignore_unknowns,
+        concat,
+        gold_questions,
+        for_evaluation,
+    )
+    datasets = load_cached_datasets(cache_path, names)
+    if datasets is None:
+        datasets = tokenize_zero_re_qa_dataset(
+            question_tokenizer,
+            answer_tokenizer,
+            source_max_length,
+            decoder_max_length,
+            train_file=train_file,
+            dev_file=dev_file,
+            ignore_unknowns=ignore_unknowns,
+            concat=concat,
+            gold_questions=gold_questions,
+            for_evaluation=for_evaluation,
+        )
+        save_cached_datasets(cache_path, names, datasets)
+    train_dataset, val_dataset = datasets
 
-    train_dataset = None
     train_loader = None
-    if not for_evaluation:
-        train_dataset = HelperDataset(train_encodings)
-    val_dataset = HelperDataset(val_encodings)
 
+    # the encoder inputs are in "input_ids" for the gold question datasets.
+    length_key = "entity_relation_passage_input_ids"
+    if gold_questions or concat:
+        length_key = "input_ids"
     if not for_evaluation:
-        train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True)
-    val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False)
+        train_loader = create_loader(
+            train_dataset,
+            batch_size,
+            shuffle=True,
+            max_tokens=max_tokens,
+            length_key=length_key,
+        )
+    val_loader = create_loader(
+        val_dataset, batch_size, max_tokens=max_tokens, length_key=length_key
+    )
     return train_loader, val_loader, train_dataset, val_dataset
 
 
-def read_wikizsl_dataset(zsl_path, seed=10, m=5, add_negs=False):
+# The shared arguments of the split writers in the map_seeds workers.
+SEED_SHARED_ARGS = ()
 
-    set_random_seed(seed)
 
-    path = Path("./relation_descriptions.json")
+def set_seed_shared_args(shared_args):
+    global SEED_SHARED_ARGS
+    SEED_SHARED_ARGS = shared_args
 
-    id_to_desc = {}
-    id_to_label = {}
-    with open(path, "r") as fd:
-        re_desc_data = json.load(fd)
-        for row in re_desc_data:
-            re_id = row["relation_id"]
-            id_to_desc[re_id] = row["relation_description"]
-            id_to_label[re_id] = row["relation_label"]
-
-    train_contexts = []
-    train_posterier_contexts = []
-    train_answers = []
-    train_passages = []
-    train_entities = []
-    train_entity_relations = []
-
-    val_contexts = []
-    val_posterier_contexts = []
-    val_answers = []
-    val_passages = []
-    val_entities = []
-    val_entity_relations = []
-    val_actual_ids = []
-
-    test_contexts = []
-    test_posterier_contexts = []
-    test_answers = []
-    test_passages = []
-    test_entities = []
-    test_entity_relations = []
-    test_actual_ids = []
-
-    with open(zsl_path, "r") as json_file:
-        data = json.load(json_file)
-        # preserve order after shuffle.
-        relation_ids = []
-        relation_set = set()
-        for row in data:
-            relation_id = row["edgeSet"][0]["kbID"]
-            if relation_id not in relation_set:
-                relation_ids.append(relation_id)
-                relation_set.add(relation_id)
-
-        r_ids = relation_ids
-        random.shuffle(r_ids)
-        val_r_ids = r_ids[: m]
-        test_r_ids = r_ids[m : 4 * m]
-        train_r_ids = r_ids[4 * m :]
-
-        set_val_r_ids = set(val_r_ids)
-        set_test_r_ids = set(test_r_ids)
-        set_train_r_ids = set(train_r_ids)
-
-        train_id_df = pd.DataFrame(train_r_ids, columns=["relation_ids"])
-        train_id_df.to_csv(
-            "./train_ids_" + str(seed) + ".csv", sep=",", header=True, index=False
-        )
 
-        val_id_df = pd.DataFrame(val_r_ids, columns=["relation_ids"])
-        val_id_df.to_csv(
-            "./val_ids_" + str(seed) + ".csv", sep=",", header=True, index=False
+def call_with_seed_shared_args(write_split, seed):
+    return write_split(*SEED_SHARED_ARGS, seed)
+
+
+def map_seeds(write_split, seeds, shared_args=(), num_workers=None):
+    """Call write_split(*shared_args, seed) for every seed, on a pool of
+    num_workers processes if given.
+
+    The shared_args are handed to every worker once by the pool
+    initializer, and inherited without pickling by the forked workers,
+    rather than pickled with every seed.
+    """
+    if not num_workers:
+        for seed in seeds:
+            write_split(*shared_args, seed)
+        return
+    with multiprocessing.Pool(
+        num_workers, initializer=set_seed_shared_args, initargs=(shared_args,)
+    ) as pool:
+        pool.map(functools.partial(call_with_seed_shared_args, write_split), seeds)
+
+
+def wikizsl_rows(zsl_path):
+    """Stream the sentence, head entity, tail entity and relation id of the
+    wikizsl rows."""
+    for _, row, _, _ in iter_json_items(zsl_path):
+        sentence = " ".join(row["tokens"])
+        relation_id = row["edgeSet"][0]["kbID"]
+        head_entity = " ".join(
+            [row["tokens"][int(i)] for i in row["edgeSet"][0]["left"]]
+        )
+        tail_entity = " ".join(
+            [row["tokens"][int(i)] for i in row["edgeSet"][0]["right"]]
         )
+        yield sentence, head_entity, tail_entity, relation_id
+
 
-        test_id_df = pd.DataFrame(test_r_ids, columns=["relation_ids"])
-        test_id_df.to_csv(
-            "./test_ids_" + str(seed) + ".csv", sep=",", header=True, index=False
+def wikizsl_pieces(rows):
+    """Map the wikizsl_rows to the prompt pieces of their sentence and gold
+    answers, and their relation id."""
+    for sentence, head_entity, tail_entity, relation_id in rows:
+        yield (
+            offmml_sentence_pieces(sentence, head_entity),
+            offmml_answer_pieces(tail_entity),
+            relation_id,
         )
 
-        for row in data:
-            sentence = " ".join(row["tokens"])
-            relation_id = row["edgeSet"][0]["kbID"]
-            head_entity = " ".join(
-                [row["tokens"][int(i)] for i in row["edgeSet"][0]["left"]]
-            )
-            tail_entity = " ".join(
-                [row["tokens"][int(i)] for i in row["edgeSet"][0]["right"]]
-            )
-            r_name = id_to_label[relation_id]
-            re_desc = id_to_desc[relation_id]
-            gold_answers = [tail_entity]
+
+def write_wikizsl_split(relation_ids, rows, seed, m=5, add_negs=False, output_dir="."):
+    """Write the id and data csv files of the seed split, given the relation
+    ids in the order they first appear and the wikizsl_pieces of the
+    rows."""
+    set_random_seed(seed)
+
+    id_to_label = relation_catalog().id_to_label
+    id_to_desc = relation_catalog().id_to_desc
+
+    # preserve order after shuffle.
+    r_ids = list(relation_ids)
+    random.shuffle(r_ids)
+    val_r_ids = r_ids[: m]
+    test_r_ids = r_ids[m : 4 * m]
+    train_r_ids = r_ids[4 * m :]
+
+    relation_pieces = {
+        r_id: offmml_relation_pieces(id_to_label[r_id], id_to_desc[r_id])
+        for r_id in r_ids
+    }
+    no_answer_pieces = offmml_answer_pieces("no_answer")
+
+    set_val_r_ids = set(val_r_ids)
+    set_test_r_ids = set(test_r_ids)
+    train_r_index = {r_id: i for i, r_id in enumerate(train_r_ids)}
+
+    train_id_df = pd.DataFrame(train_r_ids, columns=["relation_ids"])
+    train_id_df.to_csv(
+        os.path.join(output_dir, "train_ids_" + str(seed) + ".csv"),
+        sep=",",
+        header=True,
+        index=False,
+    )
+
+    val_id_df = pd.DataFrame(val_r_ids, columns=["relation_ids"])
+    val_id_df.to_csv(
+        os.path.join(output_dir, "val_ids_" + str(seed) + ".csv"),
+        sep=",",
+        header=True,
+        index=False,
+    )
+
+    test_id_df = pd.DataFrame(test_r_ids, columns=["relation_ids"])
+    test_id_df.to_csv(
+        os.path.join(output_dir, "test_ids_" + str(seed) + ".csv"),
+        sep=",",
+        header=True,
+        index=False,
+    )
+
+    with OffmmlWriter(
+        os.path.join(output_dir, "train_data_" + str(seed) + ".csv")
+    ) as train_writer, OffmmlWriter(
+        os.path.join(output_dir, "val_data_" + str(seed) + ".csv"), actual_ids=True
+    ) as val_writer, OffmmlWriter(
+        os.path.join(output_dir, "test_data_" + str(seed) + ".csv"), actual_ids=True
+    ) as test_writer:
+
+        for sentence_pieces, answer_pieces, relation_id in rows:
             if relation_id in set_val_r_ids:
-                for second_relation_id in set_val_r_ids:
-                    val_actual_ids.append(relation_id)
-                    r_name = id_to_label[second_relation_id]
-                    re_desc = id_to_desc[second_relation_id]
-                    val_passages.append(sentence)
-                    val_entity_relations.append(white_space_fix(head_entity + " <SEP> " + r_name))
-                    val_entities.append(white_space_fix(head_entity))
-                    val_contexts.append(
-                        "answer: "
-                        + white_space_fix(head_entity)
-                        + " <SEP> "
-                        + white_space_fix(r_name)
-                        + " ; "
-                        + white_space_fix(re_desc)
-                        + " context: "
-                        + white_space_fix(sentence)
-                        + " </s>"
-                    )
-                    val_posterier_contexts.append(
-                        "answer: "
-                        + white_space_fix(head_entity)
-                        + " <SEP> "
-                        + white_space_fix(r_name)
-                        + " ; "
-                        + white_space_fix(re_desc)
-                        + " "
-                        + white_space_fix(" and ".join(gold_answers))
-                        + " context: "
-                        + white_space_fix(sentence)
-                        + " </s>"
-                    )
-                    val_answers.append(
-                        white_space_fix(" and ".join(gold_answers)) + " </s>"
+                for second_relation_id in val_r_ids:
+                    val_writer.write_pieces(
+                        sentence_pieces,
+                        relation_pieces[second_relation_id],
+                        answer_pieces,
+                        actual_id=relation_id,
                     )
 
             elif relation_id in set_test_r_ids:
-                for second_relation_id in set_test_r_ids:
-                    test_actual_ids.append(relation_id)
-                    test_passages.append(sentence)
-                    r_name = id_to_label[second_relation_id]
-                    re_desc = id_to_desc[second_relation_id]
-                    test_entity_relations.append(
-                        white_space_fix(head_entity + " <SEP> " + r_name)
-                    )
-                    test_entities.append(white_space_fix(head_entity))
-                    test_contexts.append(
-                        "answer: "
-                        + white_space_fix(head_entity)
-                        + " <SEP> "
-                        + white_space_fix(r_name)
-                        + " ; "
-                        + white_space_fix(re_desc)
-                        + " context: "
-                        + white_space_fix(sentence)
-                        + " </s>"
-                    )
-                    test_posterier_contexts.append(
-                        "answer: "
-                        + white_space_fix(head_entity)
-                        + " <SEP> "
-                        + white_space_fix(r_name)
-                        + " ; "
-                        + white_space_fix(re_desc)
-                        + " "
-                        + white_space_fix(" and ".join(gold_answers))
-                        + " context: "
-                        + white_space_fix(sentence)
-                        + " </s>"
-                    )
-                    test_answers.append(
-                        white_space_fix(" and ".join(gold_answers)) + " </s>"
+                for second_relation_id in test_r_ids:
+                    test_writer.write_pieces(
+                        sentence_pieces,
+                        relation_pieces[second_relation_id],
+                        answer_pieces,
+                        actual_id=relation_id,
                     )
 
-            elif relation_id in set_train_r_ids:
-                train_passages.append(sentence)
-                train_entity_relations.append(
-                    white_space_fix(head_entity + " <SEP> " + r_name)
-                )
-                train_entities.append(white_space_fix(head_entity))
-                train_contexts.append(
-                    "answer: "
-                    + white_space_fix(head_entity)
-                    + " <SEP> "
-                    + white_space_fix(r_name)
-                    + " ; "
-                    + white_space_fix(re_desc)
-                    + " context: "
-                    + white_space_fix(sentence)
-                    + " </s>"
-                )
-                train_posterier_contexts.append(
-                    "answer: "
-                    + white_space_fix(head_entity)
-                    + " <SEP> "
-                    + white_space_fix(r_name)
-                    + " ; "
-                    + white_space_fix(re_desc)
-                    + " "
-                    + white_space_fix(" and ".join(gold_answers))
-                    + " context: "
-                    + white_space_fix(sentence)
-                    + " </s>"
-                )
-                train_answers.append(
-                    white_space_fix(" and ".join(gold_answers)) + " </s>"
+            elif relation_id in train_r_index:
+                train_writer.write_pieces(
+                    sentence_pieces, relation_pieces[relation_id], answer_pieces
                 )
 
                 # add the negative example.
                 if add_negs:
-                    temp_ids = list(set_train_r_ids)
-                    temp_ids.remove(relation_id)
-                    other_r_id = random.sample(temp_ids, 1)[0]
-                    other_r_name = id_to_label[other_r_id]
-                    other_r_desc = id_to_desc[other_r_id]
-                    gold_answers = ["no_answer"]
-                    train_passages.append(sentence)
-                    train_entity_relations.append(
-                        white_space_fix(head_entity + " <SEP> " + other_r_name)
-                    )
-                    train_entities.append(white_space_fix(head_entity))
-                    train_contexts.append(
-                        "answer: "
-                        + white_space_fix(head_entity)
-                        + " <SEP> "
-                        + white_space_fix(other_r_name)
-                        + " ; "
-                        + white_space_fix(other_r_desc)
-                        + " context: "
-                        + white_space_fix(sentence)
-                        + " </s>"
-                    )
-                    train_posterier_contexts.append(
-                        "answer: "
-                        + white_space_fix(head_entity)
-                        + " <SEP> "
-                        + white_space_fix(other_r_name)
-                        + " ; "
-                        + white_space_fix(other_r_desc)
-                        + " "
-                        + white_space_fix(" and ".join(gold_answers))
-                        + " context: "
-                        + white_space_fix(sentence)
-                        + " </s>"
-                    )
-                    train_answers.append(
-                        white_space_fix(" and ".join(gold_answers)) + " </s>"
+                    other_r_id = sample_other(train_r_ids, train_r_index[relation_id])
+                    train_writer.write_pieces(
+                        sentence_pieces, relation_pieces[other_r_id], no_answer_pieces
                     )
 
-    train_df = pd.DataFrame(
-        {
-            "passages": train_passages,
-            "contexts": train_contexts,
-            "answers": train_answers,
-            "entity_relations": train_entity_relations,
-            "entities": train_entities,
-            "posterier_contexts": train_posterier_contexts,
-        }
-    )
 
-    val_df = pd.DataFrame(
-        {
-            "passages": val_passages,
-            "contexts": val_contexts,
-            "answers": val_answers,
-            "entity_relations": val_entity_relations,
-            "entities": val_entities,
-            "posterier_contexts": val_posterier_contexts,
-            "actual_ids": val_actual_ids
-        }
+def read_wikizsl_dataset(zsl_path, seed=10, m=5, add_negs=False, output_dir="."):
+    write_wikizsl_split(
+        read_wikizsl_relation_ids(zsl_path),
+        wikizsl_pieces(wikizsl_rows(zsl_path)),
+        seed,
+        m=m,
+        add_negs=add_negs,
+        output_dir=output_dir,
     )
+    return
 
-    test_df = pd.DataFrame(
-        {
-            "passages": test_passages,
-            "contexts": test_contexts,
-            "answers": test_answers,
-            "entity_relations": test_entity_relations,
-            "entities": test_entities,
-            "posterier_contexts": test_posterier_contexts,
-            "actual_ids": test_actual_ids
-        }
-    )
 
-    train_df.to_csv(
-        "./train_data_" + str(seed) + ".csv", sep=",", header=True, index=False
-    )
-    val_df.to_csv("./val_data_" + str(seed) + ".csv", sep=",", header=True, index=False)
-    test_df.to_csv(
-        "./test_data_" + str(seed) + ".csv", sep=",", header=True, index=False
-    )
+def read_wikizsl_dataset_seeds(
+    zsl_path, seeds, m=5, add_negs=False, num_workers=None, output_dir="."
+):
+    """Write the splits of read_wikizsl_dataset for every seed, reading the
+    wikizsl file once.
 
-    return (
-        (
-            train_passages,
-            train_contexts,
-            train_answers,
-            train_entity_relations,
-            train_entities,
-            train_posterier_contexts,
-        ),
-        (
-            val_passages,
-            val_contexts,
-            val_answers,
-            val_entity_relations,
-            val_entities,
-            val_posterier_contexts,
-        ),
-        (
-            test_passages,
-            test_contexts,
-            test_answers,
-            test_entity_relations,
-            test_entities,
-            test_posterier_contexts,
+    Unlike read_wikizsl_dataset, this does not stream the file: all the
+    rows are kept in memory to be shared by the seeds.
+    """
+    rows = list(wikizsl_pieces(wikizsl_rows(zsl_path)))
+    relation_ids = list(dict.fromkeys(row[2] for row in rows))
+    map_seeds(
+        functools.partial(
+            write_wikizsl_split, m=m, add_negs=add_negs, output_dir=output_dir
         ),
+        seeds,
+        shared_args=(relation_ids, rows),
+        num_workers=num_workers,
     )
 
 
-def read_fewrl_dataset(fewrel_path, seed=10, m=5):
+def fewrel_entities(sent):
+    """Find the sentence and the head and tail entities of a fewrel row."""
+    sentence = " ".join(sent["tokens"])
+    head_entity = " ".join([sent["tokens"][i] for i in sent["h"][2][0]])
+    tail_entity = " ".join([sent["tokens"][i] for i in sent["t"][2][0]])
+    return sentence, head_entity, tail_entity
+
+
+def fewrel_pieces(sents):
+    """The prompt pieces of the sentences and gold answers of the fewrel
+    rows."""
+    pieces = []
+    for sent in sents:
+        sentence, head_entity, tail_entity = fewrel_entities(sent)
+        pieces.append(
+            (
+                offmml_sentence_pieces(sentence, head_entity),
+                offmml_answer_pieces(tail_entity),
+            )
+        )
+    return pieces
+
 
+def write_fewrl_split(r_ids, read_sentences, seed, m=5, output_dir="."):
+    """Write the id and data csv files of the seed split, given the fewrel
+    relation ids in the file order and read_sentences(r_id), which returns
+    the fewrel_pieces of the relation's sentences."""
     set_random_seed(seed)
 
-    path = Path("./relation_descriptions.json")
-
-    id_to_desc = {}
-    id_to_label = {}
-    label_to_id = {}
-    with open(path, "r") as fd:
-        re_desc_data = json.load(fd)
-        for row in re_desc_data:
-            re_id = row["relation_id"]
-            id_to_desc[re_id] = row["relation_description"]
-            id_to_label[re_id] = row["relation_label"]
-            label_to_id[row["relation_label"]] = re_id
-
-    train_contexts = []
-    train_posterier_contexts = []
-    train_answers = []
-    train_passages = []
-    train_entities = []
-    train_entity_relations = []
-
-    val_contexts = []
-    val_posterier_contexts = []
-    val_answers = []
-    val_passages = []
-    val_entities = []
-    val_entity_relations = []
-    val_actual_ids = []
-
-    test_contexts = []
-    test_posterier_contexts = []
-    test_answers = []
-    test_passages = []
-    test_entities = []
-    test_entity_relations = []
-    test_actual_ids = []
-
-    with open(fewrel_path, "r") as json_file:
-        data = json.load(json_file)
-        r_ids = list(data.keys())
-        random.shuffle(r_ids)
-        val_r_ids = r_ids[: m]
-        test_r_ids = r_ids[m: 4 * m]
-        train_r_ids = r_ids[4 * m:]
-
-        train_id_df = pd.DataFrame(train_r_ids, columns=["relation_ids"])
-        train_id_df.to_csv(
-            "./train_ids_" + str(seed) + ".csv", sep=",", header=True, index=False
-        )
+    id_to_label = relation_catalog().id_to_label
+    id_to_desc = relation_catalog().id_to_desc
+
+    r_ids = list(r_ids)
+    random.shuffle(r_ids)
+    val_r_ids = r_ids[: m]
+    test_r_ids = r_ids[m: 4 * m]
+    train_r_ids = r_ids[4 * m:]
+
+    relation_pieces = {
+        r_id: offmml_relation_pieces(id_to_label[r_id], id_to_desc[r_id])
+        for r_id in r_ids
+    }
+    no_answer_pieces = offmml_answer_pieces("no_answer")
+
+    train_id_df = pd.DataFrame(train_r_ids, columns=["relation_ids"])
+    train_id_df.to_csv(
+        os.path.join(output_dir, "train_ids_" + str(seed) + ".csv"),
+        sep=",",
+        header=True,
+        index=False,
+    )
 
-        val_id_df = pd.DataFrame(val_r_ids, columns=["relation_ids"])
-        val_id_df.to_csv(
-            "./val_ids_" + str(seed) + ".csv", sep=",", header=True, index=False
-        )
+    val_id_df = pd.DataFrame(val_r_ids, columns=["relation_ids"])
+    val_id_df.to_csv(
+        os.path.join(output_dir, "val_ids_" + str(seed) + ".csv"),
+        sep=",",
+        header=True,
+        index=False,
+    )
 
-        test_id_df = pd.DataFrame(test_r_ids, columns=["relation_ids"])
-        test_id_df.to_csv(
-            "./test_ids_" + str(seed) + ".csv", sep=",", header=True, index=False
-        )
+    test_id_df = pd.DataFrame(test_r_ids, columns=["relation_ids"])
+    test_id_df.to_csv(
+        os.path.join(output_dir, "test_ids_" + str(seed) + ".csv"),
+        sep=",",
+        header=True,
+        index=False,
+    )
 
+    with OffmmlWriter(
+        os.path.join(output_dir, "val_data_" + str(seed) + ".csv"), actual_ids=True
+    ) as writer:
         for r_id in val_r_ids:
-            r_name = id_to_label[r_id]
-            r_desc = id_to_desc[r_id]
-
             # validate on a smaller dev data for faster computation. Sample 50 sentences per relation.
-            for sent in sample(data[r_id], 50):
+            for sentence_pieces, answer_pieces in sample(read_sentences(r_id), 50):
                 for second_r_id in val_r_ids:
-                    second_r_name = id_to_label[second_r_id]
-                    second_r_desc = id_to_desc[second_r_id]
-
-                    val_actual_ids.append(r_id)
-                    sentence = " ".join(sent["tokens"])
-                    head_entity_indices = sent["h"][2][0]
-                    tail_entity_indices = sent["t"][2][0]
-                    head_entity = " ".join([sent["tokens"][i] for i in head_entity_indices])
-                    tail_entity = " ".join([sent["tokens"][i] for i in tail_entity_indices])
-                    gold_answers = tail_entity
-                    val_passages.append(sentence)
-                    val_entity_relations.append(
-                        white_space_fix(head_entity + " <SEP> " + second_r_name)
-                    )
-                    val_entities.append(white_space_fix(head_entity))
-                    val_contexts.append(
-                        "answer: "
-                        + white_space_fix(head_entity)
-                        + " <SEP> "
-                        + white_space_fix(second_r_name)
-                        + " ; "
-                        + white_space_fix(second_r_desc)
-                        + " context: "
-                        + white_space_fix(sentence)
-                        + " </s>"
-                    )
-                    val_posterier_contexts.append(
-                        "answer: "
-                        + white_space_fix(head_entity)
-                        + " <SEP> "
-                        + white_space_fix(second_r_name)
-                        + " ; "
-                        + white_space_fix(second_r_desc)
-                        + " "
-                        + white_space_fix(gold_answers)
-                        + " context: "
-                        + white_space_fix(sentence)
-                        + " </s>"
-                    )
-                    val_answers.append(
-                        white_space_fix(gold_answers) + " </s>"
+                    writer.write_pieces(
+                        sentence_pieces,
+                        relation_pieces[second_r_id],
+                        answer_pieces,
+                        actual_id=r_id,
                     )
 
+    with OffmmlWriter(
+        os.path.join(output_dir, "test_data_" + str(seed) + ".csv"), actual_ids=True
+    ) as writer:
         for r_id in test_r_ids:
-            r_name = id_to_label[r_id]
-            r_desc = id_to_desc[r_id]
-            for sent in data[r_id]:
+            for sentence_pieces, answer_pieces in read_sentences(r_id):
                 for second_r_id in test_r_ids:
-                    second_r_name = id_to_label[second_r_id]
-                    second_r_desc = id_to_desc[second_r_id]
-
-                    test_actual_ids.append(r_id)
-                    sentence = " ".join(sent["tokens"])
-                    head_entity_indices = sent["h"][2][0]
-                    tail_entity_indices = sent["t"][2][0]
-                    head_entity = " ".join([sent["tokens"][i] for i in head_entity_indices])
-                    tail_entity = " ".join([sent["tokens"][i] for i in tail_entity_indices])
-                    gold_answers = tail_entity
-                    test_passages.append(sentence)
-                    test_entity_relations.append(
-                        white_space_fix(head_entity + " <SEP> " + second_r_name)
-                    )
-                    test_entities.append(white_space_fix(head_entity))
-                    test_contexts.append(
-                        "answer: "
-                        + white_space_fix(head_entity)
-                        + " <SEP> "
-                        + white_space_fix(second_r_name)
-                        + " ; "
-                        + white_space_fix(second_r_desc)
-                        + " context: "
-                        + white_space_fix(sentence)
-                        + " </s>"
-                    )
-                    test_posterier_contexts.append(
-                        "answer: "
-                        + white_space_fix(head_entity)
-                        + " <SEP> "
-                        + white_space_fix(second_r_name)
-                        + " ; "
-                        + white_space_fix(second_r_desc)
-                        + " "
-                        + white_space_fix(gold_answers)
-                        + " context: "
-                        + white_space_fix(sentence)
-                        + " </s>"
+                    writer.write_pieces(
+                        sentence_pieces,
+                        relation_pieces[second_r_id],
+                        answer_pieces,
+                        actual_id=r_id,
                     )
-                    test_answers.append(
-                        white_space_fix(gold_answers) + " </s>"
-                    )
-
-        for r_id in train_r_ids:
-            r_name = id_to_label[r_id]
-            r_desc = id_to_desc[r_id]
 
-            for sent in data[r_id]:
-                sentence = " ".join(sent["tokens"])
-                head_entity_indices = sent["h"][2][0]
-                tail_entity_indices = sent["t"][2][0]
-                head_entity = " ".join([sent["tokens"][i] for i in head_entity_indices])
-                tail_entity = " ".join([sent["tokens"][i] for i in tail_entity_indices])
-                gold_answers = tail_entity
-                train_passages.append(sentence)
-                train_entity_relations.append(
-                    white_space_fix(head_entity + " <SEP> " + r_name)
+    with OffmmlWriter(
+        os.path.join(output_dir, "train_data_" + str(seed) + ".csv")
+    ) as writer:
+        for r_index, r_id in enumerate(train_r_ids):
+            for sentence_pieces, answer_pieces in read_sentences(r_id):
+                writer.write_pieces(
+                    sentence_pieces, relation_pieces[r_id], answer_pieces
                 )
-                train_entities.append(white_space_fix(head_entity))
-                train_contexts.append(
-                    "answer: "
-                    + white_space_fix(head_entity)
-                    + " <SEP> "
-                    + white_space_fix(r_name)
-                    + " ; "
-                    + white_space_fix(r_desc)
-                    + " context: "
-                    + white_space_fix(sentence)
-                    + " </s>"
-                )
-                train_posterier_contexts.append(
-                    "answer: "
-                    + white_space_fix(head_entity)
-                    + " <SEP> "
-                    + white_space_fix(r_name)
-                    + " ; "
-                    + white_space_fix(r_desc)
-                    + " "
-                    + white_space_fix(gold_answers)
-                    + " context: "
-                    + white_space_fix(sentence)
-                    + " </s>"
-                )
-                train_answers.append(
-                    white_space_fix(gold_answers) + " </s>"
-                )
-            
+
                 # Add the negative example.
-                temp_ids = list(train_r_ids)
-                temp_ids.remove(r_id)
-                other_r_id = random.sample(temp_ids, 1)[0]
-                other_r_name = id_to_label[other_r_id]
-                other_r_desc = id_to_desc[other_r_id]
-
-                train_passages.append(sentence)
-                train_entity_relations.append(
-                    white_space_fix(head_entity + " <SEP> " + other_r_name)
-                )
-                train_entities.append(white_space_fix(head_entity))
-                train_contexts.append(
-                    "answer: "
-                    + white_space_fix(head_entity)
-                    + " <SEP> "
-                    + white_space_fix(other_r_name)
-                    + " ; "
-                    + white_space_fix(other_r_desc)
-                    + " context: "
-                    + white_space_fix(sentence)
-                    + " </s>"
-                )
-                train_posterier_contexts.append(
-                    "answer: "
-                    + white_space_fix(head_entity)
-                    + " <SEP> "
-                    + white_space_fix(other_r_name)
-                    + " ; "
-                    + white_space_fix(other_r_desc)
-                    + " "
-                    + white_space_fix("no_answer")
-                    + " context: "
-                    + white_space_fix(sentence)
-                    + " </s>"
-                )
-                train_answers.append(
-                    white_space_fix("no_answer") + " </s>"
+                other_r_id = sample_other(train_r_ids, r_index)
+                writer.write_pieces(
+                    sentence_pieces, relation_pieces[other_r_id], no_answer_pieces
                 )
 
-    train_df = pd.DataFrame(
-        {
-            "passages": train_passages,
-            "contexts": train_contexts,
-            "answers": train_answers,
-            "entity_relations": train_entity_relations,
-            "entities": train_entities,
-            "posterier_contexts": train_posterier_contexts,
-        }
-    )
 
-    val_df = pd.DataFrame(
-        {
-            "passages": val_passages,
-            "contexts": val_contexts,
-            "answers": val_answers,
-            "entity_relations": val_entity_relations,
-            "entities": val_entities,
-            "posterier_contexts": val_posterier_contexts,
-            "actual_ids": val_actual_ids,
-        }
-    )
+def read_fewrl_dataset(fewrel_path, seed=10, m=5, output_dir="."):
+    # the sentences of every relation are read back from these offsets.
+    relation_offsets = {
+        r_id: (start, end) for r_id, _, start, end in iter_json_items(fewrel_path)
+    }
 
-    test_df = pd.DataFrame(
-        {
-            "passages": test_passages,
-            "contexts": test_contexts,
-            "answers": test_answers,
-            "entity_relations": test_entity_relations,
-            "entities": test_entities,
-            "posterier_contexts": test_posterier_contexts,
-            "actual_ids": test_actual_ids,
-        }
-    )
+    def read_sentences(r_id):
+        return fewrel_pieces(read_json_value(fewrel_path, *relation_offsets[r_id]))
 
-    train_df.to_csv(
-        "./train_data_" + str(seed) + ".csv", sep=",", header=True, index=False
+    write_fewrl_split(
+        list(relation_offsets.keys()),
+        read_sentences,
+        seed,
+        m=m,
+        output_dir=output_dir,
     )
-    val_df.to_csv("./val_data_" + str(seed) + ".csv", sep=",", header=True, index=False)
-    test_df.to_csv(
-        "./test_data_" + str(seed) + ".csv", sep=",", header=True, index=False
-    )
-
     return
 
 
-def create_fewrl_dataset(
+def read_fewrl_dataset_seeds(
+    fewrel_path, seeds, m=5, num_workers=None, output_dir="."
+):
+    """Write the splits of read_fewrl_dataset for every seed, reading the
+    fewrel file once.
+
+    Unlike read_fewrl_dataset, this does not stream the file: the
+    sentences of all the relations are kept in memory to be shared by the
+    seeds.
+    """
+    relations = {
+        r_id: fewrel_pieces(sents) for r_id, sents, _, _ in iter_json_items(fewrel_path)
+    }
+    map_seeds(
+        functools.partial(write_fewrl_split, m=m, output_dir=output_dir),
+        seeds,
+        shared_args=(list(relations.keys()), relations.get),
+        num_workers=num_workers,
+    )
+
+
+def tokenize_fewrl_dataset(
     question_tokenizer,
     answer_tokenizer,
-    batch_size,
     source_max_length,
     decoder_max_length,
     train_fewrel_path=None,
@@ -1882,123 +3300,65 @@ def create_fewrl_dataset(
     test_fewrel_path=None,
     concat=False,
 ):
-    """Function to create the fewrl dataset."""
-    train_df = pd.read_csv(train_fewrel_path, sep=",")
-    dev_df = pd.read_csv(dev_fewrel_path, sep=",")
-    test_df = pd.read_csv(test_fewrel_path, sep=",")
-
-    train_passages = train_df["passages"].tolist()
-    train_contexts = train_df["contexts"].tolist()
-    train_answers = train_df["answers"].tolist()
-    train_entity_relations = train_df["entity_relations"].tolist()
-    train_entities = [str(row) for row in train_df["entities"].tolist()]
-    train_posterier_contexts = train_df["posterier_contexts"].tolist()
-
-    val_passages = dev_df["passages"].tolist()
-    val_contexts = dev_df["contexts"].tolist()
-    val_answers = dev_df["answers"].tolist()
-    val_entity_relations = dev_df["entity_relations"].tolist()
-    val_entities = [str(row) for row in dev_df["entities"].tolist()]
-    val_posterier_contexts = dev_df["posterier_contexts"].tolist()
-
-    test_passages = test_df["passages"].tolist()
-    test_contexts = test_df["contexts"].tolist()
-    test_answers = test_df["answers"].tolist()
-    test_entity_relations = test_df["entity_relations"].tolist()
-    test_entities = [str(row) for row in test_df["entities"].tolist()]
-    test_posterier_contexts = test_df["posterier_contexts"].tolist()
-
-    if concat:
-        for i in range(len(train_contexts)):
-            ctx = train_contexts[i]
-            ctx_str = ctx.split("context: ")[1]
-            ent_rel_str = train_entity_relations[i]
-            new_train_context = white_space_fix(
-                "question: " + ent_rel_str + " context: " + ctx_str
-            )
-            train_contexts[i] = new_train_context
-
-        for i in range(len(val_contexts)):
-            ctx = val_contexts[i]
-            ctx_str = ctx.split("context: ")[1]
-            ent_rel_str = val_entity_relations[i]
-            new_val_context = white_space_fix(
-                "question: " + ent_rel_str + " context: " + ctx_str
-            )
-            val_contexts[i] = new_val_context
-
-
-        for i in range(len(test_contexts)):
-            ctx = test_contexts[i]
-            ctx_str = ctx.split("context: ")[1]
-            ent_rel_str = test_entity_relations[i]
-            new_test_context = white_space_fix(
-                "question: " + ent_rel_str + " context: " + ctx_str
-            )
-            test_contexts[i] = new_test_context
-            print(test_contexts[i])
-
-    val_encodings = question_tokenizer(
-        val_contexts,
-        truncation=True,
-        padding="max_length",
-        max_length=source_max_length,
-        add_special_tokens=False,
+    """Read and tokenize the train, dev and test files of the fewrl
+    dataset."""
+    # the concat models ask the question without the relation description.
+    contexts = "concat_contexts" if concat else "contexts"
+    train_data = read_offmml_data(
+        train_fewrel_path,
+        [
+            "passages",
+            contexts,
+            "answers",
+            "entity_relations",
+            "entities",
+            "posterier_contexts",
+        ],
     )
-    val_answer_encodings = answer_tokenizer(
-        val_answers,
-        truncation=True,
-        padding="max_length",
-        max_length=decoder_max_length,
-        add_special_tokens=False,
+    eval_columns = ["passages", contexts, "answers", "entity_relations"]
+    dev_data = read_offmml_data(dev_fewrel_path, eval_columns)
+    test_data = read_offmml_data(test_fewrel_path, eval_columns)
+
+    train_passages = train_data["passages"]
+    train_contexts = train_data[contexts]
+    train_answers = train_data["answers"]
+    train_entity_relations = train_data["entity_relations"]
+    train_entities = [str(row) for row in train_data["entities"]]
+    train_posterier_contexts = train_data["posterier_contexts"]
+
+    val_passages = dev_data["passages"]
+    val_contexts = dev_data[contexts]
+    val_answers = dev_data["answers"]
+    val_entity_relations = dev_data["entity_relations"]
+
+    test_passages = test_data["passages"]
+    test_contexts = test_data[contexts]
+    test_answers = test_data["answers"]
+    test_entity_relations = test_data["entity_relations"]
+
+    question_segments, answer_segments = segment_tokenizers(
+        question_tokenizer, answer_tokenizer
     )
+    val_encodings = question_segments(val_contexts, max_length=source_max_length)
+    val_answer_encodings = answer_segments(val_answers, max_length=decoder_max_length)
 
-    test_encodings = question_tokenizer(
-        test_contexts,
-        truncation=True,
-        padding="max_length",
-        max_length=source_max_length,
-        add_special_tokens=False,
-    )
-    test_answer_encodings = answer_tokenizer(
-        test_answers,
-        truncation=True,
-        padding="max_length",
-        max_length=decoder_max_length,
-        add_special_tokens=False,
-    )
+    test_encodings = question_segments(test_contexts, max_length=source_max_length)
+    test_answer_encodings = answer_segments(test_answers, max_length=decoder_max_length)
 
-    train_encodings = question_tokenizer(
-        train_contexts,
-        truncation=True,
-        padding="max_length",
-        max_length=source_max_length,
-        add_special_tokens=False,
-    )
-    train_answer_encodings = answer_tokenizer(
-        train_answers,
-        truncation=True,
-        padding="max_length",
-        max_length=decoder_max_length,
-        add_special_tokens=False,
+    train_encodings = question_segments(train_contexts, max_length=source_max_length)
+    train_answer_encodings = answer_segments(
+        train_answers, max_length=decoder_max_length
     )
-    train_entity_encodings = question_tokenizer(
-        train_entities,
-        truncation=True,
-        padding="max_length",
-        max_length=decoder_max_length,
-        add_special_tokens=False,
+    train_entity_encodings = question_segments(
+        train_entities, max_length=decoder_max_length
     )
 
-    train_posterier_encodings = question_tokenizer(
-        train_posterier_contexts,
-        truncation=True,
-        padding="max_length",
-        max_length=source_max_length,
-        add_special_tokens=False,
+    train_posterier_encodings = question_segments(
+        train_posterier_contexts, max_length=source_max_length
+    )
+    add_answer_segments(
+        train_encodings, answer_segments, train_passages, train_entity_relations
     )
-    train_encodings["passages"] = train_passages
-    train_encodings["entity_relations"] = train_entity_relations
     train_encodings["posterier_input_ids"] = train_posterier_encodings.pop("input_ids")
     train_encodings["posterier_attention_mask"] = train_posterier_encodings.pop(
         "attention_mask"
@@ -2019,18 +3379,11 @@ def create_fewrl_dataset(
         "attention_mask"
     ]
 
-    # because HuggingFace automatically shifts the labels, the labels correspond exactly to `target_ids`.
-    # We have to make sure that the PAD token is ignored
-
-    train_labels = [
-        [-100 if token == answer_tokenizer.pad_token_id else token for token in labels]
-        for labels in train_encodings["second_entity_labels"]
-    ]
-    train_encodings["second_entity_labels"] = train_labels
-    train_encodings["labels"] = train_labels
+    train_encodings["labels"] = train_encodings["second_entity_labels"]
 
-    val_encodings["passages"] = val_passages
-    val_encodings["entity_relations"] = val_entity_relations
+    add_answer_segments(
+        val_encodings, answer_segments, val_passages, val_entity_relations
+    )
 
     val_encodings["entity_relation_passage_input_ids"] = val_encodings["input_ids"]
     val_encodings["entity_relation_passage_attention_mask"] = val_encodings[
@@ -2043,18 +3396,11 @@ def create_fewrl_dataset(
         "attention_mask"
     ]
 
-    # because Huggingface automatically shifts the labels, the labels correspond exactly to `target_ids`.
-    # We have to make sure that the PAD token is ignored.
-
-    val_labels = [
-        [-100 if token == answer_tokenizer.pad_token_id else token for token in labels]
-        for labels in val_encodings["second_entity_labels"]
-    ]
-    val_encodings["second_entity_labels"] = val_labels
-    val_encodings["labels"] = val_labels
+    val_encodings["labels"] = val_encodings["second_entity_labels"]
 
-    test_encodings["passages"] = test_passages
-    test_encodings["entity_relations"] = test_entity_relations
+    add_answer_segments(
+        test_encodings, answer_segments, test_passages, test_entity_relations
+    )
     test_encodings["entity_relation_passage_input_ids"] = test_encodings["input_ids"]
 
     test_encodings["entity_relation_passage_attention_mask"] = test_encodings[
@@ -2066,41 +3412,65 @@ def create_fewrl_dataset(
         "attention_mask"
     ]
 
-    # because Huggingface automatically shifts the labels, the labels correspond exactly to `target_ids`.
-    # We have to make sure that the PAD token is ignored.
+    test_encodings["labels"] = test_encodings["second_entity_labels"]
 
-    test_labels = [
-        [-100 if token == answer_tokenizer.pad_token_id else token for token in labels]
-        for labels in test_encodings["second_entity_labels"]
-    ]
-    test_encodings["second_entity_labels"] = test_labels
-    test_encodings["labels"] = test_labels
-
-    class HelperDataset(torch.utils.data.Dataset):
-        def __init__(self, encodings):
-            self.encodings = encodings
-
-        def __getitem__(self, idx):
-            row = {}
-            for key, val in self.encodings.items():
-                if key in ["passages", "entity_relations"]:
-                    row[key] = val[idx]
-                else:
-                    row[key] = torch.tensor(val[idx])
-            return row
-
-        def __len__(self):
-            if "entity_relation_passage_input_ids" in self.encodings:
-                return len(self.encodings.entity_relation_passage_input_ids)
-            if "input_ids" in self.encodings:
-                return len(self.encodings.input_ids)
-
-    train_dataset = HelperDataset(train_encodings)
-    val_dataset = HelperDataset(val_encodings)
-    test_dataset = HelperDataset(test_encodings)
-    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True)
-    val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False)
-    test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False)
+    train_dataset = ColumnarDataset(train_encodings)
+    val_dataset = ColumnarDataset(val_encodings)
+    test_dataset = ColumnarDataset(test_encodings)
+    return train_dataset, val_dataset, test_dataset
+
+
+def create_fewrl_dataset(
+    question_tokenizer,
+    answer_tokenizer,
+    batch_size,
+    source_max_length,
+    decoder_max_length,
+    train_fewrel_path=None,
+    dev_fewrel_path=None,
+    test_fewrel_path=None,
+    concat=False,
+    max_tokens=None,
+    cache_dir=None,
+):
+    """Function to create the fewrl dataset.
+
+    With a cache_dir, the tokenized datasets are reused across runs.
+    """
+    names = ["train", "val", "test"]
+    cache_path = dataset_cache_path(
+        cache_dir,
+        [
+            offmml_data_path(train_fewrel_path),
+            offmml_data_path(dev_fewrel_path),
+            offmml_data_path(test_fewrel_path),
+        ],
+        [question_tokenizer, answer_tokenizer],
+        "fewrl",
+        source_max_length,
+        decoder_max_length,
+        concat,
+    )
+    datasets = load_cached_datasets(cache_path, names)
+    if datasets is None:
+        datasets = tokenize_fewrl_dataset(
+            question_tokenizer,
+            answer_tokenizer,
+            source_max_length,
+            decoder_max_length,
+            train_fewrel_path=train_fewrel_path,
+            dev_fewrel_path=dev_fewrel_path,
+            test_fewrel_path=test_fewrel_path,
+            concat=concat,
+        )
+        save_cached_datasets(cache_path, names, datasets)
+    train_dataset, val_dataset, test_dataset = datasets
+
+    train_loader = create_loader(
+        train_dataset, batch_size, shuffle=True, max_tokens=max_tokens
+    )
+    val_loader = create_loader(val_dataset, batch_size, max_tokens=max_tokens)
+    test_loader = create_loader(test_dataset, batch_size, max_tokens=max_tokens)
     return (
         train_loader,
         val_loader,
@@ -2111,72 +3481,51 @@ def create_fewrl_dataset(
     )
 
 
-def create_relation_qq_dataset(
+# The columns of the data split read for the relation qq dataset.
+RELATION_QQ_COLUMNS = [
+    "passages",
+    "contexts",
+    "answers",
+    "entity_relations",
+    "entities",
+    "posterier_contexts",
+]
+
+
+def encode_relation_qq_data(
     question_tokenizer,
     answer_tokenizer,
-    batch_size,
     source_max_length,
     decoder_max_length,
-    train_fewrel_path=None,
-    concat=False,
-    shuffle=False,
-    for_fewrel_dataset=False,
+    train_data,
+    start_index=0,
 ):
-    """Function to create the fewrl dataset for training with negative
-    samples."""
-
-    if for_fewrel_dataset:
-        train_df = pd.read_csv(train_fewrel_path, sep=",")
-
-        train_passages = train_df["passages"].tolist()
-        train_contexts = train_df["contexts"].tolist()
-        train_answers = train_df["answers"].tolist()
-        train_entity_relations = train_df["entity_relations"].tolist()
-        train_entities = [str(row) for row in train_df["entities"].tolist()]
-        train_posterier_contexts = train_df["posterier_contexts"].tolist()
-    else:
-        (
-        train_passages,
-        train_contexts,
-        train_posterier_contexts,
-        train_answers,
-        train_entity_relations,
-        train_entities,
-        ) = read_gold_re_qa_relation_data(
-            train_fewrel_path, concat=False, for_question_generation=True
-        )
-
-    train_encodings = question_tokenizer(
-        train_contexts,
-        truncation=True,
-        padding="max_length",
-        max_length=source_max_length,
-        add_special_tokens=False,
+    """Tokenize the RELATION_QQ_COLUMNS of the rows, where the first row is
+    the example start_index of the data split."""
+    train_passages = train_data["passages"]
+    train_contexts = train_data["contexts"]
+    train_answers = train_data["answers"]
+    train_entity_relations = train_data["entity_relations"]
+    train_entities = [str(row) for row in train_data["entities"]]
+    train_posterier_contexts = train_data["posterier_contexts"]
+
+    question_segments, answer_segments = segment_tokenizers(
+        question_tokenizer, answer_tokenizer
     )
-    train_answer_encodings = answer_tokenizer(
-        train_answers,
-        truncation=True,
-        padding="max_length",
-        max_length=decoder_max_length,
-        add_special_tokens=False,
+    train_encodings = question_segments(train_contexts, max_length=source_max_length)
+    train_answer_encodings = answer_segments(
+        train_answers, max_length=decoder_max_length
     )
-    train_entity_encodings = question_tokenizer(
-        train_entities,
-        truncation=True,
-        padding="max_length",
-        max_length=decoder_max_length,
-        add_special_tokens=False,
+    train_entity_encodings = question_segments(
+        train_entities, max_length=decoder_max_length
     )
 
-    train_posterier_encodings = question_tokenizer(
-        train_posterier_contexts,
-        truncation=True,
-        padding="max_length",
-        max_length=source_max_length,
-        add_special_tokens=False,
+    train_posterier_encodings = question_segments(
+        train_posterier_contexts, max_length=source_max_length
+    )
+    add_answer_segments(
+        train_encodings, answer_segments, train_passages, train_entity_relations
     )
-    train_encodings["passages"] = train_passages
-    train_encodings["entity_relations"] = train_entity_relations
     train_encodings["posterier_input_ids"] = train_posterier_encodings.pop("input_ids")
     train_encodings["posterier_attention_mask"] = train_posterier_encodings.pop(
         "attention_mask"
@@ -2197,37 +3546,171 @@ def create_relation_qq_dataset(
         "attention_mask"
     ]
 
-    # because HuggingFace automatically shifts the labels, the labels correspond exactly to `target_ids`.
-    # We have to make sure that the PAD token is ignored
+    train_encodings["labels"] = train_encodings["second_entity_labels"]
 
-    train_labels = [
-        [-100 if token == answer_tokenizer.pad_token_id else token for token in labels]
-        for labels in train_encodings["second_entity_labels"]
-    ]
-    train_encodings["second_entity_labels"] = train_labels
-    train_encodings["labels"] = train_labels
-
-    class HelperDataset(torch.utils.data.Dataset):
-        def __init__(self, encodings):
-            self.encodings = encodings
-
-        def __getitem__(self, idx):
-            row = {}
-            for key, val in self.encodings.items():
-                if key in ["passages", "entity_relations"]:
-                    row[key] = val[idx]
-                else:
-                    row[key] = torch.tensor(val[idx])
-            return row
+    # keys the offline question samples of every example.
+    train_encodings["example_index"] = list(
+        range(start_index, start_index + len(train_passages))
+    )
+
+    return ColumnarDataset(train_encodings)
+
+
+def tokenize_relation_qq_dataset(
+    question_tokenizer,
+    answer_tokenizer,
+    source_max_length,
+    decoder_max_length,
+    train_fewrel_path=None,
+    for_fewrel_dataset=False,
+    write_relation_data=False,
+):
+    """Read and tokenize the fewrl file for training with negative
+    samples."""
 
-        def __len__(self):
-            if "entity_relation_passage_input_ids" in self.encodings:
-                return len(self.encodings.entity_relation_passage_input_ids)
-            if "input_ids" in self.encodings:
-                return len(self.encodings.input_ids)
+    if not for_fewrel_dataset:
+        return create_relation_data_dataset(
+            question_tokenizer,
+            answer_tokenizer,
+            train_fewrel_path,
+            source_max_length,
+            decoder_max_length,
+            for_question_generation=True,
+            write_relation_data=write_relation_data,
+        )
 
-    train_dataset = HelperDataset(train_encodings)
-    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=shuffle)
+    train_data = read_offmml_data(train_fewrel_path, RELATION_QQ_COLUMNS)
+    return encode_relation_qq_data(
+        question_tokenizer,
+        answer_tokenizer,
+        source_max_length,
+        decoder_max_length,
+        train_data,
+    )
+
+
+def tokenize_relation_qq_shards(
+    question_tokenizer,
+    answer_tokenizer,
+    source_max_length,
+    decoder_max_length,
+    train_fewrel_path,
+    shard_size,
+):
+    """Yield the relation qq dataset of the fewrl file as the datasets of
+    shard_size examples, tokenizing one shard at a time."""
+    start_index = 0
+    for train_data in iter_offmml_data(
+        train_fewrel_path, RELATION_QQ_COLUMNS, chunk_size=shard_size
+    ):
+        yield encode_relation_qq_data(
+            question_tokenizer,
+            answer_tokenizer,
+            source_max_length,
+            decoder_max_length,
+            train_data,
+            start_index=start_index,
+        )
+        start_index += len(train_data["passages"])
+
+
+def create_relation_qq_dataset(
+    question_tokenizer,
+    answer_tokenizer,
+    batch_size,
+    source_max_length,
+    decoder_max_length,
+    train_fewrel_path=None,
+    concat=False,
+    shuffle=False,
+    for_fewrel_dataset=False,
+    max_tokens=None,
+    cache_dir=None,
+    write_relation_data=False,
+    shard_size=None,
+    num_workers=0,
+):
+    """Function to create the fewrl dataset for training with negative
+    samples.
+
+    With a cache_dir, the tokenized dataset is reused across runs. The
+    .relation_data.csv side file is only written when write_relation_data
+    is set and the dataset is not in the cache.
+
+    With a shard_size, the fewrl file is tokenized into shards of
+    shard_size examples, and streamed by a ShardedDataset through
+    num_workers loader workers, so the dataset is never held in memory.
+    The shards are kept in the cache_dir, which is required with a
+    shard_size. The sharded batches have batch_size examples, max_tokens
+    is not used.
+    """
+    if for_fewrel_dataset:
+        file_paths = [offmml_data_path(train_fewrel_path)]
+    else:
+        # the prompts have the descriptions of relation_descriptions.json.
+        file_paths = [train_fewrel_path, REPO_DIR / "relation_descriptions.json"]
+    if shard_size is not None and for_fewrel_dataset:
+        if cache_dir is None:
+            raise ValueError("the shards of a shard_size need a cache_dir.")
+        shards_path = dataset_cache_path(
+            cache_dir,
+            file_paths,
+            [question_tokenizer, answer_tokenizer],
+            "relation_qq_shards",
+            source_max_length,
+            decoder_max_length,
+            shard_size,
+        )
+        if not os.path.exists(shards_path):
+            write_shards(
+                shards_path,
+                tokenize_relation_qq_shards(
+                    question_tokenizer,
+                    answer_tokenizer,
+                    source_max_length,
+                    decoder_max_length,
+                    train_fewrel_path,
+                    shard_size,
+                ),
+            )
+        train_dataset = ShardedDataset(
+            shards_path, batch_size, shuffle=shuffle, num_workers=num_workers
+        )
+        train_loader = create_sharded_loader(train_dataset)
+        return (
+            train_loader,
+            train_dataset,
+        )
+
+    names = ["train"]
+    cache_path = dataset_cache_path(
+        cache_dir,
+        file_paths,
+        [question_tokenizer, answer_tokenizer],
+        "relation_qq",
+        source_max_length,
+        decoder_max_length,
+        for_fewrel_dataset,
+    )
+    datasets = load_cached_datasets(cache_path, names)
+    if datasets is None:
+        datasets = [
+            tokenize_relation_qq_dataset(
+                question_tokenizer,
+                answer_tokenizer,
+                source_max_length,
+                decoder_max_length,
+                train_fewrel_path=train_fewrel_path,
+                for_fewrel_dataset=for_fewrel_dataset,
+                write_relation_data=write_relation_data,
+            )
+        ]
+        save_cached_datasets(cache_path, names, datasets)
+    train_dataset = datasets[0]
+
+    train_loader = create_loader(
+        train_dataset, batch_size, shuffle=shuffle, max_tokens=max_tokens
+    )
     return (
         train_loader,
         train_dataset,
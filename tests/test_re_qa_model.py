@@ -0,0 +1,277 @@
+"""Tests of the REQA model helpers."""
+
+import os
+
+import pytest
+import torch
+from transformers import (LogitsProcessorList, T5Config, T5ForConditionalGeneration,
+                          T5Tokenizer)
+
+import src.re_qa_model as re_qa_model
+from src.zero_extraction_utils import (ColumnarDataset, add_answer_segments,
+                                       segment_tokenizers)
+from src.re_qa_model import (MODEL_NAME, REQA, CheckpointWriter, HyperParameters,
+                             PGGQuestionCache, QuestionSampleBank,
+                             SampledLogProbs, load_weights,
+                             remove_prefix, splice_input_ids,
+                             write_flat_checkpoint)
+
+ENTITY_RELATIONS = ["Barack Obama <SEP> place of birth", "Paris <SEP> country"]
+PASSAGES = [
+    "Barack Obama was born in Honolulu , Hawaii in 1961 .",
+    "Paris is the capital and most populous city of France , with an "
+    "estimated population of 2,165,423 residents in 2019 .",
+]
+QUESTIONS = [
+    "question: where was Barack Obama born?",
+    "question: which country is Paris in?",
+    "question: what is the capital?",
+]
+
+
+def splicing_model(tokenizer, source_max_length):
+    """A REQA with only the tokenizers and the segments of the answer module
+    inputs, without loading the t5 models."""
+    model = REQA.__new__(REQA)
+    torch.nn.Module.__init__(model)
+    model.config = HyperParameters(source_max_length=source_max_length)
+    model.answer_tokenizer = tokenizer
+    model.question_tokenizer = tokenizer
+    model.init_segment_ids()
+    return model
+
+
+def string_answer_inputs(tokenizer, articles, source_max_length):
+    """The answer module inputs of the tokenized strings."""
+    answer_inputs = tokenizer(
+        articles,
+        truncation=True,
+        padding=True,
+        max_length=source_max_length,
+        add_special_tokens=False,
+        return_tensors="pt",
+    )
+    return answer_inputs.input_ids, answer_inputs.attention_mask
+
+
+def test_splice_input_ids_matches_tokenizer():
+    tokenizer = T5Tokenizer.from_pretrained(MODEL_NAME)
+    segments = ["relation:", ENTITY_RELATIONS[1], "context:", PASSAGES[1], "</s>"]
+    segment_ids = [
+        tokenizer(segment, add_special_tokens=False).input_ids for segment in segments
+    ]
+    for max_length in [8, 16, 64]:
+        input_ids, attention_mask = splice_input_ids(
+            [segment_ids], max_length, pad_token_id=tokenizer.pad_token_id
+        )
+        ids, mask = string_answer_inputs(tokenizer, [" ".join(segments)], max_length)
+        assert torch.equal(input_ids, ids)
+        assert torch.equal(attention_mask, mask)
+
+
+def test_answer_module_input_matches_string_path():
+    """The spliced answer module inputs of the generated question ids are
+    the ids of the 'relation: ... question: ... context: ... </s>' strings,
+    also when they are truncated at the source_max_length, both from the
+    strings of the batch and from its passage and entity relation ids."""
+    tokenizer = T5Tokenizer.from_pretrained(MODEL_NAME)
+
+    # generated questions start with the decoder start token and are padded.
+    question_ids = torch.tensor(tokenizer(QUESTIONS, padding=True).input_ids)
+    start_ids = torch.zeros((len(QUESTIONS), 1), dtype=torch.long)
+    question_ids = torch.cat([start_ids, question_ids], dim=1)
+    example_ids = torch.tensor([0, 1, 1])
+    batch = {"entity_relations": ENTITY_RELATIONS, "passages": PASSAGES}
+    encodings = {"example_index": [0, 1]}
+    _, answer_segments = segment_tokenizers(tokenizer, tokenizer)
+    add_answer_segments(encodings, answer_segments, PASSAGES, ENTITY_RELATIONS)
+    column_batch = ColumnarDataset(encodings)[[0, 1]]
+
+    questions = [
+        remove_prefix(question, "question: ")
+        for question in tokenizer.batch_decode(question_ids, skip_special_tokens=True)
+    ]
+    articles = [
+        "relation: "
+        + batch["entity_relations"][example_id]
+        + " question: "
+        + question
+        + " context: "
+        + batch["passages"][example_id]
+        + " </s>"
+        for example_id, question in zip(example_ids.tolist(), questions)
+    ]
+    for source_max_length in [24, 40, 256]:
+        model = splicing_model(tokenizer, source_max_length)
+        ids, mask = string_answer_inputs(tokenizer, articles, source_max_length)
+        for input_batch in [batch, column_batch]:
+            input_ids, attention_mask = model.answer_module_input(
+                input_batch, question_ids, example_ids, current_device=None
+            )
+            assert torch.equal(input_ids, ids)
+            assert torch.equal(attention_mask, mask)
+
+
+def test_answer_module_input_keeps_question_ids():
+    """The generated question ids are spliced as they are, also when they
+    are not the tokenization of their text."""
+    tokenizer = T5Tokenizer.from_pretrained(MODEL_NAME)
+    model = splicing_model(tokenizer, 256)
+    batch = {"entity_relations": ENTITY_RELATIONS, "passages": PASSAGES}
+
+    # the question tokenized one character at a time.
+    question = [
+        token
+        for character in "where"
+        for token in tokenizer(character, add_special_tokens=False).input_ids
+    ]
+    question_ids = torch.tensor(
+        [[0] + model.question_prefix_ids + question + [tokenizer.eos_token_id]]
+    )
+    assert question != tokenizer("where", add_special_tokens=False).input_ids
+
+    input_ids, _ = model.answer_module_input(
+        batch, question_ids, torch.tensor([0]), current_device=None
+    )
+    start = len(model.relation_prefix_ids) + len(
+        tokenizer(ENTITY_RELATIONS[0], add_special_tokens=False).input_ids
+    )
+    start += len(model.question_prefix_ids)
+    assert input_ids[0, start : start + len(question)].tolist() == question
+
+
+def tiny_t5(seed):
+    torch.manual_seed(seed)
+    config = T5Config(
+        vocab_size=64,
+        d_model=16,
+        d_kv=8,
+        d_ff=32,
+        num_layers=2,
+        num_heads=2,
+        decoder_start_token_id=0,
+        pad_token_id=0,
+    )
+    return T5ForConditionalGeneration(config)
+
+
+@pytest.mark.parametrize("dtype", [None, "float16", "bfloat16"])
+@pytest.mark.parametrize("base", [None, "t5-small"])
+def test_flat_checkpoint_round_trip(tmp_path, monkeypatch, dtype, base):
+    """The flat checkpoints load into the model, exactly for the full
+    precision ones, and keep the tied weights as one tensor."""
+    base_weights = tiny_t5(0).state_dict()
+    monkeypatch.setattr(re_qa_model, "pretrained_weights", lambda name: base_weights)
+    model = tiny_t5(1)
+    state_dict = model.state_dict()
+    path = os.path.join(str(tmp_path), "model_1")
+
+    write_flat_checkpoint(
+        {"module." + key: value for key, value in state_dict.items()},
+        path,
+        dtype=dtype,
+        base=base,
+    )
+    weights = load_weights(path)
+    assert weights.keys() == state_dict.keys()
+    assert weights["shared.weight"] is weights["encoder.embed_tokens.weight"]
+    atol = 1e-6 if dtype is None else 1e-2
+    for key, value in state_dict.items():
+        assert torch.allclose(weights[key].float(), value.float(), atol=atol)
+
+    loaded = tiny_t5(2)
+    loaded.load_state_dict(weights)
+    if dtype is None and base is None:
+        for key, value in loaded.state_dict().items():
+            assert torch.equal(value, state_dict[key])
+
+
+def test_checkpoint_writer_flat(tmp_path):
+    model = tiny_t5(1)
+    path = os.path.join(str(tmp_path), "model_1")
+    writer = CheckpointWriter(flat=True, dtype="bfloat16")
+    writer.save(model, path)
+    writer.wait()
+    assert not os.path.exists(path + ".tmp")
+    weights = load_weights(path)
+    assert weights["shared.weight"].dtype == torch.bfloat16
+    tiny_t5(2).load_state_dict(weights)
+
+
+def test_sampled_log_probs_match_scores():
+    """The log probabilities gathered during the sampling are the ones of the
+    warped scores returned by generate, and the samples are the same."""
+    model = tiny_t5(1).eval()
+    input_ids = torch.randint(2, 64, (2, 7))
+    generate_kwargs = dict(
+        input_ids=input_ids,
+        do_sample=True,
+        no_repeat_ngram_size=2,
+        max_length=12,
+        num_return_sequences=4,
+    )
+    with torch.no_grad():
+        torch.manual_seed(7)
+        outputs = model.generate(
+            top_k=20,
+            top_p=0.9,
+            output_scores=True,
+            return_dict_in_generate=True,
+            **generate_kwargs
+        )
+        torch.manual_seed(7)
+        log_p_processor = SampledLogProbs(top_k=20, top_p=0.9)
+        sequences = model.generate(
+            top_k=0,
+            top_p=1.0,
+            logits_processor=LogitsProcessorList([log_p_processor]),
+            **generate_kwargs
+        )
+    assert torch.equal(sequences, outputs.sequences)
+
+    log_p = torch.zeros(sequences.size(0))
+    for step, scores in enumerate(outputs.scores):
+        tokens = sequences[:, step + 1]
+        token_log_p = torch.log_softmax(scores, dim=-1).gather(1, tokens[:, None])
+        log_p += token_log_p.squeeze(1).masked_fill(tokens == 0, 0.0)
+    assert torch.allclose(log_p_processor.finish(sequences), log_p)
+
+
+def test_pgg_question_cache_refresh():
+    """The cached questions are stale when missing or refresh_steps old."""
+    cache = PGGQuestionCache(max_length=4, refresh_steps=2)
+    example_index = torch.tensor([3, 0])
+    assert cache.stale(example_index).tolist() == [True, True]
+    cache.write(example_index, torch.tensor([[0, 5, 6, 1, 0], [0, 7, 1, 0, 0]]))
+    cache.advance()
+    assert cache.stale(torch.tensor([0, 9, 3])).tolist() == [False, True, False]
+    assert cache.read(example_index).tolist() == [[0, 5, 6, 1], [0, 7, 1, 0]]
+    cache.advance()
+    assert cache.stale(example_index).tolist() == [True, True]
+
+
+def test_question_sample_bank_meta(tmp_path):
+    """The bank is read back with its build metadata, and rejected for other
+    data or before it is complete."""
+    path = os.path.join(str(tmp_path), "bank")
+    bank = QuestionSampleBank(
+        path, mode="w", num_examples=3, num_samples=2, max_length=4, source_digest="a"
+    )
+    bank.write(
+        torch.tensor([2, 0]),
+        torch.tensor([[5, 1], [6, 7], [8, 1], [9, 1]]),
+        torch.tensor([-1.0, -2.0, -3.0, -4.0]),
+    )
+    with pytest.raises(ValueError):
+        QuestionSampleBank(path)
+    bank.flush()
+
+    bank = QuestionSampleBank(path)
+    bank.check(num_examples=3, num_samples=2, max_length=4, source_digest="a")
+    questions, log_ps = bank.read(torch.tensor([0]))
+    assert questions.tolist() == [[8, 1, 0, 0], [9, 1, 0, 0]]
+    assert log_ps.tolist() == [-3.0, -4.0]
+    with pytest.raises(ValueError):
+        bank.check(num_examples=4, source_digest="a")
+    with pytest.raises(ValueError):
+        bank.check(source_digest="b")
@@ -0,0 +1,233 @@
+"""Tests of the data preparation and evaluation utilities."""
+
+import json
+import os
+
+import numpy
+import pytest
+
+import src.zero_extraction_utils as zero_extraction_utils
+from src.zero_extraction_utils import (OFFMML_COLUMNS, ColumnarDataset,
+                                       OffmmlWriter, ShardedDataset,
+                                       create_sharded_loader,
+                                       iter_json_items, iter_offmml_data,
+                                       offmml_answer_pieces, offmml_pieces_row,
+                                       offmml_relation_pieces, offmml_row,
+                                       offmml_sentence_pieces, offmml_table_path,
+                                       read_fewrl_dataset,
+                                       read_fewrl_dataset_seeds,
+                                       read_json_value, read_offmml_data,
+                                       read_relation_gold_ids,
+                                       read_wikizsl_dataset,
+                                       read_wikizsl_dataset_seeds,
+                                       relation_catalog, relation_f1,
+                                       wikizsl_pieces, write_shards,
+                                       write_wikizsl_split)
+
+
+def test_relation_f1_wikizsl_split(tmp_path):
+    """A perfect predictor scores an f1 of one on a wikizsl dev split, whose
+    candidate relations do not follow the order of its rows."""
+    id_to_label = relation_catalog().id_to_label
+    relation_ids = list(id_to_label)[:30]
+    rows = [
+        ("sentence {0} {1}".format(i, r_id), "head {0}".format(i), "tail", r_id)
+        for i in range(4)
+        for r_id in relation_ids
+    ]
+    write_wikizsl_split(
+        relation_ids, wikizsl_pieces(rows), seed=12321, output_dir=str(tmp_path)
+    )
+
+    dev_path = os.path.join(str(tmp_path), "val_data_12321.csv")
+    data = read_offmml_data(dev_path, ["actual_ids", "entity_relations"])
+    actual_ids = data["actual_ids"]
+    first_appearance = list(dict.fromkeys(actual_ids))
+    labels = [
+        entity_relation.split("<SEP>")[1].strip()
+        for entity_relation in data["entity_relations"]
+    ]
+    assert labels[:5] != [id_to_label[r_id] for r_id in first_appearance]
+
+    log_ps = [
+        0.0 if label == id_to_label[r_id] else -10.0
+        for label, r_id in zip(labels, actual_ids)
+    ]
+    gold_ids = read_relation_gold_ids(dev_path)
+    assert len(gold_ids) == len(actual_ids) // 5
+    assert relation_f1(log_ps, gold_ids) == 1.0
+
+    samples = numpy.repeat(numpy.asarray(log_ps)[:, None], 3, axis=1)
+    assert relation_f1(samples.reshape(-1), gold_ids, num_samples=3) == 1.0
+
+
+def test_iter_offmml_data_chunks(tmp_path, monkeypatch):
+    """The chunks of the columnar table are the rows of the csv file."""
+    monkeypatch.setattr(zero_extraction_utils, "OFFMML_FLUSH_ROWS", 4)
+    csv_path = os.path.join(str(tmp_path), "train_data_1.csv")
+    with OffmmlWriter(csv_path, actual_ids=True) as writer:
+        for i in range(7):
+            for r_name in ["place of birth", "country", "employer"]:
+                writer.writerow(
+                    "sentence {0} é".format(i),
+                    "head {0}".format(i % 2),
+                    r_name,
+                    r_name + " description",
+                    "tail {0}".format(i),
+                    actual_id="P{0}".format(i % 3),
+                )
+    assert sorted(os.listdir(str(tmp_path))) == ["train_data_1.csv", "train_data_1.npz"]
+    with numpy.load(offmml_table_path(csv_path)) as table:
+        assert len(table["passages.offsets"]) == 7 + 1
+        assert len(table["relations.codes"]) == 21
+    columns = OFFMML_COLUMNS + ["actual_ids"]
+    data = read_offmml_data(csv_path, columns)
+    chunks = list(iter_offmml_data(csv_path, columns, chunk_size=4))
+    assert [len(chunk["passages"]) for chunk in chunks] == [4, 4, 4, 4, 4, 1]
+    for column in columns:
+        assert sum([chunk[column] for chunk in chunks], []) == data[column]
+
+    os.remove(offmml_table_path(csv_path))
+    assert read_offmml_data(csv_path, columns) == data
+
+
+def test_iter_json_items_small_chunks(tmp_path):
+    """The items are decoded whole when they span the chunks, also the bare
+    numbers."""
+    items = [1, 2.5, 333, -4e2, 0.125, True, None, "é x", {"a": [1, 2]}, 10]
+    for indent in [None, 2]:
+        array_path = os.path.join(str(tmp_path), "array.json")
+        with open(array_path, "w", encoding="utf-8") as fd:
+            json.dump(items, fd, indent=indent)
+        object_path = os.path.join(str(tmp_path), "object.json")
+        with open(object_path, "w", encoding="utf-8") as fd:
+            json.dump({str(i): item for i, item in enumerate(items)}, fd, indent=indent)
+
+        for chunk_size in range(1, 8):
+            rows = list(iter_json_items(array_path, chunk_size=chunk_size))
+            assert [row[1] for row in rows] == items
+            for _, item, start, end in rows:
+                assert read_json_value(array_path, start, end) == item
+
+            rows = list(iter_json_items(object_path, chunk_size=chunk_size))
+            assert [(row[0], row[1]) for row in rows] == [
+                (str(i), item) for i, item in enumerate(items)
+            ]
+
+
+def test_offmml_pieces_row():
+    """The rows joined from the prompt pieces are the rows of offmml_row."""
+    for sentence, head_entity, r_name, r_desc, gold_answers in [
+        ("a  sentence\t é ", " head  entity", "place of  birth ", " born in", "x  y"),
+        ("sentence", "", "country", "", " "),
+    ]:
+        row = offmml_pieces_row(
+            offmml_sentence_pieces(sentence, head_entity),
+            offmml_relation_pieces(r_name, r_desc),
+            offmml_answer_pieces(gold_answers),
+        )
+        assert row == offmml_row(sentence, head_entity, r_name, r_desc, gold_answers)
+
+
+def write_split_files(output_dir, seeds):
+    """The content of the files written for the seeds."""
+    files = {}
+    for seed in seeds:
+        for split in ["train", "val", "test"]:
+            for name in [split + "_data_{0}.csv", split + "_ids_{0}.csv"]:
+                path = os.path.join(output_dir, name.format(seed))
+                with open(path, "r") as fd:
+                    files[name.format(seed)] = fd.read()
+    return files
+
+
+def test_dataset_seeds_match_single_seeds(tmp_path):
+    """The splits written together for the seeds on a pool of workers are
+    the splits of the single seeds."""
+    relation_ids = list(relation_catalog().id_to_label)[:10]
+    seeds = [12321, 943]
+    fewrel = {
+        r_id: [
+            {
+                "tokens": ["sentence", str(i), r_id, "head", "tail"],
+                "h": ["head", "", [[3]]],
+                "t": ["tail", "", [[4]]],
+            }
+            for i in range(50)
+        ]
+        for r_id in relation_ids
+    }
+    fewrel_path = os.path.join(str(tmp_path), "fewrel.json")
+    with open(fewrel_path, "w") as fd:
+        json.dump(fewrel, fd)
+    wikizsl = [
+        {
+            "tokens": ["sentence", str(i), r_id, "head", "tail"],
+            "edgeSet": [{"kbID": r_id, "left": [3], "right": [4]}],
+        }
+        for i in range(3)
+        for r_id in relation_ids
+    ]
+    wikizsl_path = os.path.join(str(tmp_path), "wikizsl.json")
+    with open(wikizsl_path, "w") as fd:
+        json.dump(wikizsl, fd)
+
+    for read_dataset, read_dataset_seeds, path in [
+        (read_fewrl_dataset, read_fewrl_dataset_seeds, fewrel_path),
+        (read_wikizsl_dataset, read_wikizsl_dataset_seeds, wikizsl_path),
+    ]:
+        single_dir = os.path.join(str(tmp_path), read_dataset.__name__)
+        seeds_dir = single_dir + "_seeds"
+        os.makedirs(single_dir)
+        os.makedirs(seeds_dir)
+        for seed in seeds:
+            read_dataset(path, seed=seed, m=2, output_dir=single_dir)
+        read_dataset_seeds(path, seeds, m=2, num_workers=2, output_dir=seeds_dir)
+        assert write_split_files(seeds_dir, seeds) == write_split_files(
+            single_dir, seeds
+        )
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_sharded_dataset_equal_ranks(tmp_path, num_workers, shuffle):
+    """Every rank yields len(dataset) batches of the same number of
+    examples, and together they read every example."""
+    path = os.path.join(str(tmp_path), "shards")
+    sizes = [7, 3, 1, 6]
+    starts = numpy.cumsum([0] + sizes)
+    write_shards(
+        path,
+        (
+            ColumnarDataset(
+                {
+                    "input_ids": [[5, 6]] * size,
+                    "example_index": list(range(start, start + size)),
+                }
+            )
+            for start, size in zip(starts, sizes)
+        ),
+    )
+    indices = []
+    batch_counts = []
+    example_counts = []
+    for rank in range(3):
+        dataset = ShardedDataset(
+            path,
+            batch_size=2,
+            shuffle=shuffle,
+            buffer_size=4,
+            seed=1,
+            rank=rank,
+            world_size=3,
+            num_workers=num_workers,
+        )
+        batches = list(create_sharded_loader(dataset))
+        assert len(batches) == len(dataset)
+        rank_indices = [i for batch in batches for i in batch["example_index"].tolist()]
+        batch_counts.append(len(batches))
+        example_counts.append(len(rank_indices))
+        indices += rank_indices
+    assert len(set(batch_counts)) == 1
+    assert len(set(example_counts)) == 1
+    assert set(indices) == set(range(sum(sizes)))